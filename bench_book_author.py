@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for book_author.py.
+
+    $ python bench_book_author.py micro [--repeat N]
+    $ python bench_book_author.py load [--authors N] [--driver socket] ...
+
+micro times single cheap requests against the app in-process, so the
+per-request overhead (routing, headers, negotiation) is what gets measured
+rather than the storage. Microseconds per request, best of three runs.
+
+load builds a synthetic catalog and runs a mixed read / write workload
+against it, either in-process or over a local socket with several client
+threads, and reports throughput, p50 / p99 latency per route and peak RSS.
+Everything random comes from --seed, so the same arguments give the same
+catalog and the same requests.
+
+Both take --json PATH to also write the results there ("-" for stdout), to
+keep and compare across releases.
+"""
+
+import book_author
+
+import argparse
+import bisect
+import httplib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import cStringIO
+import wsgiref.simple_server
+import wsgiref.util
+
+
+def environ(method, path, query='', body=None, accept=None, c_type='application/json'):
+    env = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'bench',
+        'SERVER_PORT': '80',
+        'wsgi.input': cStringIO.StringIO(body or ''),
+    }
+    if body is not None:
+        env['CONTENT_TYPE'] = c_type
+        env['CONTENT_LENGTH'] = str(len(body))
+    if accept is not None:
+        env['HTTP_ACCEPT'] = accept
+    return env
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def peak_rss_kb():
+    # ru_maxrss is KB on Linux, bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if 'darwin' == sys.platform:
+        rss //= 1024
+    return rss
+
+
+def write_json(results, path):
+    if path is None:
+        return
+    s = json.dumps(results, indent=4, sort_keys=True)
+    if '-' == path:
+        print s
+    else:
+        with open(path, 'w') as f:
+            f.write(s + '\n')
+
+
+
+# ------------------------------------------------------------
+# micro
+# ------------------------------------------------------------
+
+def run(app, make_environ, n):
+    # seconds per request, best of three
+    best = None
+    for i in range(3):
+        environs = [make_environ() for j in xrange(n)]
+        t = time.time()
+        for env in environs:
+            for chunk in app(env, start_response):
+                pass
+        t = (time.time() - t) / n
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def shift_path_split(path):
+    # how BookAuthor split paths before the Router, for comparison
+    parts = []
+    pathenv = {'PATH_INFO': path}
+    p = wsgiref.util.shift_path_info(pathenv)
+    while p is not None:
+        parts.append(p)
+        p = wsgiref.util.shift_path_info(pathenv)
+    return parts
+
+
+def run_dispatch(dispatch, paths, n):
+    # seconds per path, best of three
+    best = None
+    for i in range(3):
+        t = time.time()
+        for j in xrange(n // len(paths)):
+            for path in paths:
+                dispatch(path)
+        t = (time.time() - t) / (n // len(paths) * len(paths))
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def cases():
+    # (name, make_environ)
+    body = json.dumps([{"title": "b1", "pubdate": 1}])
+    return [
+        ("GET entity", lambda: environ('GET', '/author/a1/1')),
+        ("GET missing entity", lambda: environ('GET', '/author/nobody/1')),
+        ("GET no route", lambda: environ('GET', '/nothing/here')),
+        ("GET query page", lambda: environ('GET', '/query/author_by_books', 'limit=1')),
+        ("PUT entity, no change", lambda: environ('PUT', '/author/a1/1', body=body)),
+        ("DELETE missing entity", lambda: environ('DELETE', '/book/nothing/1')),
+    ]
+
+
+def micro(args):
+    # no response cache, so every request goes all the way through
+    app = book_author.BookAuthor(cache_bytes=0)
+    app.storage.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+    results = {}
+    paths = ['/author/a1/1', '/query/author_by_books', '/bulk', '/nothing/here']
+    results["split, shift_path_info"] = run_dispatch(shift_path_split, paths, args.repeat)
+    results["route, Router.match"] = run_dispatch(app.router.match, paths, args.repeat)
+    for name, make_environ in cases():
+        results[name] = run(app, make_environ, args.repeat)
+    # what /metrics costs per request
+    bare = book_author.BookAuthor(cache_bytes=0, metrics=False)
+    bare.storage.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+    results["GET entity, no metrics"] = run(bare, cases()[0][1], args.repeat)
+    for name in sorted(results):
+        print "%-24s %8.2f us/request" % (name, results[name] * 1e6)
+    write_json({
+        "benchmark": "micro",
+        "python": platform.python_version(),
+        "repeat": args.repeat,
+        "us_per_request": dict((k, v * 1e6) for k, v in results.iteritems()),
+    }, args.json)
+    return results
+
+
+
+# ------------------------------------------------------------
+# load
+# ------------------------------------------------------------
+
+class Zipf(object):
+    # ranks 1..n, rank k drawn with weight 1 / k ** s
+    
+    def __init__(self, n, s):
+        self.cdf = []
+        total = 0.0
+        for k in xrange(1, n + 1):
+            total += 1.0 / k ** s
+            self.cdf.append(total)
+        self.total = total
+    
+    def sample(self, rnd):
+        return bisect.bisect_left(self.cdf, rnd.random() * self.total) + 1
+
+
+def make_catalog(authors, books, max_books, s, seed):
+    # [(side, idstr, date, rels)] ready for bulk_create: books per author
+    # are Zipf distributed, and so is which books they are, so popular
+    # books end up with many authors
+    rnd = random.Random(seed)
+    count = Zipf(max_books, s)
+    which = Zipf(books, s)
+    records = []
+    for i in xrange(authors):
+        rels = set()
+        for j in xrange(count.sample(rnd)):
+            b = which.sample(rnd) - 1
+            rels.add(("book%d" % b, 1900 + b % 120))
+        records.append(("author", "author%d" % i, 1900 + i % 100, sorted(rels)))
+    return records
+
+
+def make_workload(catalog, requests, write_ratio, s, seed):
+    # [(route, method, path, query, body)]; reads and writes both favour
+    # the authors and books at the start of the catalog
+    rnd = random.Random(seed)
+    authors = [(idstr, date) for side, idstr, date, rels in catalog]
+    books = sorted(set(r for side, idstr, date, rels in catalog for r in rels))
+    pick_author = Zipf(len(authors), s)
+    pick_book = Zipf(len(books), s)
+    ops = []
+    for i in xrange(requests):
+        a = authors[pick_author.sample(rnd) - 1]
+        b = books[pick_book.sample(rnd) - 1]
+        a_path = "/author/%s/%d" % a
+        b_path = "/book/%s/%d" % b
+        r = rnd.random()
+        if r >= write_ratio:
+            r = (r - write_ratio) / (1 - write_ratio)
+            if r < 0.5:
+                ops.append(("GET /author", "GET", a_path, "", None))
+            elif r < 0.8:
+                ops.append(("GET /book", "GET", b_path, "", None))
+            elif r < 0.95:
+                ops.append(("GET /query page", "GET", "/query/author_by_books", "limit=20", None))
+            else:
+                ops.append(("GET /query min_count", "GET", "/query/book_by_authors",
+                    "limit=20&min_count=3", None))
+        else:
+            r = r / write_ratio
+            if r < 0.6:
+                body = json.dumps([{"title": "book%d" % rnd.randint(0, len(books)), "pubdate": 1}])
+                ops.append(("PUT /author", "PUT", a_path, "", body))
+            elif r < 0.9:
+                body = json.dumps([{"name": "author%d" % rnd.randint(0, len(authors)), "dob": 1}])
+                ops.append(("PUT /book", "PUT", b_path, "", body))
+            else:
+                ops.append(("DELETE /author", "DELETE", a_path, "", None))
+    return ops
+
+
+def make_storage(name, directory):
+    if "compact" == name:
+        return book_author.BookAuthorCompactStorage()
+    if "sqlite" == name:
+        return book_author.BookAuthorSQLiteStorage(os.path.join(directory, "bench.db"))
+    return book_author.BookAuthorMemStorage()
+
+
+def drive_inprocess(app, ops):
+    # [(route, status, seconds)]
+    timings = []
+    status = []
+    def capture(s, headers, exc_info=None):
+        status.append(s)
+    for route, method, path, query, body in ops:
+        env = environ(method, path, query, body)
+        t = time.time()
+        for chunk in app(env, capture):
+            pass
+        timings.append((route, int(status.pop()[:3]), time.time() - t))
+    return timings
+
+
+def drive_socket(port, ops, clients):
+    # ops dealt out to client threads, each on its own keep-alive
+    # connection (reopened when the server closes it)
+    timings = []
+    lock = threading.Lock()
+    def client(ops):
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        mine = []
+        for route, method, path, query, body in ops:
+            url = path + ('?' + query if query else '')
+            headers = {}
+            if body is not None:
+                headers['Content-Type'] = 'application/json'
+            t = time.time()
+            try:
+                conn.request(method, url, body, headers)
+                res = conn.getresponse()
+                res.read()
+                status = res.status
+                if 'close' == (res.getheader('connection') or '').lower() or res.version < 11:
+                    conn.close()
+            except (httplib.HTTPException, EnvironmentError):
+                conn.close()
+                status = 0
+            mine.append((route, status, time.time() - t))
+        conn.close()
+        with lock:
+            timings.extend(mine)
+    threads = [threading.Thread(target=client, args=(ops[i::clients],))
+        for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return timings
+
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_server(app, kind, threads):
+    # (server, thread) serving app on a free local port
+    if "async" == kind:
+        httpd = book_author.AsyncHTTPServer('127.0.0.1', 0, app)
+        t = threading.Thread(target=httpd.serve_forever, args=(0.05,))
+    else:
+        if "threaded" == kind:
+            httpd = book_author.make_threaded_server('127.0.0.1', 0, app, threads)
+        else:
+            httpd = wsgiref.simple_server.make_server('127.0.0.1', 0, app)
+        httpd.RequestHandlerClass = QuietHandler
+        t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return (httpd, t)
+
+
+def stop_server(httpd, t):
+    httpd.shutdown()
+    t.join()
+    httpd.server_close()
+
+
+def percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(timings, seconds):
+    routes = {}
+    for route, status, t in timings:
+        routes.setdefault(route, []).append((t, status))
+    a = {}
+    for route, values in routes.iteritems():
+        times = sorted(t for t, status in values)
+        statuses = {}
+        for t, status in values:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        a[route] = {
+            "count": len(times),
+            "p50_ms": percentile(times, 0.50) * 1e3,
+            "p99_ms": percentile(times, 0.99) * 1e3,
+            "mean_ms": sum(times) / len(times) * 1e3,
+            "status": statuses,
+        }
+    return {
+        "requests": len(timings),
+        "seconds": seconds,
+        "throughput": len(timings) / seconds if seconds else None,
+        "routes": a,
+    }
+
+
+def load(args):
+    directory = tempfile.mkdtemp(prefix="bench_book_author")
+    try:
+        catalog = make_catalog(args.authors, args.books, args.max_books, args.zipf, args.seed)
+        ops = make_workload(catalog, args.requests, args.write_ratio, args.zipf, args.seed + 1)
+        storage = make_storage(args.storage, directory)
+        app = book_author.BookAuthor(storage=storage, cache_bytes=args.cache_mb << 20)
+        t = time.time()
+        for i in xrange(0, len(catalog), 1000):
+            storage.bulk_create(catalog[i:i + 1000])
+        load_seconds = time.time() - t
+        
+        t = time.time()
+        if "socket" == args.driver:
+            httpd, thread = start_server(app, args.server, args.threads)
+            try:
+                timings = drive_socket(httpd.server_port, ops, args.clients)
+            finally:
+                stop_server(httpd, thread)
+        else:
+            timings = drive_inprocess(app, ops)
+        results = summarize(timings, time.time() - t)
+        if hasattr(storage, "close"):
+            storage.close()
+    finally:
+        shutil.rmtree(directory, True)
+    
+    results.update({
+        "benchmark": "load",
+        "python": platform.python_version(),
+        "config": dict((k, v) for k, v in vars(args).iteritems()
+            if k not in ("func", "json")),
+        "catalog": {
+            "authors": len(catalog),
+            "edges": sum(len(rels) for side, idstr, date, rels in catalog),
+            "load_seconds": load_seconds,
+        },
+        "peak_rss_kb": peak_rss_kb(),
+    })
+    print "%d requests in %.2fs, %.0f/s, peak RSS %d KB" % (results["requests"],
+        results["seconds"], results["throughput"], results["peak_rss_kb"])
+    for route in sorted(results["routes"]):
+        r = results["routes"][route]
+        print "%-22s %7d  p50 %8.3f ms  p99 %8.3f ms" % (route, r["count"],
+            r["p50_ms"], r["p99_ms"])
+    write_json(results, args.json)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="book_author benchmarks")
+    sub = parser.add_subparsers()
+    p = sub.add_parser("micro", help="per-request overhead, in-process")
+    p.add_argument("--repeat", type=int, default=20000, metavar="N",
+        help="requests per run (default 20000)")
+    p.set_defaults(func=micro)
+    p = sub.add_parser("load", help="mixed workload over a synthetic catalog")
+    p.add_argument("--authors", type=int, default=10000, metavar="N")
+    p.add_argument("--books", type=int, default=20000, metavar="N",
+        help="size of the pool books are drawn from")
+    p.add_argument("--max-books", type=int, default=200, metavar="N",
+        help="most books one author can have")
+    p.add_argument("--zipf", type=float, default=1.2, metavar="S",
+        help="Zipf exponent for books per author and for popularity")
+    p.add_argument("--requests", type=int, default=20000, metavar="N")
+    p.add_argument("--write-ratio", type=float, default=0.1, metavar="F")
+    p.add_argument("--driver", choices=["inprocess", "socket"], default="inprocess")
+    p.add_argument("--server", choices=["simple", "threaded", "async"], default="threaded",
+        help="server for --driver socket")
+    p.add_argument("--threads", type=int, default=8, metavar="N",
+        help="server threads for --server threaded")
+    p.add_argument("--clients", type=int, default=8, metavar="N",
+        help="client threads for --driver socket")
+    p.add_argument("--storage", choices=["mem", "compact", "sqlite"], default="mem")
+    p.add_argument("--cache-mb", type=int, default=32, metavar="MB")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=load)
+    for p in sub.choices.values():
+        p.add_argument("--json", metavar="PATH",
+            help="also write the results here as JSON, - for stdout")
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    main()
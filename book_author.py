@@ -91,17 +91,138 @@ POST - (non-idempotent) add the relations specified in the JSON body to the
     keyed entity. Essentially the same as a PUT.
 
 
+URL: /bulk
+
+POST - load many entities in one request. The body is NDJSON
+    (content-type "application/x-ndjson"), one entity per line, authors
+    and books mixed freely, each with its relations in the same form as
+    the PUT body above:
+    {"name": "Plato", "dob": -424, "books": [{"title": "The Republic", "pubdate": -360}]}
+    {"title": "Envisioning Information", "pubdate": 1990, "authors": [{"name": "Edward R. Tufte", "dob": 1942}]}
+    The body is read and applied a batch of lines at a time, and the
+    response only counts what happened:
+    {"lines": 2, "created": 2, "updated": 0, "rejected": 0}
+    Lines that aren't a valid entity are counted as rejected and skipped.
+
+
+URL: /read
+
+POST - read many entities in one request. The body is a JSON list of
+    author and / or book keys, and the response lists each one, in the
+    same order, with its relations in the /bulk form; an entity that
+    doesn't exist gets null relations rather than failing the lot:
+    [{"title": "The Republic", "pubdate": -360}, {"name": "Nobody", "dob": 1900}]
+    returns:
+    [{"title": "The Republic", "pubdate": -360, "authors": [{"name": "Plato", "dob": -424}]},
+    {"name": "Nobody", "dob": 1900, "books": null}]
+
+
 URL: /query/entity/order_by_prolific
 
 GET - list the entities sorted by the number of relations each has.
+    Optional query parameters:
+    limit - at most this many entities
+    min_count - skip entities with fewer relations than this
+    cursor - opaque value from a previous page's Link rel="next" header,
+        continues right after that page
+    ie: GET /query/author_by_books?limit=20&min_count=2
+
+
+URL: /query/author_by_name, /query/book_by_title
+
+GET - list the entities whose name / title starts with the prefix query
+    parameter, in name order, from an index (default storage only).
+    limit and cursor page through them as above.
+    ie: GET /query/author_by_name?prefix=Edward
+
+URL: /query/author_by_dob, /query/book_by_pubdate
+
+GET - list the entities with a year from the from to the to query
+    parameter, both inclusive and either optional, in year then name
+    order, from an index (default storage only). limit and cursor page.
+    ie: GET /query/book_by_pubdate?from=1980&to=1995
+
+URL: /query/coauthors/name/dob, /query/related_books/title/pubdate
+
+GET - the other authors who share books with an author (or books that
+    share authors with a book), most shared first, with how many are
+    shared. limit caps the list (default 100).
+
+URL: /query/author_neighborhood/name/dob, /query/book_neighborhood/title/pubdate
+
+GET - everything within depth hops of an entity (default 2), nearest
+    first, each with its distance: books at 1 from an author, their other
+    authors at 2, and so on. At most limit of them (default 100).
+    ie: GET /query/author_neighborhood/Edward R. Tufte/1942?depth=3&limit=50
+
+
+URL: /dump
+
+GET - every author with its books, one /bulk line each (NDJSON), which is
+    the whole store. X-Changes-Latest is the /changes seq to follow on
+    from to keep the copy current (default storage only).
+
+URL: /changes
+
+GET - the writes made after the since query parameter, oldest first, each
+    numbered (seq) and in the /bulk line form for a put, or just the key
+    for a delete (default storage only):
+    GET /changes?since=41&limit=1000&wait=20
+    returns:
+    [{"seq": 42, "op": "put", "name": "Plato", "dob": -424, "books": [...]},
+    {"seq": 43, "op": "delete", "title": "Laws", "pubdate": -348}]
+    with the newest seq in X-Changes-Latest and the storage's epoch in
+    X-Changes-Epoch. wait holds the request up to that many seconds until
+    there is something to return. 410 Gone when the writes after since
+    are no longer kept, or when epoch is passed and no longer matches:
+    start over from a full read.
+
+URL: /metrics
+
+GET - counters and latency / size histograms of the requests served so
+    far, by route, method and status, plus response cache and storage
+    counts, in the Prometheus text exposition format (text/plain).
+
+
+GET responses carry a strong ETag (with the default storage), which changes
+whenever the entity's relations do, or for queries whenever anything does.
+Send it back in If-None-Match to get a 304 and no body if it still holds.
 
 """
 
 
-import wsgiref.util
-import cgi
+import wsgiref.simple_server
 import json
 import sys
+import urllib
+import urlparse
+import heapq
+import bisect
+import base64
+import itertools
+import struct
+import os
+import time
+import zlib
+import marshal
+import threading
+import mmap
+import array
+import sqlite3
+import Queue
+import socket
+import asyncore
+import asynchat
+import select
+import cStringIO
+import multiprocessing
+import multiprocessing.connection
+import collections
+import httplib
+import cProfile
+import pstats
+import random
+import weakref
 
 # ------------------------------------------------------------
 # ------------------------------------------------------------
@@ -109,91 +230,1358 @@ import sys
 # ------------------------------------------------------------
 # ------------------------------------------------------------
 
+class Route(object):
+    """
+    One URL pattern and what each method does there. Patterns are literal
+    segments then {parameters}, which are passed to the handler in order:
+        
+        Route("/author/{name}/{dob}", {"GET": "get_author"}, side="author")
+    
+    side is what versions (and caches) the GET: "author" or "book" for one
+    entity, "query" for anything that changes with the whole store, None
+    for nothing. POST / PUT bodies have to be body_type, and are read and
+    parsed for the handler unless read_body is False. A wsgi route's
+    handlers are WSGI applications, called as soon as they're routed to and
+    left to answer however they like. writes are the methods that change
+    the storage, which a read replica refuses: all but GET unless given.
+    """
+    
+    def __init__(self, pattern, methods, side=None, body_type="application/json",
+            read_body=True, wsgi=False, writes=None):
+        self.pattern = pattern
+        self.methods = methods
+        self.side = side
+        self.body_type = body_type
+        self.read_body = read_body
+        self.wsgi = wsgi
+        self.writes = writes
+        if writes is None:
+            self.writes = [m for m in methods if "GET" != m]
+        self.segments = pattern.strip('/').split('/')
+        self.literals = 0
+        while (self.literals < len(self.segments) and
+                not self.segments[self.literals].startswith('{')):
+            self.literals += 1
+        for segment in self.segments[self.literals:]:
+            if not segment.startswith('{'):
+                raise ValueError("literal after a parameter in %r" % pattern)
+
+
+class Router(object):
+    """
+    Routes compiled once into a dict, so finding one is a lookup on
+    (number of segments, first segment), plus the second segment where
+    several routes share the first, whatever the number of routes.
+    """
+    
+    def __init__(self, routes, target):
+        # handler names are looked up on target
+        self.table = {}
+        for route in routes:
+            bound = BoundRoute(route, target)
+            key = (len(route.segments), route.segments[0])
+            if route.literals > 1:
+                node = self.table.setdefault(key, {})
+                if not isinstance(node, dict) or route.segments[1] in node:
+                    raise ValueError("route %r is ambiguous" % route.pattern)
+                node[route.segments[1]] = bound
+            else:
+                if key in self.table:
+                    raise ValueError("route %r is ambiguous" % route.pattern)
+                self.table[key] = bound
+    
+    def match(self, path):
+        # (BoundRoute, [parameters]) or (None, None)
+        parts = [p for p in path.split('/') if p]
+        if not parts:
+            return (None, None)
+        node = self.table.get((len(parts), parts[0]))
+        if isinstance(node, dict):
+            node = node.get(parts[1])
+        if node is None:
+            return (None, None)
+        return (node, parts[node.literals:])
+
+
+class BoundRoute(object):
+    # a Route with its handlers resolved
+    
+    def __init__(self, route, target):
+        self.route = route
+        self.pattern = route.pattern
+        self.side = route.side
+        self.wsgi = route.wsgi
+        self.body_type = route.body_type
+        self.literals = route.literals
+        self.handlers = dict((method, getattr(target, name))
+            for method, name in route.methods.iteritems())
+        self.allow = ', '.join(sorted(self.handlers))
+        self.write_methods = frozenset(route.writes)
+        # what a read replica allows
+        self.read_allow = ', '.join(sorted(frozenset(self.handlers) - self.write_methods))
+        # methods that send a body for us to read
+        self.body_methods = frozenset()
+        if route.read_body:
+            self.body_methods = frozenset(["POST", "PUT"]) & frozenset(self.handlers)
+
+
+
 class BookAuthor(object):
     
-    def __init__(self):
-        self.storage = BookAuthorMemStorage()
+    routes = [
+        Route("/author/{name}/{dob}", {"GET": "get_author", "PUT": "put_author",
+            "POST": "put_author", "DELETE": "delete_author"}, side="author"),
+        Route("/book/{title}/{pubdate}", {"GET": "get_book", "PUT": "put_book",
+            "POST": "put_book", "DELETE": "delete_book"}, side="book"),
+        Route("/query/author_by_books", {"GET": "query_author_by_books"}, side="query"),
+        Route("/query/book_by_authors", {"GET": "query_book_by_authors"}, side="query"),
+        Route("/query/author_by_name", {"GET": "query_author_by_name"}, side="query"),
+        Route("/query/book_by_title", {"GET": "query_book_by_title"}, side="query"),
+        Route("/query/author_by_dob", {"GET": "query_author_by_dob"}, side="query"),
+        Route("/query/book_by_pubdate", {"GET": "query_book_by_pubdate"}, side="query"),
+        Route("/bulk", {"POST": "post_bulk"}, body_type="application/x-ndjson",
+            read_body=False),
+        Route("/query/coauthors/{name}/{dob}", {"GET": "query_coauthors"}, side="query"),
+        Route("/query/related_books/{title}/{pubdate}", {"GET": "query_related_books"},
+            side="query"),
+        Route("/query/author_neighborhood/{name}/{dob}", {"GET": "query_author_neighborhood"},
+            side="query"),
+        Route("/query/book_neighborhood/{title}/{pubdate}", {"GET": "query_book_neighborhood"},
+            side="query"),
+        Route("/read", {"POST": "post_read"}, writes=()),
+        Route("/dump", {"GET": "get_dump"}, wsgi=True),
+        Route("/changes", {"GET": "get_changes"}, wsgi=True),
+        Route("/metrics", {"GET": "get_metrics"}, wsgi=True),
+    ]
+    
+    def __init__(self, chunk_size=256, encodings=None, max_body=1 << 20,
+            bulk_batch=1000, storage=None, cache_bytes=1 << 25, metrics=True,
+            max_wait=0):
+        self.cache_bytes = cache_bytes
+        self.use_storage(storage or BookAuthorMemStorage())
+        # the Follower keeping storage a copy of a leader's, if this is a
+        # read replica: writes are refused, and reads too while it lags
+        self.replica = None
+        # POST / PUT bodies larger than this get a 413, as do /bulk lines
+        self.max_body = max_body
+        # /bulk applies this many lines per storage call
+        self.bulk_batch = bulk_batch
+        # GET responses are streamed, this many items per body chunk
+        self.chunk_size = chunk_size
+        # picked by Accept, the first one when the client doesn't care
+        self.encodings = encodings or ENCODINGS
+        # longest a GET /changes waits for a change. The wait holds a
+        # serving thread, so it's 0 (answer at once) unless the server has
+        # threads to spare, see main
+        self.max_wait = max_wait
+        # counts and timings of everything we answer, for GET /metrics
+        self.metrics = Metrics() if metrics else None
+        self.router = Router(self.routes, self)
+    
+    
+    def use_storage(self, storage):
+        # start (or start over) with storage. A Follower does this while
+        # requests are served, so everything is built first and each
+        # attribute only goes from one complete value to the next.
+        # Encoded GET responses are cached for storage that versions
+        # entities (to check entries against) and tells us about writes (to
+        # drop them)
+        cache = None
+        if self.cache_bytes and hasattr(storage, "listeners"):
+            cache = ResponseCache(self.cache_bytes)
+        self.cache = cache
+        if cache is not None:
+            storage.listeners.append(self.invalidate)
+        self.storage = storage
     
     
     def __call__(self, environ, start_response):
-        path = []
-        # shift_path_info is destructive, pass it a copy
-        pathenv = {'PATH_INFO': environ.get('PATH_INFO')}
-        p = wsgiref.util.shift_path_info(pathenv)
-        while p is not None:
-            path.append(p)
-            p = wsgiref.util.shift_path_info(pathenv)
-        
-        entity, idstr, date = None, None, None
-        if len(path) > 0:
-            entity = path[0]
-        if len(path) > 1:
-            idstr = path[1]
-        if len(path) > 2:
-            date = path[2]
+        route, params = self.router.match(environ.get('PATH_INFO') or '')
+        if self.metrics is None:
+            return self.respond(environ, start_response, route, params)
+        started = time.time()
+        statuses = []
+        def metered_start_response(status, headers, *exc_info):
+            statuses.append(status[:3])
+            return start_response(status, headers, *exc_info)
+        label = route.pattern if route is not None else ""
+        method = environ.get("REQUEST_METHOD")
+        try:
+            bytes_in = int(environ.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            bytes_in = 0
+        try:
+            result = self.respond(environ, metered_start_response, route, params)
+        except Exception:
+            self.metrics.observe(label, method, "500", time.time() - started,
+                bytes_in, 0)
+            raise
+        status = statuses[-1] if statuses else ""
+        if isinstance(result, list):
+            self.metrics.observe(label, method, status, time.time() - started,
+                bytes_in, sum(len(chunk) for chunk in result))
+            return result
+        return self.metrics.metered(result, label, method, status, started, bytes_in)
+    
+    def respond(self, environ, start_response, route, params):
+        req_method = environ.get("REQUEST_METHOD")
+        # the same ones throughout, whatever use_storage does meanwhile
+        storage = self.storage
+        cache = self.cache
+        handler = None
+        status = '200 OK'
+        if route is None:
+            status = '404 Not Found'
+        else:
+            handler = route.handlers.get(req_method)
+            if handler is None:
+                status = '405 Method Not Allowed'
+            elif route.wsgi:
+                return handler(environ, start_response)
+            elif self.replica is not None:
+                if req_method in route.write_methods:
+                    handler = None
+                    status = '405 Method Not Allowed'
+                elif self.replica.lag() > self.replica.max_lag:
+                    status = '503 Service Unavailable'
         
         c_type = environ.get("CONTENT_TYPE")
-        json_c_type = "application/json"
-        req_method = environ.get("REQUEST_METHOD")
-        form = None
-        if req_method in ["POST", "PUT"]:
-            form = cgi.FieldStorage(fp=environ['wsgi.input'], environ=environ)
         in_rels = []
-        if None != form and 0 < form.length and json_c_type == c_type:
-            in_rels = json.loads(form.value)
+        if handler is not None and req_method in route.body_methods:
+            try:
+                body = read_body(environ, self.max_body)
+                if body and route.body_type == media_type(c_type):
+                    in_rels = json.loads(body, object_hook=utf8_values)
+            except BodyTooLarge:
+                status = '413 Request Entity Too Large'
+            except ValueError:
+                status = '400 Bad Request'
         
-        status = '200 OK'
-        created, updated, deleted = False, False, False
         rels = []
-        entities = ['author', 'book']
+        stream = None
+        next_cursor = None
+        encoding = negotiate(environ.get("HTTP_ACCEPT"), self.encodings)
+        etag = None
+        cache_key = None
+        cached = None
+        if "GET" == req_method and handler is not None and encoding is not None:
+            # taken before reading, so a write in between only makes it stale
+            etag = self.etag(storage, route, params, encoding)
+            if (etag is not None and cache is not None and
+                    not etag_matches(environ.get("HTTP_IF_NONE_MATCH"), etag)):
+                cache_key = self.cache_key(route, params, environ, encoding)
+                cached = cache.get(cache_key, etag)
         
         # dispatch
-        if ((entity in entities and idstr != None and date != None) or
-                (entity == "query" and idstr != None)):
-            if "author" == entity:
-                if req_method in ["POST", "PUT"]:
-                    created, updated = self.storage.author_create(idstr, date, in_rels)
-                    rels = self.storage.author_read_items(idstr, date)
-                elif "GET" == req_method:
-                    rels = self.storage.author_read_items(idstr, date)
-                elif "DELETE" == req_method:
-                    rels = self.storage.author_read_items(idstr, date)
-                    deleted = self.storage.author_delete(idstr, date)
-            elif "book" == entity:
-                if req_method in ["POST", "PUT"]:
-                    created, updated = self.storage.book_create(idstr, date, in_rels)
-                    rels = self.storage.book_read_items(idstr, date)
-                elif "GET" == req_method:
-                    rels = self.storage.book_read_items(idstr, date)
-                elif "DELETE" == req_method:
-                    rels = self.storage.book_read_items(idstr, date)
-                    deleted = self.storage.book_delete(idstr, date)
-            elif "query" == entity:
-                if "GET" == req_method and "author_by_books" == idstr:
-                    rels = self.storage.author_by_books()
-                elif "GET" == req_method and "book_by_authors" == idstr:
-                    rels = self.storage.book_by_authors()
+        if encoding is None:
+            # nothing we could answer in, don't bother doing the work
+            status = '406 Not Acceptable'
+            encoding = self.encodings[0]
+        elif '200 OK' != status:
+            # no route, or body was refused
+            pass
+        elif etag is not None and etag_matches(environ.get("HTTP_IF_NONE_MATCH"), etag):
+            # the client has this already; nothing read, nothing encoded
+            start_response('304 Not Modified', [('ETag', etag), ('Vary', 'Accept')])
+            return []
+        elif cached is not None:
+            # encoded before and nothing has changed since
+            start_response('200 OK', cached[0])
+            return [cached[1]]
         else:
-            status  = '404 Not Found'
+            status, rels, stream, next_cursor = handler(storage, environ, in_rels, *params)
         
-        if 0 == len(rels):
-            status = '404 Not Found'
+        if stream is not None:
+            # peek, an empty stream is still a 404
+            stream = iter(stream)
+            for first in stream:
+                stream = itertools.chain([first], stream)
+                break
+            else:
+                stream = None
         
-        if created:
-            status = '201 Created'
+        if stream is None and 0 == len(rels) and '200 OK' == status:
+            status = '404 Not Found'
         
-        if c_type != None and json_c_type != c_type and req_method in ["POST", "PUT"]:
+        if (c_type != None and handler is not None and req_method in ["POST", "PUT"] and
+                route.body_type != media_type(c_type) and '413' != status[:3]):
             status = '406 Not Acceptable'
         
-        headers = [('Content-type', json_c_type)]
+        headers = [('Content-type', encoding.content_type), ('Vary', 'Accept')]
+        if handler is None and route is not None:
+            headers.append(('Allow', route.allow if self.replica is None else route.read_allow))
+        if next_cursor is not None:
+            headers.append(('Link', next_page_link(environ, next_cursor)))
+        if etag is not None and '200 OK' == status:
+            headers.append(('ETag', etag))
+        else:
+            cache_key = None
         start_response(status, headers)
-        r_str = json.dumps(
-            rels,
-            sort_keys=True,
-            indent=4
-        )
+        if stream is not None:
+            # wsgi: a generator is an iterable too
+            chunks = encoding.chunks(stream, self.chunk_size)
+            if cache_key is not None:
+                return cache.collect(cache_key, etag, headers, chunks)
+            return chunks
+        body = encoding.encode(rels)
+        if cache_key is not None:
+            cache.put(cache_key, etag, headers, body)
         # wsgi: return iterable
-        return [r_str]
+        return [body]
+    
+    
+    # handlers, see routes; each is given the storage respond took for the
+    # request, and returns (status, rels, stream, next_cursor) with either a
+    # list of rels or a stream of them
+    
+    def get_author(self, storage, environ, in_rels, name, dob):
+        return ('200 OK', [], storage.author_iter_items(name, dob), None)
+    
+    def put_author(self, storage, environ, in_rels, name, dob):
+        created, updated = storage.author_create(name, dob, in_rels)
+        rels = storage.author_read_items(name, dob)
+        return ('201 Created' if created else '200 OK', rels, None, None)
+    
+    def delete_author(self, storage, environ, in_rels, name, dob):
+        rels = storage.author_read_items(name, dob)
+        storage.author_delete(name, dob)
+        return ('200 OK', rels, None, None)
+    
+    def get_book(self, storage, environ, in_rels, title, pubdate):
+        return ('200 OK', [], storage.book_iter_items(title, pubdate), None)
+    
+    def put_book(self, storage, environ, in_rels, title, pubdate):
+        created, updated = storage.book_create(title, pubdate, in_rels)
+        rels = storage.book_read_items(title, pubdate)
+        return ('201 Created' if created else '200 OK', rels, None, None)
+    
+    def delete_book(self, storage, environ, in_rels, title, pubdate):
+        rels = storage.book_read_items(title, pubdate)
+        storage.book_delete(title, pubdate)
+        return ('200 OK', rels, None, None)
+    
+    def query_author_by_books(self, storage, environ, in_rels):
+        return self.query_ranked(environ, storage.author_by_books_iter,
+            storage.author_by_books_page)
+    
+    def query_book_by_authors(self, storage, environ, in_rels):
+        return self.query_ranked(environ, storage.book_by_authors_iter,
+            storage.book_by_authors_page)
+    
+    def query_ranked(self, environ, walk, page):
+        try:
+            limit, min_count, cursor = query_page_args(environ)
+            if limit is None and cursor is None:
+                # the whole ranking, no need to hold it all
+                return ('200 OK', [], walk(min_count), None)
+            rels, next_cursor = page(limit, min_count, cursor)
+            return ('200 OK', rels, None, next_cursor)
+        except CursorGone:
+            return ('410 Gone', [], None, None)
+        except ValueError:
+            return ('400 Bad Request', [], None, None)
+    
+    def query_author_by_name(self, storage, environ, in_rels):
+        return self.query_index(storage, environ, "author_by_name", query_prefix_args)
+    
+    def query_book_by_title(self, storage, environ, in_rels):
+        return self.query_index(storage, environ, "book_by_title", query_prefix_args)
+    
+    def query_author_by_dob(self, storage, environ, in_rels):
+        return self.query_index(storage, environ, "author_by_dob", query_range_args)
+    
+    def query_book_by_pubdate(self, storage, environ, in_rels):
+        return self.query_index(storage, environ, "book_by_pubdate", query_range_args)
+    
+    def query_index(self, storage, environ, name, parse_args):
+        # the storage's name_iter / name_page, for storage that has them
+        page = getattr(storage, name + "_page", None)
+        if page is None:
+            return ('501 Not Implemented', [], None, None)
+        try:
+            args = parse_args(environ)
+            limit, min_count, cursor = query_page_args(environ)
+            if limit is None and cursor is None:
+                return ('200 OK', [], getattr(storage, name + "_iter")(*args), None)
+            rels, next_cursor = page(*args, limit=limit, cursor=cursor)
+            return ('200 OK', rels, None, next_cursor)
+        except CursorGone:
+            return ('410 Gone', [], None, None)
+        except ValueError:
+            return ('400 Bad Request', [], None, None)
+    
+    def query_coauthors(self, storage, environ, in_rels, name, dob):
+        return self.query_traversal(storage, environ, "author_coauthors", name, dob)
+    
+    def query_related_books(self, storage, environ, in_rels, title, pubdate):
+        return self.query_traversal(storage, environ, "book_related", title, pubdate)
+    
+    def query_author_neighborhood(self, storage, environ, in_rels, name, dob):
+        return self.query_traversal(storage, environ, "author_neighborhood", name, dob)
+    
+    def query_book_neighborhood(self, storage, environ, in_rels, title, pubdate):
+        return self.query_traversal(storage, environ, "book_neighborhood", title, pubdate)
+    
+    def query_traversal(self, storage, environ, name, idstr, date):
+        # the storage's name(idstr, date, [depth,] limit=), if it has one
+        traverse = getattr(storage, name, None)
+        if traverse is None:
+            return ('501 Not Implemented', [], None, None)
+        try:
+            depth, limit = query_traversal_args(environ)
+            args = (idstr, date)
+            if name.endswith("_neighborhood"):
+                args += (depth,)
+            return ('200 OK', traverse(*args, limit=limit), None, None)
+        except ValueError:
+            return ('400 Bad Request', [], None, None)
+    
+    def post_bulk(self, storage, environ, in_rels):
+        # reads its own body, a batch at a time
+        if "application/x-ndjson" != media_type(environ.get("CONTENT_TYPE")):
+            return ('200 OK', [], None, None)
+        return ('200 OK', self.bulk_load(storage, environ), None, None)
+    
+    
+    def post_read(self, storage, environ, in_rels):
+        # many entities at once, in the order asked for
+        try:
+            keys = [parse_entity_key(d) for d in in_rels]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return ('400 Bad Request', [], None, None)
+        if not keys:
+            return ('400 Bad Request', [], None, None)
+        return ('200 OK', [], batch_items(keys, storage.read_many(keys)), None)
+    
+    def get_dump(self, environ, start_response):
+        # wsgi route: every author as a /bulk line, which is everything,
+        # to start a copy from; X-Changes-Latest is where to follow
+        # /changes from afterwards
+        storage = self.storage
+        dump = getattr(storage, "dump", None)
+        if dump is None:
+            start_response('501 Not Implemented', [('Content-type', 'text/plain')])
+            return ['501 Not Implemented\n']
+        version, rows = dump()
+        start_response('200 OK', [('Content-type', 'application/x-ndjson'),
+            ('X-Changes-Epoch', storage.epoch), ('X-Changes-Latest', str(version))])
+        return (''.join(json.dumps(row) + '\n' for row in chunk) for chunk in rows)
+    
+    def get_changes(self, environ, start_response):
+        # wsgi route: the change feed after ?since=, waiting up to ?wait=
+        # (at most max_wait) seconds for one if there are none yet
+        storage = self.storage
+        feed = getattr(storage, "changes", None)
+        encoding = negotiate(environ.get("HTTP_ACCEPT"), self.encodings)
+        status = None
+        try:
+            since, limit, wait = query_changes_args(environ)
+        except ValueError:
+            status = '400 Bad Request'
+        if feed is None:
+            status = '501 Not Implemented'
+        elif encoding is None:
+            status = '406 Not Acceptable'
+        elif status is None:
+            qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            try:
+                if qs.get('epoch', [storage.epoch])[-1] != storage.epoch:
+                    raise ChangesGone(since)
+                changes, latest = feed.since(since, limit, min(wait, self.max_wait))
+            except ChangesGone:
+                status = '410 Gone'
+        if status is not None:
+            start_response(status, [('Content-type', 'text/plain')])
+            return [status + '\n']
+        start_response('200 OK', [('Content-type', encoding.content_type),
+            ('Vary', 'Accept'), ('X-Changes-Epoch', storage.epoch),
+            ('X-Changes-Latest', str(latest)), ('X-Changes-Max-Wait', str(self.max_wait))])
+        return [encoding.encode([change_row(seq, record) for seq, record in changes])]
+    
+    def get_metrics(self, environ, start_response):
+        # wsgi route
+        storage = self.storage
+        if self.metrics is None:
+            start_response('404 Not Found', [('Content-type', 'text/plain')])
+            return ['metrics are off\n']
+        stats = None
+        if hasattr(storage, "stats"):
+            stats = storage.stats()
+        body = self.metrics.render(self.cache, stats, self.replica)
+        start_response('200 OK',
+            [('Content-type', 'text/plain; version=0.0.4; charset=utf-8')])
+        return [body]
+    
+    
+    def etag(self, storage, route, params, encoding):
+        # strong ETag for a GET, or None if the storage keeps no versions
+        if not hasattr(storage, "version") or route.side is None:
+            return None
+        try:
+            if "query" == route.side:
+                version = storage.version()
+            elif "author" == route.side:
+                version = storage.author_version(*params)
+            else:
+                version = storage.book_version(*params)
+        except ValueError:
+            return None
+        if version is None:
+            return None
+        return '"%s-%x-%s"' % (storage.epoch, version, encoding.tag)
+    
+    def cache_key(self, route, params, environ, encoding):
+        # (group, variant): an entity's representations share a group, as do
+        # all the queries, so a write can drop them together
+        if "query" == route.side:
+            return (("query", None),
+                (environ.get('PATH_INFO'), environ.get('QUERY_STRING', ''), encoding.tag))
+        return ((route.side, (str(params[0]), int(params[1]))), encoding.tag)
+    
+    def invalidate(self, side, key, opposite_keys):
+        # storage listener; whatever a write could have changed
+        opposite = "book" if "author" == side else "author"
+        self.cache.drop((side, key))
+        for k in opposite_keys:
+            self.cache.drop((opposite, k))
+        self.cache.drop(("query", None))
+    
+    
+    def bulk_load(self, storage, environ):
+        # apply an NDJSON body of entities a batch at a time
+        summary = {"lines": 0, "created": 0, "updated": 0, "rejected": 0}
+        batch = []
+        for line in iter_body_lines(environ, self.max_body):
+            summary["lines"] += 1
+            try:
+                batch.append(parse_entity_record(json.loads(line)))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                # line is None when it was too long
+                summary["rejected"] += 1
+                continue
+            if len(batch) >= self.bulk_batch:
+                self.bulk_apply(storage, batch, summary)
+                batch = []
+        self.bulk_apply(storage, batch, summary)
+        return summary
+    
+    
+    def bulk_apply(self, storage, batch, summary):
+        for created, updated in storage.bulk_create(batch):
+            if created:
+                summary["created"] += 1
+            elif updated:
+                summary["updated"] += 1
+
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+def media_type(c_type):
+    # "application/json; charset=utf-8" -> "application/json"
+    if c_type is None:
+        return None
+    return c_type.split(';', 1)[0].strip().lower()
+
+
+def read_body(environ, max_body):
+    # the request body as one str, never reading past CONTENT_LENGTH;
+    # BodyTooLarge before reading anything if it claims to be too big
+    stream = environ['wsgi.input']
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > max_body:
+        raise BodyTooLarge(length)
+    if length <= 0:
+        if not environ.get('wsgi.input_terminated'):
+            return ''
+        # no length, but the server gives us EOF; ask for one byte past
+        # the limit to know whether it was hit
+        length = max_body + 1
+    data = stream.read(length)
+    got = len(data)
+    if got < length and data:
+        # short read, fill a buffer sized once up front
+        buf = bytearray(length)
+        view = memoryview(buf)
+        view[:got] = data
+        while got < length:
+            data = stream.read(length - got)
+            if not data:
+                break
+            view[got:got + len(data)] = data
+            got += len(data)
+        data = view[:got].tobytes()
+    # else the whole body came in one read, nothing to copy
+    if got > max_body:
+        raise BodyTooLarge(got)
+    return data
+
+
+def iter_body_lines(environ, max_line, block_size=1 << 16):
+    # the request body a line at a time, read a block at a time; a line
+    # longer than max_line comes back as None and the rest of it is skipped
+    stream = environ['wsgi.input']
+    try:
+        remaining = int(environ.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        remaining = 0
+    if remaining <= 0:
+        if not environ.get('wsgi.input_terminated'):
+            return
+        remaining = sys.maxint
+    pending = ''
+    skipping = False
+    while remaining > 0:
+        block = stream.read(min(block_size, remaining))
+        if not block:
+            break
+        remaining -= len(block)
+        start = 0
+        while True:
+            end = block.find('\n', start)
+            if end < 0:
+                # carry the start of a line over to the next block
+                if not skipping:
+                    pending += block[start:]
+                    if len(pending) > max_line:
+                        pending = ''
+                        skipping = True
+                        yield None
+                break
+            if skipping:
+                skipping = False
+            else:
+                line = pending + block[start:end] if pending else block[start:end]
+                pending = ''
+                if len(line) > max_line:
+                    yield None
+                elif line.strip():
+                    yield line
+            start = end + 1
+    if pending.strip():
+        yield pending
+
+
+def utf8_str(x):
+    # a name or title from json.loads as the UTF-8 byte string the path
+    # routes store it as
+    if isinstance(x, unicode):
+        return x.encode('utf-8')
+    return str(x)
+
+
+def utf8_values(d):
+    # json.loads object_hook, so names and titles in request bodies match
+    # the ones in paths
+    return dict((k, v.encode('utf-8') if isinstance(v, unicode) else v)
+        for k, v in d.iteritems())
+
+
+def parse_entity_record(d):
+    # one /bulk line -> ("author" | "book", idstr, date, [(idstr, date)])
+    if "books" in d:
+        side, rels = "author", [(utf8_str(r['title']), int(r['pubdate'])) for r in d['books']]
+        key = (utf8_str(d['name']), int(d['dob']))
+    else:
+        side, rels = "book", [(utf8_str(r['name']), int(r['dob'])) for r in d['authors']]
+        key = (utf8_str(d['title']), int(d['pubdate']))
+    if not rels:
+        raise ValueError("no relations")
+    return (side, key[0], key[1], rels)
+
+
+def parse_entity_key(d):
+    # one /read key -> ("author" | "book", (idstr, date))
+    if "name" in d:
+        return ("author", (utf8_str(d['name']), int(d['dob'])))
+    return ("book", (utf8_str(d['title']), int(d['pubdate'])))
+
+
+def batch_items(keys, found):
+    # /read response items, each key with its relations or null if missing
+    for (side, key), rels in itertools.izip(keys, found):
+        if "author" == side:
+            yield {"name": key[0], "dob": key[1], "books": rels and
+                [{"title": r[0], "pubdate": r[1]} for r in rels]}
+        else:
+            yield {"title": key[0], "pubdate": key[1], "authors": rels and
+                [{"name": r[0], "dob": r[1]} for r in rels]}
+
+
+def query_page_args(environ):
+    # limit, min_count, cursor from the query string; ValueError if bad
+    qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    limit, min_count, cursor = None, 1, None
+    if 'limit' in qs:
+        limit = int(qs['limit'][-1])
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    if 'min_count' in qs:
+        min_count = int(qs['min_count'][-1])
+    if 'cursor' in qs:
+        cursor = qs['cursor'][-1]
+    return (limit, min_count, cursor)
+
+
+def query_prefix_args(environ):
+    # (prefix,) for the name indexes, all of them if none given
+    qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    return (qs.get('prefix', [''])[-1],)
+
+
+def query_range_args(environ):
+    # (from, to) years for the date indexes, inclusive, None if left open
+    qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    return tuple(int(qs[k][-1]) if k in qs else None for k in ('from', 'to'))
+
+
+def query_traversal_args(environ):
+    # depth (default 2) and limit (default 100) for traversals
+    qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    depth = int(qs.get('depth', [2])[-1])
+    limit = int(qs.get('limit', [100])[-1])
+    if depth < 1 or limit < 1:
+        raise ValueError("depth and limit must be positive")
+    return (depth, limit)
+
+
+def query_changes_args(environ):
+    # since (required), limit (default 1000) and wait seconds (default 0)
+    # for the change feed
+    qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    since = int(qs['since'][-1]) if 'since' in qs else None
+    limit = int(qs.get('limit', [1000])[-1])
+    wait = float(qs.get('wait', [0])[-1])
+    if since is None or since < 0 or limit < 1 or not 0 <= wait < float('inf'):
+        raise ValueError("bad since, limit or wait")
+    return (since, limit, wait)
+
+
+def change_row(seq, record):
+    # a ChangeFeed record as a response item: a put in the /bulk line form,
+    # or a delete of just the key
+    op, side, idstr, date, rels = record
+    if "d" == op:
+        row = entity_row(side, (idstr, date))
+        row["op"] = "delete"
+    else:
+        row = bulk_row(side, (idstr, date), rels)
+        row["op"] = "put"
+    row["seq"] = seq
+    return row
+
+
+def change_record(row):
+    # change_row's row back into the ChangeFeed record
+    if "delete" == row["op"]:
+        side, key = parse_entity_key(row)
+        return ("d", side, key[0], key[1], [])
+    return ("c",) + parse_entity_record(row)
+
+
+def bulk_row(side, key, rels):
+    # an entity in the /bulk line form
+    row = entity_row(side, key)
+    opposite = "book" if "author" == side else "author"
+    row[opposite + "s"] = [entity_row(opposite, r) for r in rels]
+    return row
+
+
+class ResponseCache(object):
+    """
+    Encoded responses, least recently used first out once they add up to
+    more than max_bytes. Entries are grouped so everything cached for one
+    entity can be dropped at once, and each remembers the ETag it was made
+    for: a lookup with any other ETag is a miss, so an entry that raced
+    with a write is never served.
+    """
+    
+    def __init__(self, max_bytes, max_entry=None):
+        self.max_bytes = max_bytes
+        # bigger responses are streamed and not kept
+        self.max_entry = max_entry or max_bytes // 8
+        self.lock = threading.Lock()
+        # (group, variant) -> (etag, headers, body), oldest first
+        self.entries = collections.OrderedDict()
+        self.groups = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def get(self, key, etag):
+        # (headers, body) or None
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] != etag:
+                if entry is not None:
+                    self._forget(key, entry)
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1:]
+    
+    def put(self, key, etag, headers, body):
+        if len(body) > self.max_entry:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self._forget(key, old)
+            self.entries[key] = (etag, list(headers), body)
+            self.groups.setdefault(key[0], set()).add(key)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._forget(oldest, self.entries.pop(oldest))
+                self.evictions += 1
+    
+    def collect(self, key, etag, headers, chunks):
+        # pass chunks through, keeping a copy to put if they all fit
+        kept = []
+        size = 0
+        for chunk in chunks:
+            if kept is not None:
+                size += len(chunk)
+                if size <= self.max_entry:
+                    kept.append(chunk)
+                else:
+                    kept = None
+            yield chunk
+        if kept is not None:
+            self.put(key, etag, headers, ''.join(kept))
+    
+    def drop(self, group):
+        with self.lock:
+            for key in self.groups.pop(group, ()):
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= len(entry[2])
+    
+    def _forget(self, key, entry):
+        # entry was just popped from entries
+        self.size -= len(entry[2])
+        keys = self.groups.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.groups[key[0]]
+
+
+class Metrics(object):
+    """
+    Request counts by route, method and status, and histograms of how long
+    each took and how many bytes came in and went out, rendered with
+    whatever else is passed to render() in the Prometheus text format.
+    
+    observe() is a bisect and a few dict updates under one lock. A streamed
+    response is observed when its last chunk has gone, so its latency is
+    the whole response rather than the time to first byte.
+    """
+    
+    # upper bounds, seconds and bytes
+    latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    size_buckets = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+    # anything else is counted as "other", clients pick the method
+    methods = frozenset(["GET", "HEAD", "PUT", "POST", "DELETE"])
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (route, method, status) -> count
+        self.requests = collections.defaultdict(int)
+        # (route, method) -> [count per bucket (not cumulative), +Inf, sum]
+        self.latency = {}
+        self.request_bytes = {}
+        self.response_bytes = {}
+    
+    def observe(self, route, method, status, seconds, bytes_in, bytes_out):
+        if method not in self.methods:
+            method = "other"
+        key = (route, method)
+        with self.lock:
+            self.requests[(route, method, status)] += 1
+            observe_histogram(self.latency, key, self.latency_buckets, seconds)
+            observe_histogram(self.request_bytes, key, self.size_buckets, bytes_in)
+            observe_histogram(self.response_bytes, key, self.size_buckets, bytes_out)
+    
+    def metered(self, chunks, route, method, status, started, bytes_in):
+        # pass a streamed body through, observing it once it's done (or the
+        # server gives up on it and closes us)
+        bytes_out = 0
+        try:
+            for chunk in chunks:
+                bytes_out += len(chunk)
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            self.observe(route, method, status, time.time() - started,
+                bytes_in, bytes_out)
+    
+    def render(self, cache=None, stats=None, replica=None):
+        # the text exposition format, version 0.0.4
+        out = []
+        with self.lock:
+            requests = sorted(self.requests.items())
+            histograms = [(name, help, sorted((k, list(v)) for k, v in h.items()), bounds)
+                for name, help, h, bounds in [
+                    ("bookauthor_http_request_duration_seconds",
+                        "Time to handle a request, body included.",
+                        self.latency, self.latency_buckets),
+                    ("bookauthor_http_request_size_bytes",
+                        "Request body sizes.", self.request_bytes, self.size_buckets),
+                    ("bookauthor_http_response_size_bytes",
+                        "Response body sizes.", self.response_bytes, self.size_buckets)]]
+        metric_head(out, "bookauthor_http_requests_total", "counter",
+            "Requests by route, method and status.")
+        for (route, method, status), n in requests:
+            out.append('bookauthor_http_requests_total{%s} %d' % (metric_labels(
+                route=route, method=method, status=status), n))
+        for name, help, rows, bounds in histograms:
+            metric_head(out, name, "histogram", help)
+            for (route, method), counts in rows:
+                total = 0
+                for bound, n in zip(bounds + (float('inf'),), counts):
+                    total += n
+                    out.append('%s_bucket{%s} %d' % (name, metric_labels(
+                        route=route, method=method, le=metric_number(bound)), total))
+                labels = metric_labels(route=route, method=method)
+                out.append('%s_sum{%s} %s' % (name, labels, metric_number(counts[-1])))
+                out.append('%s_count{%s} %d' % (name, labels, total))
+        if cache is not None:
+            for name, kind, help, value in [
+                    ("hits_total", "counter", "Responses served from the cache.", cache.hits),
+                    ("misses_total", "counter", "Cacheable GETs that had to be encoded.",
+                        cache.misses),
+                    ("evictions_total", "counter", "Entries dropped to make room.",
+                        cache.evictions),
+                    ("entries", "gauge", "Responses held.", len(cache)),
+                    ("size_bytes", "gauge", "Bytes of responses held.", cache.size)]:
+                metric_head(out, "bookauthor_cache_" + name, kind, help)
+                out.append('bookauthor_cache_%s %d' % (name, value))
+        if stats is not None:
+            metric_head(out, "bookauthor_storage_entities", "gauge",
+                "Authors and books stored.")
+            for side in ("author", "book"):
+                out.append('bookauthor_storage_entities{%s} %d' % (
+                    metric_labels(side=side), stats[side + "s"]))
+            metric_head(out, "bookauthor_storage_relations", "gauge",
+                "Author-book links stored.")
+            out.append('bookauthor_storage_relations %d' % stats["relations"])
+            metric_head(out, "bookauthor_storage_writes_total", "counter",
+                "Entity creates and deletes, by what they did.")
+            for (op, side, result), n in sorted(stats["writes"].items()):
+                out.append('bookauthor_storage_writes_total{%s} %d' % (
+                    metric_labels(op=op, side=side, result=result), n))
+        if replica is not None:
+            for name, kind, help, value in [
+                    ("lag_seconds", "gauge",
+                        "Time since the replica last knew it had all the leader's writes.",
+                        replica.lag()),
+                    ("seq", "gauge", "Last leader write applied.", replica.seq),
+                    ("leader_seq", "gauge", "Last leader write heard of.", replica.latest),
+                    ("bootstraps_total", "counter", "Full copies taken from the leader.",
+                        replica.bootstraps)]:
+                metric_head(out, "bookauthor_replication_" + name, kind, help)
+                out.append('bookauthor_replication_%s %s' % (name, metric_number(value)))
+        out.append('')
+        return '\n'.join(out)
+
+
+def observe_histogram(histograms, key, bounds, value):
+    # histograms[key] is [count per bucket ..., +Inf, sum]
+    h = histograms.get(key)
+    if h is None:
+        h = histograms[key] = [0] * (len(bounds) + 1) + [0]
+    h[bisect.bisect_left(bounds, value)] += 1
+    h[-1] += value
+
+
+def metric_head(out, name, kind, help):
+    out.append('# HELP %s %s' % (name, help))
+    out.append('# TYPE %s %s' % (name, kind))
+
+
+def metric_labels(**labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')) for k, v in sorted(labels.items()))
+
+
+def metric_number(x):
+    if float('inf') == x:
+        return '+Inf'
+    return repr(x)
+
+
+class ProfilingMiddleware(object):
+    """
+    Wraps an application (a BookAuthor, for its routes) and runs cProfile
+    over a random fraction of requests, and over any request that carries
+    the header, if one is given. Profiles are added up per route, and the
+    admin path serves them:
+        
+        GET    /admin/profile                      routes, requests, seconds
+        GET    /admin/profile?route=/bulk          pstats file for one route
+        GET    /admin/profile?route=/bulk&format=text&sort=tottime
+        DELETE /admin/profile                      start over
+    
+    A pstats file loads with pstats.Stats(path). A profiled request's
+    response is read whole inside the profile, so encoding a stream is
+    counted too. Unsampled requests cost a comparison or two.
+    """
+    
+    def __init__(self, app, fraction=0.0, header=None, path="/admin/profile"):
+        self.app = app
+        self.fraction = fraction
+        # environ key for the header, ie "X-Profile" -> HTTP_X_PROFILE
+        self.header = None
+        if header:
+            self.header = "HTTP_" + header.upper().replace('-', '_')
+        self.path = path
+        self.lock = threading.Lock()
+        # route pattern -> [requests, pstats.Stats]
+        self.stats = {}
+    
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == self.path:
+            return self.admin(environ, start_response)
+        if not ((self.header is not None and environ.get(self.header)) or
+                (self.fraction and random.random() < self.fraction)):
+            return self.app(environ, start_response)
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            result = self.app(environ, start_response)
+            try:
+                body = list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            profile.disable()
+            self.add(self.route(environ), profile)
+        return body
+    
+    def route(self, environ):
+        # what to file a profile under, as Metrics does
+        router = getattr(self.app, 'router', None)
+        if router is None:
+            return environ.get('PATH_INFO', '')
+        route, params = router.match(environ.get('PATH_INFO') or '')
+        return route.pattern if route is not None else ""
+    
+    def add(self, route, profile):
+        with self.lock:
+            entry = self.stats.get(route)
+            if entry is None:
+                self.stats[route] = [1, pstats.Stats(profile)]
+            else:
+                entry[0] += 1
+                entry[1].add(profile)
+    
+    def admin(self, environ, start_response):
+        method = environ.get('REQUEST_METHOD')
+        if "DELETE" == method:
+            with self.lock:
+                self.stats = {}
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            return ['profiles dropped\n']
+        if "GET" != method:
+            start_response('405 Method Not Allowed',
+                [('Content-type', 'text/plain'), ('Allow', 'DELETE, GET')])
+            return ['']
+        qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        if 'route' not in qs:
+            with self.lock:
+                rows = sorted((entry[1].total_tt, route, entry[0])
+                    for route, entry in self.stats.iteritems())
+            out = ['%10.6f %8d %s\n' % (seconds, n, route or '(no route)')
+                for seconds, route, n in reversed(rows)]
+            start_response('200 OK', [('Content-type', 'text/plain')])
+            return ['   seconds requests route\n'] + out
+        route = qs['route'][-1]
+        with self.lock:
+            entry = self.stats.get(route)
+            if entry is None:
+                start_response('404 Not Found', [('Content-type', 'text/plain')])
+                return ['nothing profiled for that route\n']
+            if 'text' != qs.get('format', [''])[-1]:
+                # what Stats.dump_stats writes
+                start_response('200 OK', [('Content-type', 'application/octet-stream'),
+                    ('Content-Disposition', 'attachment; filename="profile.pstats"')])
+                return [marshal.dumps(entry[1].stats)]
+            out = cStringIO.StringIO()
+            try:
+                entry[1].stream = out
+                entry[1].sort_stats(qs.get('sort', ['cumulative'])[-1])
+                entry[1].print_stats(int(qs.get('limit', ['40'])[-1]))
+            except (KeyError, ValueError):
+                start_response('400 Bad Request', [('Content-type', 'text/plain')])
+                return ['bad sort or limit\n']
+            finally:
+                entry[1].stream = sys.stdout
+        start_response('200 OK', [('Content-type', 'text/plain')])
+        return [out.getvalue()]
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match compares weakly, so a W/ prefix doesn't matter
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag or '*' == tag:
+            return True
+    return False
+
+
+def next_page_link(environ, cursor):
+    # same query, continued after the page just served
+    qs = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    qs['cursor'] = [cursor]
+    url = urllib.quote(environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''))
+    url += '?' + urllib.urlencode(sorted(qs.items()), True)
+    return '<%s>; rel="next"' % url
+
+
+
+# ------------------------------------------------------------
+# ------------------------------------------------------------
+# Encodings
+# ------------------------------------------------------------
+# ------------------------------------------------------------
+
+"""
+Nearly every response body is a list of flat dicts. An encoding turns one into
+bytes, either all at once (encode) or as a generator of chunks of about
+chunk_size items each (chunks). Encoders are built once and shared across
+requests; BookAuthor picks one per request from the Accept header.
+
+application/json - compact, no key sorting. Ask for
+    "application/json; indent=4" to get the old sorted and indented output.
+application/x-ndjson - one compact JSON value per line
+application/cbor - RFC 8949 CBOR, streamed as an indefinite-length array
+"""
+
+
+class JSONEncoding(object):
+    content_type = "application/json"
+    
+    def __init__(self, indent=None, sort_keys=False):
+        if indent:
+            self.encoder = json.JSONEncoder(indent=indent, sort_keys=sort_keys)
+        else:
+            self.encoder = json.JSONEncoder(separators=(',', ':'), sort_keys=sort_keys)
+        self.indent = indent
+        # for ETags, which differ by representation
+        self.tag = "json-pretty" if indent else "json"
+        self.pretty = self if indent else JSONEncoding(4, True)
+    
+    def for_params(self, params):
+        # media type parameters from Accept may ask for a variant; indent=4
+        # is the only one there is
+        if '4' == params.get('indent'):
+            return self.pretty
+        return self
+    
+    def encode(self, items):
+        return self.encoder.encode(items)
+    
+    def chunks(self, items, chunk_size):
+        # a JSON array, encoded and sent an element at a time
+        encode = self.encoder.encode
+        if self.indent:
+            pad = '\n' + ' ' * self.indent
+            enc = encode
+            encode = lambda item: enc(item).replace('\n', pad)
+            # the encoder's own separator, so streamed is byte for byte encode()
+            open_sep, sep, close = pad, self.encoder.item_separator + pad, '\n]'
+        else:
+            open_sep, sep, close = '', self.encoder.item_separator, ']'
+        chunk = ['[']
+        s = open_sep
+        for item in items:
+            chunk.append(s)
+            chunk.append(encode(item))
+            s = sep
+            if len(chunk) >= 2 * chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append(close if s is sep else ']')
+        yield ''.join(chunk)
+
+
+class NDJSONEncoding(object):
+    content_type = "application/x-ndjson"
+    tag = "ndjson"
+    
+    def __init__(self):
+        self.encoder = json.JSONEncoder(separators=(',', ':'))
+    
+    def for_params(self, params):
+        return self
+    
+    def encode(self, items):
+        if isinstance(items, dict):
+            # a lone summary object, not a list
+            return self.encoder.encode(items) + '\n'
+        return ''.join(self.chunks(items, len(items) or 1))
+    
+    def chunks(self, items, chunk_size):
+        encode = self.encoder.encode
+        chunk = []
+        for item in items:
+            chunk.append(encode(item))
+            chunk.append('\n')
+            if len(chunk) >= 2 * chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        if chunk:
+            yield ''.join(chunk)
+
+
+class CBOREncoding(object):
+    content_type = "application/cbor"
+    tag = "cbor"
+    
+    def for_params(self, params):
+        return self
+    
+    def encode(self, items):
+        return cbor_dumps(items)
+    
+    def chunks(self, items, chunk_size):
+        # indefinite-length array, 0x9f item ... 0xff
+        chunk = ['\x9f']
+        for item in items:
+            cbor_append(item, chunk)
+            if len(chunk) >= 4 * chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        chunk.append('\xff')
+        yield ''.join(chunk)
+
+
+def cbor_dumps(obj):
+    out = []
+    cbor_append(obj, out)
+    return ''.join(out)
+
+
+def cbor_head(major, n):
+    # major type in the top 3 bits, argument n in the smallest form
+    major <<= 5
+    if n < 24:
+        return chr(major | n)
+    if n < 0x100:
+        return struct.pack('>BB', major | 24, n)
+    if n < 0x10000:
+        return struct.pack('>BH', major | 25, n)
+    if n < 0x100000000:
+        return struct.pack('>BI', major | 26, n)
+    return struct.pack('>BQ', major | 27, n)
+
+
+def cbor_append(obj, out):
+    # only what our payloads hold: dicts, lists, strings, numbers
+    if obj is True:
+        out.append('\xf5')
+    elif obj is False:
+        out.append('\xf4')
+    elif obj is None:
+        out.append('\xf6')
+    elif isinstance(obj, (int, long)):
+        if obj >= 0:
+            out.append(cbor_head(0, obj))
+        else:
+            out.append(cbor_head(1, -1 - obj))
+    elif isinstance(obj, basestring):
+        if isinstance(obj, unicode):
+            obj = obj.encode('utf-8')
+        out.append(cbor_head(3, len(obj)))
+        out.append(obj)
+    elif isinstance(obj, dict):
+        out.append(cbor_head(5, len(obj)))
+        for k, v in obj.iteritems():
+            cbor_append(k, out)
+            cbor_append(v, out)
+    elif isinstance(obj, (list, tuple)):
+        out.append(cbor_head(4, len(obj)))
+        for v in obj:
+            cbor_append(v, out)
+    elif isinstance(obj, float):
+        out.append(struct.pack('>Bd', 0xfb, obj))
+    else:
+        raise TypeError("can't CBOR encode %r" % (obj,))
+
+
+ENCODINGS = [JSONEncoding(), NDJSONEncoding(), CBOREncoding()]
+
+
+def parse_accept(accept):
+    # [(q, index, media_type, params)] best first, ties in header order;
+    # refusals (q=0) come last
+    a = []
+    for i, part in enumerate(accept.split(',')):
+        fields = part.split(';')
+        media_type = fields[0].strip().lower()
+        if not media_type:
+            continue
+        params = {}
+        for f in fields[1:]:
+            k, _, v = f.partition('=')
+            params[k.strip().lower()] = v.strip().strip('"')
+        try:
+            q = float(params.pop('q', 1))
+        except ValueError:
+            q = 0
+        a.append((-max(q, 0), i, media_type, params))
+    a.sort()
+    return a
+
+
+def media_range_match(media_type, content_type):
+    # how specifically a media range covers content_type: 3 exactly, 2 as
+    # type/*, 1 as */*, 0 not at all
+    if media_type == content_type:
+        return 3
+    if media_type.endswith('/*') and content_type.startswith(media_type[:-1]):
+        return 2
+    if media_type == '*/*':
+        return 1
+    return 0
+
+
+def negotiate(accept, encodings):
+    # encoding to answer with, None if nothing acceptable is on offer. A
+    # refusal outranks any less specific range, so "application/json;q=0,
+    # */*;q=0.1" never gets JSON
+    if not accept:
+        return encodings[0]
+    ranges = parse_accept(accept)
+    refused = [media_type for q, i, media_type, params in ranges if 0 == q]
+    for q, i, media_type, params in ranges:
+        if 0 == q:
+            break
+        for e in encodings:
+            match = media_range_match(media_type, e.content_type)
+            if match and not any(media_range_match(r, e.content_type) > match
+                    for r in refused):
+                return e.for_params(params)
+    return None
 
 
 
@@ -204,7 +1592,8 @@ class BookAuthor(object):
 # ------------------------------------------------------------
 
 
-def entity_create(idstr, date, additional_rels, entities, entities_opposite):
+def entity_create(idstr, date, additional_rels, entities, entities_opposite,
+        ranks=None, ranks_opposite=None, indexes=(), indexes_opposite=()):
     # a = entities.get((str(idstr), int(date)), set())
     # have to use non-idiomatic code to track if created for HTTP status
     id_key = (str(idstr), int(date))
@@ -222,9 +1611,19 @@ def entity_create(idstr, date, additional_rels, entities, entities_opposite):
             id_rels.add(opposite_id_key)
             updated = True
             # add linkback to the opposite entity
-            inverse_rels = entities_opposite.get(opposite_id_key, set())
+            inverse_rels = entities_opposite.get(opposite_id_key)
+            if inverse_rels is None:
+                inverse_rels = set()
+                for index in indexes_opposite:
+                    index.add(opposite_id_key)
             inverse_rels.add(id_key)
             entities_opposite[opposite_id_key] = inverse_rels
+            if ranks is not None:
+                ranks.incr(id_key)
+                ranks_opposite.incr(opposite_id_key)
+    if created:
+        for index in indexes:
+            index.add(id_key)
     entities[id_key] = id_rels
     return (created, updated)
 
@@ -233,7 +1632,8 @@ def entity_read(idstr, date, entities):
     return entities.get((str(idstr), int(date)), set())
 
 
-def entity_delete(idstr, date, entities, entities_opposite):
+def entity_delete(idstr, date, entities, entities_opposite,
+        ranks=None, ranks_opposite=None, indexes=(), indexes_opposite=()):
     # a = entities.get((str(idstr), int(date)), set())
     # have to use non-idiomatic code to track if created for HTTP status
     id_key = (str(idstr), int(date))
@@ -248,85 +1648,2967 @@ def entity_delete(idstr, date, entities, entities_opposite):
             inverse_rels.discard(id_key)
             if 0 == len(inverse_rels):
                 del entities_opposite[opposite_id]
+                for index in indexes_opposite:
+                    index.remove(opposite_id)
             else:
                 entities_opposite[opposite_id] = inverse_rels
+            if ranks_opposite is not None:
+                ranks_opposite.decr(opposite_id)
     
+    if ranks is not None:
+        ranks.remove(id_key)
+    for index in indexes:
+        index.remove(id_key)
     del entities[id_key]
     return True
 
 
-def entity_by_rels(entities):
-    a = map(lambda x: (x, len(entities[x])), entities.iterkeys())
-    ent_cmp = lambda a,b: cmp(a[1], b[1])
-    a.sort(ent_cmp)
-    a.reverse()
-    return a
+def entity_by_rels(entities, ranks=None):
+    return entity_page_by_rels(entities, ranks)[0]
 
 
+def entity_page_by_rels(entities, ranks=None, limit=None, min_count=1, after=None):
+    # returns ([(key, count), ...], position of the last one or None)
+    # after is a position from a previous page of the same ranks; without
+    # ranks, entities are ranked first
+    if limit is None:
+        limit = sys.maxint
+    if ranks is None:
+        ranks = ranks_for(entities)
+    a = []
+    position = None
+    for key, count, stamp in ranks.walk(min_count, after):
+        if len(a) == limit:
+            return (a, position)
+        a.append((key, count))
+        position = (count, stamp)
+    return (a, None)
 
-class BookAuthorMemStorage(object):
-    def __init__(self):
-        self.books = {}
-        self.authors = {}
-    
-    def author_create(self, author, dob, bookset):
-        rels = []
-        for d in bookset:
-            rels.append( (d['title'], d['pubdate']) )
-        return entity_create(author, dob, rels, self.authors, self.books)
-    
-    def book_create(self, title, pubdate, authorset):
-        rels = []
-        for d in authorset:
-            rels.append( (d['name'], d['dob']) )
-        return entity_create(title, pubdate, rels, self.books, self.authors)
-    
-    
-    def author_read(self, author, dob):
-        return entity_read(author, dob, self.authors)
-    
-    def book_read(self, title, pubdate):
-        return entity_read(title, pubdate, self.books)
-    
-    def author_read_items(self, author, dob):
-        s = entity_read(author, dob, self.authors)
-        # unpack set of tuples
-        a = []
-        for i in s:
+
+def entity_related(key, entities, entities_opposite, limit=None):
+    # [(key, shared)] for the others on key's side that share relations
+    # with it, most shared first
+    counts = collections.defaultdict(int)
+    for r in entities.get(key, ()):
+        for k in entities_opposite.get(r, ()):
+            counts[k] += 1
+    counts.pop(key, None)
+    return rank_related(counts.iteritems(), limit)
+
+
+def rank_related(found, limit=None):
+    # (key, shared) by shared descending, then key
+    rank = lambda e: (-e[1], e[0])
+    if limit is None:
+        return sorted(found, key=rank)
+    return heapq.nsmallest(limit, found, key=rank)
+
+
+def entity_neighborhood(key, entities, entities_opposite, depth, limit=None):
+    # [(distance, key)] breadth first from key, at most depth hops and
+    # limit keys, nearest first; odd distances are on the opposite side
+    if key not in entities:
+        return []
+    if limit is None:
+        limit = sys.maxint
+    adjacent = (entities, entities_opposite)
+    seen = (set([key]), set())
+    frontier = [key]
+    found = []
+    for distance in xrange(1, depth + 1):
+        here, visited = adjacent[(distance - 1) % 2], seen[distance % 2]
+        next_frontier = []
+        for k in frontier:
+            for r in here.get(k, ()):
+                if r not in visited:
+                    visited.add(r)
+                    next_frontier.append(r)
+                    found.append((distance, r))
+                    if len(found) == limit:
+                        return found
+        frontier = next_frontier
+    return found
+
+
+def neighborhood_rows(side, found, row):
+    # rows for entity_neighborhood's (distance, key), row(side, key) each
+    opposite = "book" if "author" == side else "author"
+    return [dict(row(opposite if distance % 2 else side, key), distance=distance)
+        for distance, key in found]
+
+
+def entity_row(side, key):
+    if "author" == side:
+        return {"name": key[0], "dob": key[1]}
+    return {"title": key[0], "pubdate": key[1]}
+
+
+class CursorGone(Exception):
+    pass
+
+
+def encode_cursor(epoch, position):
+    # the storage's epoch goes along, positions mean nothing to any other
+    return base64.urlsafe_b64encode(json.dumps([epoch, position], separators=(',', ':')))
+
+
+def decode_cursor(cursor, epoch):
+    # ValueError for anything we didn't hand out, CursorGone for a cursor
+    # from another storage, or from this one before a restart
+    if cursor is None:
+        return None
+    try:
+        wrapped = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, UnicodeError):
+        raise ValueError("bad cursor")
+    if not isinstance(wrapped, list) or len(wrapped) != 2:
+        raise ValueError("bad cursor")
+    cursor_epoch, position = wrapped
+    if (not isinstance(position, list) or len(position) != 2 or
+            not isinstance(position[0], (int, long))):
+        raise ValueError("bad cursor")
+    if cursor_epoch != epoch:
+        raise CursorGone(cursor_epoch)
+    return position
+
+
+
+def ranks_for(entities):
+    # EntityRanks for an existing dict of entities
+    ranks = EntityRanks()
+    if hasattr(entities, 'itercounts'):
+        counts = entities.itercounts()
+    else:
+        counts = ((k, len(rels)) for k, rels in entities.iteritems())
+    for key, count in counts:
+        ranks.add(key, count)
+    return ranks
+
+
+
+def relation_count(entities):
+    # links from one side, each is also one from the other side
+    if hasattr(entities, 'itercounts'):
+        return sum(count for key, count in entities.itercounts())
+    return sum(len(rels) for rels in entities.itervalues())
+
+
+class EntityRanks(object):
+    """
+    Entity keys ordered by relation count, kept up to date one relation at
+    a time so the prolific queries never have to sort.
+    
+    buckets maps a count to an append-only list of (stamp, key). Moving a
+    key to another count appends a fresh stamp there and leaves the old
+    entry behind; an entry is live only while stamps[key] still matches it.
+    Stale entries are swept out once they make up half of a bucket, so
+    incr / decr / remove are amortized O(1).
+    
+    Ties are ordered by when the key reached its count, earliest first.
+    """
+    
+    def __init__(self):
+        self.counts = {}
+        self.stamps = {}
+        self.buckets = {}
+        self.stale = {}
+        self.next_stamp = 0
+        self.max_count = 0
+    
+    def __len__(self):
+        return len(self.counts)
+    
+    def __iter__(self):
+        # yields (key, count), most relations first
+        for key, count, stamp in self.walk():
+            yield (key, count)
+    
+    def count(self, key):
+        return self.counts.get(key, 0)
+    
+    def add(self, key, count):
+        # a key not ranked yet, straight in at count
+        self._move(key, count)
+    
+    def walk(self, min_count=1, after=None):
+        # yields (key, count, stamp), most relations first, stopping below
+        # min_count; after = (count, stamp) resumes just past that entry
+        # without revisiting anything ranked above it
+        stamps = self.stamps
+        top = self.max_count
+        start = 0
+        if after is not None:
+            a_count, a_stamp = after
+            if not isinstance(a_stamp, (int, long)):
+                raise ValueError("bad position")
+            if a_count <= top:
+                top = a_count
+                bucket = self.buckets.get(top)
+                if bucket is not None:
+                    start = bisect.bisect_left(bucket, (a_stamp + 1,))
+        for count in xrange(top, max(min_count, 1) - 1, -1):
+            bucket = self.buckets.get(count)
+            if bucket is None:
+                start = 0
+                continue
+            for i in xrange(start, len(bucket)):
+                stamp, key = bucket[i]
+                if stamps.get(key) == stamp:
+                    yield (key, count, stamp)
+            start = 0
+    
+    def incr(self, key):
+        # the hot path, so _move inlined for a count going up by one
+        counts = self.counts
+        old = counts.get(key, 0)
+        count = old + 1
+        stamp = self.next_stamp
+        self.next_stamp = stamp + 1
+        counts[key] = count
+        self.stamps[key] = stamp
+        bucket = self.buckets.get(count)
+        if bucket is None:
+            bucket = self.buckets[count] = []
+            if count > self.max_count:
+                self.max_count = count
+        bucket.append((stamp, key))
+        if old:
+            self._retire(old)
+    
+    def decr(self, key):
+        self._move(key, self.counts.get(key, 0) - 1)
+    
+    def remove(self, key):
+        self._move(key, 0)
+    
+    def _move(self, key, count):
+        old = self.counts.get(key, 0)
+        if count > 0:
+            stamp = self.next_stamp
+            self.next_stamp += 1
+            self.counts[key] = count
+            self.stamps[key] = stamp
+            bucket = self.buckets.get(count)
+            if bucket is None:
+                bucket = self.buckets[count] = []
+            bucket.append((stamp, key))
+            if count > self.max_count:
+                self.max_count = count
+        elif old > 0:
+            del self.counts[key]
+            del self.stamps[key]
+        if old > 0:
+            self._retire(old)
+    
+    def _retire(self, count):
+        # one entry in buckets[count] just went stale
+        bucket = self.buckets[count]
+        stale = self.stale.get(count, 0) + 1
+        if stale == len(bucket):
+            del self.buckets[count]
+            self.stale.pop(count, None)
+            while self.max_count > 0 and self.max_count not in self.buckets:
+                self.max_count -= 1
+        elif stale * 2 > len(bucket):
+            # build a new list rather than filtering in place, a walk may
+            # still be holding on to the old one
+            stamps = self.stamps
+            self.buckets[count] = [e for e in bucket if stamps.get(e[1]) == e[0]]
+            self.stale.pop(count, None)
+        else:
+            self.stale[count] = stale
+
+class SortedIndex(object):
+    """
+    Entity keys in order of by(key), for prefix and range lookups. Kept as
+    a list of short sorted lists, with the last entry of each in maxes, so
+    adding or removing a key shifts at most a couple of thousand entries
+    rather than the whole index. walk() bisects to its starting point and
+    goes on from there: O(log n + k) for k entries.
+    """
+    
+    load = 1000
+    
+    def __init__(self, by, keys=()):
+        # by(key) is the entry stored and ordered on, and its own inverse
+        self.by = by
+        entries = sorted(by(key) for key in keys)
+        self.lists = [entries[i:i + self.load] for i in xrange(0, len(entries), self.load)]
+        self.maxes = [entries[-1] for entries in self.lists]
+    
+    def __len__(self):
+        return sum(len(entries) for entries in self.lists)
+    
+    def add(self, key):
+        entry = self.by(key)
+        if not self.lists:
+            self.lists.append([entry])
+            self.maxes.append(entry)
+            return
+        i = bisect.bisect_left(self.maxes, entry)
+        if i == len(self.maxes):
+            i -= 1
+            self.lists[i].append(entry)
+            self.maxes[i] = entry
+        else:
+            bisect.insort(self.lists[i], entry)
+        entries = self.lists[i]
+        if len(entries) > 2 * self.load:
+            self.lists.insert(i + 1, entries[self.load:])
+            del entries[self.load:]
+            self.maxes.insert(i, entries[-1])
+    
+    def remove(self, key):
+        entry = self.by(key)
+        i = bisect.bisect_left(self.maxes, entry)
+        if i == len(self.maxes):
+            return
+        entries = self.lists[i]
+        j = bisect.bisect_left(entries, entry)
+        if j == len(entries) or entries[j] != entry:
+            return
+        del entries[j]
+        if entries:
+            self.maxes[i] = entries[-1]
+        else:
+            del self.lists[i]
+            del self.maxes[i]
+    
+    def walk(self, start, after=False):
+        # entries from start on, or from just past it if after
+        find = bisect.bisect_right if after else bisect.bisect_left
+        i = find(self.maxes, start)
+        if i == len(self.maxes):
+            return
+        j = find(self.lists[i], start)
+        for entries in itertools.islice(self.lists, i, None):
+            for entry in itertools.islice(entries, j, None):
+                yield entry
+            j = 0
+
+
+def by_name(key):
+    return key
+
+
+def by_date(key):
+    return (key[1], key[0])
+
+
+def indexes_for(entities):
+    # name and date SortedIndexes for an existing dict of entities
+    keys = list(entities.iterkeys())
+    return (SortedIndex(by_name, keys), SortedIndex(by_date, keys))
+
+
+
+# ------------------------------------------------------------
+# Persistence
+# ------------------------------------------------------------
+
+"""
+A MutationLog is an append-only file of the storage's effective writes,
+so a restart can rebuild the in-memory dicts without replaying HTTP.
+
+Each record is
+    uint32 length, uint32 crc32 of the payload  (little endian)
+    payload: marshal of (op, side, idstr, date, [(idstr, date), ...])
+        op "c" adds the relations (entity_create), "d" drops the entity
+Replaying a log on top of the state it produced gives the same state,
+which is what lets snapshots and logs overlap safely.
+
+fsync is batched (group commit): the file is synced once sync_every
+records have piled up, or, with sync_interval, at least that often in
+seconds from a background thread. sync_every=1 syncs every write; larger
+batches trade the last few acknowledged writes on a crash for throughput.
+A torn or corrupt tail (a crash mid-write) is cut off at the last good
+record when the log is replayed.
+"""
+
+LOG_HEADER = struct.Struct('<II')
+
+
+class MutationLog(object):
+    
+    def __init__(self, path, sync_every=1, sync_interval=None):
+        self.path = path
+        self.sync_every = max(1, sync_every)
+        self.sync_interval = sync_interval
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.f = open(path, 'ab')
+        if sync_interval:
+            t = threading.Thread(target=self._sync_loop)
+            t.daemon = True
+            t.start()
+    
+    def replay(self):
+        # yields every intact record, then truncates anything after them
+        good = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(LOG_HEADER.size)
+                if len(header) < LOG_HEADER.size:
+                    break
+                length, crc = LOG_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                try:
+                    record = marshal.loads(payload)
+                except (ValueError, EOFError, TypeError):
+                    break
+                good = f.tell()
+                yield record
+        with self.lock:
+            self.f.flush()
+            if os.path.getsize(self.path) > good:
+                self.f.truncate(good)
+                self.f.seek(0, os.SEEK_END)
+    
+    def append(self, record):
+        payload = marshal.dumps(record)
+        data = LOG_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self.lock:
+            self.f.write(data)
+            self.pending += 1
+            if self.pending >= self.sync_every:
+                self._sync()
+    
+    def sync(self):
+        with self.lock:
+            self._sync()
+    
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+    
+    def _sync_loop(self):
+        while not self.f.closed:
+            time.sleep(self.sync_interval)
+            with self.lock:
+                if self.pending and not self.f.closed:
+                    self._sync()
+    
+    def reset(self):
+        # everything so far is in a snapshot now, start over empty
+        with self.lock:
+            self.f.truncate(0)
+            self._sync()
+    
+    def close(self):
+        with self.lock:
+            if not self.f.closed:
+                self._sync()
+                self.f.close()
+
+
+
+"""
+A ChangeFeed keeps the storage's last few effective writes, each numbered
+with the storage version it made (so one more than the write before), in
+a ring: write seq lives in slot seq % size until size more writes
+overwrite it. Records are the same as the MutationLog's, so a consumer can
+apply() them to a storage of its own. Reading what came after a seq is an
+index into the ring, and a reader can wait for the next write. Asking for
+writes the ring no longer holds, or for writes from another run of the
+storage (its epoch changed), raises ChangesGone: start over from a full
+copy.
+"""
+
+class ChangesGone(Exception):
+    pass
+
+
+class ChangeFeed(object):
+    
+    def __init__(self, size=10000):
+        self.size = size
+        self.ring = [None] * size
+        # seq of the newest change, 0 for none yet
+        self.seq = 0
+        self.cond = threading.Condition()
+    
+    def append(self, seq, record):
+        with self.cond:
+            self.ring[seq % self.size] = record
+            self.seq = seq
+            self.cond.notify_all()
+    
+    def since(self, seq, limit=None, wait=None):
+        # ([(seq, record)] after seq, oldest first, newest seq); waits up to
+        # wait seconds for something if there's nothing yet
+        with self.cond:
+            if wait and seq == self.seq:
+                deadline = time.time() + wait
+                while seq == self.seq and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+            latest = self.seq
+            if seq > latest or seq < latest - self.size:
+                raise ChangesGone(seq)
+            end = latest if limit is None else min(latest, seq + limit)
+            ring, size = self.ring, self.size
+            return ([(s, ring[s % size]) for s in xrange(seq + 1, end + 1)], latest)
+
+
+
+"""
+A snapshot is the whole storage in one file, laid out so it can be
+mmap'd and read in place:
+    
+    header   SNAP_HEADER: magic, string / author / book counts, section offsets
+    strings  (n_strings + 1) uint32 offsets, then the bytes; every idstr
+             once, sorted, so a string's id is its rank
+    authors  n_authors SNAP_ENTITY records sorted by (string id, date):
+             string id, date, start and length of its adjacency run
+    books    same for books
+    adjacency, authors then books: int32 row numbers into the other table
+
+Finding an entity is two binary searches, and reading its relations only
+touches the pages it lives on, so a freshly started server can answer
+reads right away. write_snapshot writes to a temporary file and renames
+it over the old one.
+"""
+
+SNAP_MAGIC = 'BASNAP01'
+SNAP_HEADER = struct.Struct('<8sIII5Q')
+SNAP_ENTITY = struct.Struct('<iiII')
+SNAP_OFFSET = struct.Struct('<II')
+
+
+def write_snapshot(path, authors, books):
+    strings = set(k[0] for k in authors.iterkeys())
+    strings.update(k[0] for k in books.iterkeys())
+    strings = sorted(strings)
+    string_id = dict((x, i) for i, x in enumerate(strings))
+    a_keys = sorted(authors.iterkeys())
+    b_keys = sorted(books.iterkeys())
+    a_row = dict((k, i) for i, k in enumerate(a_keys))
+    b_row = dict((k, i) for i, k in enumerate(b_keys))
+    
+    # string table
+    str_offsets = array.array('I', [0])
+    pos = 0
+    for x in strings:
+        pos += len(x)
+        str_offsets.append(pos)
+    if pos >= 1 << 32:
+        raise ValueError("string table too large for a snapshot")
+    
+    def side(keys, entities, opposite_row):
+        table = []
+        adj = array.array('i')
+        for k in keys:
+            rels = entities.get(k)
+            table.append(SNAP_ENTITY.pack(string_id[k[0]], k[1], len(adj), len(rels)))
+            adj.extend(opposite_row[r] for r in rels)
+        return (''.join(table), adj)
+    
+    a_table, a_adj = side(a_keys, authors, b_row)
+    b_table, b_adj = side(b_keys, books, a_row)
+    
+    off_strdata = SNAP_HEADER.size + str_offsets.itemsize * len(str_offsets)
+    off_authors = off_strdata + pos
+    off_authors += -off_authors % 4
+    off_books = off_authors + len(a_table)
+    off_a_adj = off_books + len(b_table)
+    off_b_adj = off_a_adj + a_adj.itemsize * len(a_adj)
+    
+    if sys.byteorder != 'little':
+        for a in (str_offsets, a_adj, b_adj):
+            a.byteswap()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(SNAP_HEADER.pack(SNAP_MAGIC, len(strings), len(a_keys), len(b_keys),
+            off_strdata, off_authors, off_books, off_a_adj, off_b_adj))
+        str_offsets.tofile(f)
+        for x in strings:
+            f.write(x)
+        f.write('\0' * (off_authors - off_strdata - pos))
+        f.write(a_table)
+        f.write(b_table)
+        a_adj.tofile(f)
+        b_adj.tofile(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class Snapshot(object):
+    # read-only view of a snapshot file, nothing is loaded up front
+    
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.n_strings, n_authors, n_books, self.off_strdata,
+            off_authors, off_books, off_a_adj, off_b_adj) = SNAP_HEADER.unpack_from(self.mm)
+        if magic != SNAP_MAGIC:
+            raise ValueError("%s is not a snapshot" % path)
+        self.sides = {
+            "author": (off_authors, n_authors, off_a_adj, "book"),
+            "book": (off_books, n_books, off_b_adj, "author"),
+        }
+    
+    def count(self, side):
+        return self.sides[side][1]
+    
+    def string(self, i):
+        a, b = SNAP_OFFSET.unpack_from(self.mm, SNAP_HEADER.size + 4 * i)
+        return self.mm[self.off_strdata + a:self.off_strdata + b]
+    
+    def string_id(self, x):
+        lo, hi = 0, self.n_strings
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string(mid) < x:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_strings and self.string(lo) == x:
+            return lo
+        return -1
+    
+    def entity(self, side, row):
+        # (string id, date, adjacency start, relation count)
+        return SNAP_ENTITY.unpack_from(self.mm, self.sides[side][0] + SNAP_ENTITY.size * row)
+    
+    def key(self, side, row):
+        e = self.entity(side, row)
+        return (self.string(e[0]), e[1])
+    
+    def find(self, side, key):
+        # row of key, -1 if it isn't there
+        sid = self.string_id(key[0])
+        if sid < 0:
+            return -1
+        target = (sid, key[1])
+        lo, hi = 0, self.sides[side][1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entity(side, mid)[:2] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.sides[side][1] and self.entity(side, lo)[:2] == target:
+            return lo
+        return -1
+    
+    def rels(self, side, row):
+        off_table, n, off_adj, opposite = self.sides[side]
+        sid, date, start, length = self.entity(side, row)
+        rows = struct.unpack_from('<%di' % length, self.mm, off_adj + 4 * start)
+        return set(self.key(opposite, r) for r in rows)
+    
+    def read(self, side, key):
+        # set of relations, None if the snapshot doesn't have key
+        row = self.find(side, key)
+        if row < 0:
+            return None
+        return self.rels(side, row)
+    
+    def itercounts(self, side):
+        # (key, relation count) in table order
+        for row in xrange(self.sides[side][1]):
+            sid, date, start, length = self.entity(side, row)
+            yield ((self.string(sid), date), length)
+
+
+class SnapshotEntities(object):
+    """
+    One side's entity dict, layered over a Snapshot. Lookups fall through
+    to the mapped file; an entry is copied into the live dict only when
+    something is about to change it. consumed holds the snapshot keys whose
+    snapshot entry no longer counts, because they are live or deleted.
+    
+    Supports the subset of dict that the entity_* functions use.
+    """
+    
+    def __init__(self, snapshot, side):
+        self.snapshot = snapshot
+        self.side = side
+        self.live = {}
+        self.consumed = set()
+    
+    def _base(self, key):
+        if key in self.consumed:
+            return None
+        return self.snapshot.read(self.side, key)
+    
+    def __len__(self):
+        return len(self.live) + self.snapshot.count(self.side) - len(self.consumed)
+    
+    def __contains__(self, key):
+        return key in self.live or self._base(key) is not None
+    
+    has_key = __contains__
+    
+    def get(self, key, default=None):
+        rels = self.live.get(key)
+        if rels is None:
+            rels = self._base(key)
+        if rels is None:
+            return default
+        return rels
+    
+    def __getitem__(self, key):
+        rels = self.live.get(key)
+        if rels is None:
+            rels = self._base(key)
+            if rels is None:
+                raise KeyError(key)
+            # about to be changed in place, make it live
+            self.consumed.add(key)
+            self.live[key] = rels
+        return rels
+    
+    def __setitem__(self, key, rels):
+        if key not in self.live and key not in self.consumed:
+            if self.snapshot.find(self.side, key) >= 0:
+                self.consumed.add(key)
+        self.live[key] = rels
+    
+    def __delitem__(self, key):
+        if key in self.live:
+            del self.live[key]
+            if key not in self.consumed and self.snapshot.find(self.side, key) >= 0:
+                self.consumed.add(key)
+        elif self._base(key) is not None:
+            self.consumed.add(key)
+        else:
+            raise KeyError(key)
+    
+    def iterkeys(self):
+        for key in self.live:
+            yield key
+        for key, count in self.snapshot.itercounts(self.side):
+            if key not in self.consumed:
+                yield key
+    
+    __iter__ = iterkeys
+    
+    def iteritems(self):
+        for item in self.live.iteritems():
+            yield item
+        for row in xrange(self.snapshot.count(self.side)):
+            key = self.snapshot.key(self.side, row)
+            if key not in self.consumed:
+                yield (key, self.snapshot.rels(self.side, row))
+    
+    def itercounts(self):
+        for key, rels in self.live.iteritems():
+            yield (key, len(rels))
+        for key, count in self.snapshot.itercounts(self.side):
+            if key not in self.consumed:
+                yield (key, count)
+    
+    def keys(self):
+        return list(self.iterkeys())
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def values(self):
+        return [rels for key, rels in self.iteritems()]
+
+
+
+class ReadWriteLock(object):
+    """
+    Any number of readers, or one writer. A waiting writer holds off new
+    readers so a steady stream of GETs can't starve it. Not reentrant:
+    storage methods take it once, at the public entry point.
+    """
+    
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        self.read_lock = _LockContext(self.acquire_read, self.release_read)
+        self.write_lock = _LockContext(self.acquire_write, self.release_write)
+    
+    def acquire_read(self):
+        with self.cond:
+            while self.writer or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+    
+    def release_read(self):
+        with self.cond:
+            self.readers -= 1
+            if 0 == self.readers:
+                self.cond.notify_all()
+    
+    def acquire_write(self):
+        with self.cond:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+    
+    def release_write(self):
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+    
+    def reading(self):
+        return self.read_lock
+    
+    def writing(self):
+        return self.write_lock
+
+
+class _LockContext(object):
+    # with-statement adapter, one per lock mode and shared by all threads
+    
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+    
+    def __enter__(self):
+        self.acquire()
+    
+    def __exit__(self, *exc):
+        self.release()
+
+
+
+def entity_key_rows(side, keys):
+    return [entity_row(side, k) for k in keys]
+
+
+def walk_in_chunks(lock, walk, row, min_count, chunk_size=256):
+    # row(key, count) for walk(min_count, after), holding lock only while a
+    # chunk is read; later chunks resume from the last position, so they
+    # see writes made in between
+    after = None
+    while True:
+        with lock.reading():
+            chunk = []
+            for key, count, stamp in itertools.islice(walk(min_count, after), chunk_size):
+                chunk.append(row(key, count))
+                after = (count, stamp)
+        for r in chunk:
+            yield r
+        if len(chunk) < chunk_size:
+            return
+
+
+class ReadView(object):
+    """
+    A BookAuthorMemStorage as of one version, for streams that go on
+    reading while writes carry on. Nothing is copied up front: while a view
+    is open, each write first saves what it is about to change into
+    before, once per key, so a key reads as before's copy where there is
+    one and as the live dicts where there isn't.
+    
+    before maps side -> {key: (relations, (-count, stamp))} as of version;
+    relations is None for a key that didn't exist then, and the ranking
+    position None for one that wasn't ranked.
+    """
+    
+    def __init__(self, version):
+        self.version = version
+        self.before = {"author": {}, "book": {}}
+
+
+def walk_view(lock, live, before, position, chunk_size=256):
+    # (position, key) in position order as a ReadView sees it: live(after)
+    # walks the current state from just past after, skipping keys written
+    # since the view opened, and position(key, before[key]) puts those back
+    # where they were, or None to leave one out. lock is only held while a
+    # chunk is read
+    after = None
+    while True:
+        with lock.reading():
+            chunk = []
+            for p, key in live(after):
+                if key not in before:
+                    chunk.append((p, key))
+                    if len(chunk) == chunk_size:
+                        break
+            more = len(chunk) == chunk_size
+            for key, value in before.iteritems():
+                p = position(key, value)
+                if p is not None and (after is None or p > after):
+                    chunk.append((p, key))
+        chunk.sort()
+        for p, key in itertools.islice(chunk, chunk_size):
+            yield (p, key)
+        if not more and len(chunk) <= chunk_size:
+            return
+        after = chunk[chunk_size - 1][0]
+
+
+
+class BookAuthorMemStorage(object):
+    def __init__(self, log=None, snapshot=None, snapshot_every=None, changes=10000):
+        if snapshot_every and snapshot is None:
+            raise ValueError("snapshot_every needs a snapshot path")
+        # guards everything below, see ReadWriteLock
+        self.lock = ReadWriteLock()
+        self.books = {}
+        self.authors = {}
+        self.book_ranks = EntityRanks()
+        self.author_ranks = EntityRanks()
+        # (by name, by date) SortedIndexes for each side
+        self.indexes = {"author": indexes_for({}), "book": indexes_for({})}
+        # bumped by every effective write; an entity's version is the
+        # global one as of its last change (0 if none since we started), and
+        # the epoch tells this process's versions from any other's
+        self.epoch = os.urandom(4).encode('hex')
+        self.global_version = 0
+        self.versions = {"author": {}, "book": {}}
+        # listener(side, key, opposite keys) after each effective write,
+        # with the write lock held
+        self.listeners = []
+        # the last changes effective writes, numbered by global_version
+        self.changes = ChangeFeed(changes) if changes else None
+        # open ReadViews, for writes to save what they change into; a view
+        # nobody holds any more drops out by itself
+        self.views = weakref.WeakSet()
+        # streams hold the read lock for this many entries at a time
+        self.chunk_size = 256
+        # for stats(): (op, side, result) -> count, and the number of
+        # author-book links, counted on first use after a snapshot load
+        self.writes = collections.defaultdict(int)
+        self.relations = 0
+        # optional snapshot file path; if it exists we start from it and
+        # build the rankings only once a query needs them
+        self.snapshot_path = snapshot
+        if snapshot is not None and os.path.exists(snapshot):
+            base = Snapshot(snapshot)
+            self.books = SnapshotEntities(base, "book")
+            self.authors = SnapshotEntities(base, "author")
+            self.book_ranks = None
+            self.author_ranks = None
+            self.indexes = None
+            self.relations = None
+        self.snapshot_every = None
+        self.writes_since_snapshot = 0
+        # optional MutationLog; whatever it already holds is loaded first
+        self.log = None
+        if log is not None:
+            for record in log.replay():
+                self.apply(record)
+        self.log = log
+        # ... and the snapshot is rewritten every snapshot_every writes
+        self.snapshot_every = snapshot_every
+    
+    def author_create(self, author, dob, bookset):
+        rels = []
+        for d in bookset:
+            rels.append( (d['title'], d['pubdate']) )
+        with self.lock.writing():
+            return self._create("author", author, dob, rels)
+    
+    def book_create(self, title, pubdate, authorset):
+        rels = []
+        for d in authorset:
+            rels.append( (d['name'], d['dob']) )
+        with self.lock.writing():
+            return self._create("book", title, pubdate, rels)
+    
+    
+    def bulk_create(self, records):
+        # [(side, idstr, date, rels)] from parse_entity_record, returns
+        # [(created, updated)] in the same order
+        a = []
+        with self.lock.writing():
+            for side, idstr, date, rels in records:
+                a.append(self._create(side, idstr, date, rels))
+        return a
+    
+    
+    def _create(self, side, idstr, date, rels):
+        # callers hold the write lock
+        id_key = (str(idstr), int(date))
+        if self.views:
+            self._preserve(side, [id_key], [(str(r[0]), int(r[1])) for r in rels])
+        indexes, indexes_opposite = self._indexes(side)
+        if "author" == side:
+            entities = self.authors
+            before = len(entities.get(id_key, ()))
+            result = entity_create(idstr, date, rels, self.authors, self.books,
+                self.author_ranks, self.book_ranks, indexes, indexes_opposite)
+        else:
+            entities = self.books
+            before = len(entities.get(id_key, ()))
+            result = entity_create(idstr, date, rels, self.books, self.authors,
+                self.book_ranks, self.author_ranks, indexes, indexes_opposite)
+        self.writes[("create", side,
+            "created" if result[0] else "updated" if result[1] else "unchanged")] += 1
+        if result[1]:
+            if self.relations is not None:
+                self.relations += len(entities[id_key]) - before
+            self._touch(side, (str(idstr), int(date)), rels)
+            # logged once applied, but before the caller hears about it
+            self._record(("c", side, str(idstr), int(date),
+                [(str(r[0]), int(r[1])) for r in rels]))
+            self._wrote()
+        return result
+    
+    def _delete(self, side, idstr, date):
+        id_key = (str(idstr), int(date))
+        if self.views:
+            self._preserve(side, [id_key],
+                (self.authors if "author" == side else self.books).get(id_key, ()))
+        indexes, indexes_opposite = self._indexes(side)
+        if "author" == side:
+            rels = self.authors.get(id_key)
+            deleted = entity_delete(idstr, date, self.authors, self.books,
+                self.author_ranks, self.book_ranks, indexes, indexes_opposite)
+        else:
+            rels = self.books.get(id_key)
+            deleted = entity_delete(idstr, date, self.books, self.authors,
+                self.book_ranks, self.author_ranks, indexes, indexes_opposite)
+        self.writes[("delete", side, "deleted" if deleted else "missing")] += 1
+        if deleted:
+            if self.relations is not None:
+                self.relations -= len(rels)
+            self._touch(side, id_key, rels, deleted)
+            self._record(("d", side, str(idstr), int(date), []))
+            self._wrote()
+        return deleted
+    
+    def _preserve(self, side, keys, opposite_keys):
+        # callers hold the write lock; before keys on side and opposite_keys
+        # on the other side change, each open view keeps how they were
+        for view in self.views:
+            self._keep(view, side, keys)
+            self._keep(view, "book" if "author" == side else "author", opposite_keys)
+    
+    def _keep(self, view, side, keys):
+        if "author" == side:
+            entities, ranks = self.authors, self.author_ranks
+        else:
+            entities, ranks = self.books, self.book_ranks
+        before = view.before[side]
+        for key in keys:
+            if key in before:
+                continue
+            rels = entities.get(key)
+            position = None
+            if ranks is not None and key in ranks.stamps:
+                position = (-ranks.counts[key], ranks.stamps[key])
+            before[key] = (None if rels is None else set(rels), position)
+    
+    def _view(self):
+        # a ReadView as of now, which writes keep up until _close_view
+        with self.lock.reading():
+            view = ReadView(self.global_version)
+            self.views.add(view)
+        return view
+    
+    def _close_view(self, view):
+        # under the lock, so no write is going through views meanwhile
+        with self.lock.reading():
+            self.views.discard(view)
+    
+    def _indexes(self, side):
+        # (side's indexes, opposite side's), empty until they're built
+        if self.indexes is None:
+            return ((), ())
+        opposite = "book" if "author" == side else "author"
+        return (self.indexes[side], self.indexes[opposite])
+    
+    def _touch(self, side, id_key, rels, deleted=False):
+        # new versions for an entity and the opposites it was (un)linked to
+        self.global_version += 1
+        version = self.global_version
+        if "author" == side:
+            versions, versions_opposite = self.versions["author"], self.versions["book"]
+            opposite = self.books
+        else:
+            versions, versions_opposite = self.versions["book"], self.versions["author"]
+            opposite = self.authors
+        if deleted:
+            versions.pop(id_key, None)
+        else:
+            versions[id_key] = version
+        keys = [(str(r[0]), int(r[1])) for r in rels]
+        for key in keys:
+            if key in opposite:
+                versions_opposite[key] = version
+            else:
+                versions_opposite.pop(key, None)
+        for listener in self.listeners:
+            listener(side, id_key, keys)
+    
+    def _record(self, record):
+        # a MutationLog record for the write _touch just numbered
+        if self.log is not None:
+            self.log.append(record)
+        if self.changes is not None:
+            self.changes.append(self.global_version, record)
+    
+    def _wrote(self):
+        # after every effective write
+        self.writes_since_snapshot += 1
+        if self.snapshot_every and self.writes_since_snapshot >= self.snapshot_every:
+            self._snapshot()
+    
+    def snapshot(self, path=None):
+        with self.lock.writing():
+            self._snapshot(path)
+    
+    def _snapshot(self, path=None):
+        # write everything out, after which the log only needs what follows
+        write_snapshot(path or self.snapshot_path, self.authors, self.books)
+        self.writes_since_snapshot = 0
+        if self.log is not None:
+            self.log.reset()
+    
+    def stats(self):
+        # sizes and write counts for /metrics
+        if self.relations is None:
+            with self.lock.writing():
+                if self.relations is None:
+                    self.relations = relation_count(self.authors)
+        with self.lock.reading():
+            return {"authors": len(self.authors), "books": len(self.books),
+                "relations": self.relations, "writes": dict(self.writes)}
+    
+    def _ranked(self):
+        # rankings for a storage loaded from a snapshot are built on first
+        # use; call before taking the read lock
+        if self.author_ranks is None:
+            with self.lock.writing():
+                if self.author_ranks is None:
+                    self.book_ranks = ranks_for(self.books)
+                    self.author_ranks = ranks_for(self.authors)
+    
+    def _indexed(self):
+        # and the same for the indexes
+        if self.indexes is None:
+            with self.lock.writing():
+                if self.indexes is None:
+                    self.indexes = {"author": indexes_for(self.authors),
+                        "book": indexes_for(self.books)}
+    
+    def apply(self, record):
+        # replay one MutationLog record, not logged again
+        op, side, idstr, date, rels = record
+        with self.lock.writing():
+            if "c" == op:
+                return self._create(side, idstr, date, rels)
+            return self._delete(side, idstr, date)
+    
+    
+    def author_read(self, author, dob):
+        # a copy, the stored set may change under the caller
+        with self.lock.reading():
+            return set(entity_read(author, dob, self.authors))
+    
+    def book_read(self, title, pubdate):
+        with self.lock.reading():
+            return set(entity_read(title, pubdate, self.books))
+    
+    def dump(self, chunk_size=256):
+        # (version, chunks of author rows in the /bulk form): every author
+        # exactly as of version, through a ReadView, read a chunk at a time
+        # while writes go on
+        with self.lock.reading():
+            view = ReadView(self.global_version)
+            self.views.add(view)
+            keys = list(self.authors.iterkeys())
+        return (view.version, self._dump(view, keys, chunk_size))
+    
+    def _dump(self, view, keys, chunk_size):
+        before = view.before["author"]
+        try:
+            for i in xrange(0, len(keys), chunk_size):
+                with self.lock.reading():
+                    found = [(key, before[key][0] if key in before else self.authors.get(key))
+                        for key in keys[i:i + chunk_size]]
+                chunk = [bulk_row("author", key, rels) for key, rels in found if rels]
+                yield chunk
+        finally:
+            self._close_view(view)
+    
+    def read_many(self, keys):
+        # [(side, key)] -> [relation keys, or None if missing] in order, all
+        # read in one go
+        a = []
+        with self.lock.reading():
+            for side, key in keys:
+                rels = (self.authors if "author" == side else self.books).get(key)
+                a.append(None if rels is None else list(rels))
+        return a
+    
+    def author_read_items(self, author, dob):
+        s = self.author_read(author, dob)
+        # unpack set of tuples
+        a = []
+        for i in s:
             a.append({'title': i[0], 'pubdate': i[1]})
         return a
     
     def book_read_items(self, title, pubdate):
-        s = entity_read(title, pubdate, self.books)
-        # unpack set of tuples
-        a = []
-        for i in s:
-            a.append({'name': i[0], 'dob': i[1]})
-        return a
+        s = self.book_read(title, pubdate)
+        # unpack set of tuples
+        a = []
+        for i in s:
+            a.append({'name': i[0], 'dob': i[1]})
+        return a
+    
+    def author_iter_items(self, author, dob):
+        # author_read_items, one at a time
+        for i in self.author_read(author, dob):
+            yield {'title': i[0], 'pubdate': i[1]}
+    
+    def book_iter_items(self, title, pubdate):
+        for i in self.book_read(title, pubdate):
+            yield {'name': i[0], 'dob': i[1]}
+    
+    
+    def author_delete(self, author, dob):
+        with self.lock.writing():
+            return self._delete("author", author, dob)
+    
+    def book_delete(self, title, pubdate):
+        with self.lock.writing():
+            return self._delete("book", title, pubdate)
+    
+    
+    def version(self):
+        # changes with anything at all, for the queries
+        return self.global_version
+    
+    def author_version(self, author, dob):
+        # None for no such author
+        return self._version("author", self.authors, author, dob)
+    
+    def book_version(self, title, pubdate):
+        return self._version("book", self.books, title, pubdate)
+    
+    def _version(self, side, entities, idstr, date):
+        id_key = (str(idstr), int(date))
+        with self.lock.reading():
+            version = self.versions[side].get(id_key)
+            if version is None and id_key in entities:
+                version = 0
+            return version
+    
+    
+    def author_coauthors(self, author, dob, limit=None):
+        # authors sharing books with this one, most shared first
+        with self.lock.reading():
+            found = entity_related((str(author), int(dob)), self.authors, self.books, limit)
+        return [{"name": k[0], "dob": k[1], "shared_books": n} for k, n in found]
+    
+    def book_related(self, title, pubdate, limit=None):
+        with self.lock.reading():
+            found = entity_related((str(title), int(pubdate)), self.books, self.authors, limit)
+        return [{"title": k[0], "pubdate": k[1], "shared_authors": n} for k, n in found]
+    
+    def author_neighborhood(self, author, dob, depth, limit=None):
+        # books and authors within depth hops, nearest first, with distance
+        with self.lock.reading():
+            found = entity_neighborhood((str(author), int(dob)), self.authors,
+                self.books, depth, limit)
+        return neighborhood_rows("author", found, entity_row)
+    
+    def book_neighborhood(self, title, pubdate, depth, limit=None):
+        with self.lock.reading():
+            found = entity_neighborhood((str(title), int(pubdate)), self.books,
+                self.authors, depth, limit)
+        return neighborhood_rows("book", found, entity_row)
+    
+    
+    def author_by_books(self):
+        return self.author_by_books_page()[0]
+    
+    def book_by_authors(self):
+        return self.book_by_authors_page()[0]
+    
+    def author_by_books_iter(self, min_count=1):
+        # author_by_books, one at a time straight off the ranking, all as of
+        # the first one
+        return self._ranked_iter("author",
+            lambda key, count: {"name": key[0], "dob": key[1], "book_count": count},
+            min_count)
+    
+    def book_by_authors_iter(self, min_count=1):
+        return self._ranked_iter("book",
+            lambda key, count: {"title": key[0], "pubdate": key[1], "author_count": count},
+            min_count)
+    
+    def _ranked_iter(self, side, row, min_count):
+        # row(key, count) down side's ranking through a ReadView
+        self._ranked()
+        ranks = self.author_ranks if "author" == side else self.book_ranks
+        view = self._view()
+        def live(after):
+            for key, count, stamp in ranks.walk(min_count,
+                    None if after is None else (-after[0], after[1])):
+                yield ((-count, stamp), key)
+        def position(key, value):
+            rels, p = value
+            if rels is None or p is None or -p[0] < min_count:
+                return None
+            return p
+        try:
+            for p, key in walk_view(self.lock, live, view.before[side], position,
+                    self.chunk_size):
+                yield row(key, -p[0])
+        finally:
+            self._close_view(view)
+    
+    def author_by_name_page(self, prefix, limit=None, cursor=None):
+        # authors whose names start with prefix, by name then dob
+        return self._find_page("author", 0, (str(prefix),),
+            lambda e: e[0].startswith(prefix), limit, cursor)
+    
+    def book_by_title_page(self, prefix, limit=None, cursor=None):
+        return self._find_page("book", 0, (str(prefix),),
+            lambda e: e[0].startswith(prefix), limit, cursor)
+    
+    def author_by_dob_page(self, start=None, end=None, limit=None, cursor=None):
+        # authors born start to end inclusive (either open if None), by dob
+        # then name
+        return self._find_page("author", 1, (start,) if start is not None else (),
+            (lambda e: True) if end is None else (lambda e: e[0] <= end), limit, cursor)
+    
+    def book_by_pubdate_page(self, start=None, end=None, limit=None, cursor=None):
+        return self._find_page("book", 1, (start,) if start is not None else (),
+            (lambda e: True) if end is None else (lambda e: e[0] <= end), limit, cursor)
+    
+    def author_by_name_iter(self, prefix):
+        # the same, one at a time and all as of the first one
+        return self._find_iter("author", 0, (str(prefix),),
+            lambda e: e[0].startswith(prefix))
+    
+    def book_by_title_iter(self, prefix):
+        return self._find_iter("book", 0, (str(prefix),),
+            lambda e: e[0].startswith(prefix))
+    
+    def author_by_dob_iter(self, start=None, end=None):
+        return self._find_iter("author", 1, (start,) if start is not None else (),
+            (lambda e: True) if end is None else (lambda e: e[0] <= end))
+    
+    def book_by_pubdate_iter(self, start=None, end=None):
+        return self._find_iter("book", 1, (start,) if start is not None else (),
+            (lambda e: True) if end is None else (lambda e: e[0] <= end))
+    
+    def _find_iter(self, side, by, start, match):
+        # _find_page's rows through a ReadView
+        self._indexed()
+        index = self.indexes[side][by]
+        view = self._view()
+        def live(after):
+            for entry in index.walk(start if after is None else after, after is not None):
+                if not match(entry):
+                    return
+                yield (entry, index.by(entry))
+        def position(key, value):
+            entry = index.by(key)
+            if value[0] is None or entry < start or not match(entry):
+                return None
+            return entry
+        try:
+            for entry, key in walk_view(self.lock, live, view.before[side], position,
+                    self.chunk_size):
+                yield entity_row(side, key)
+        finally:
+            self._close_view(view)
+    
+    def _find_page(self, side, by, start, match, limit, cursor):
+        # keys from the side's by'th SortedIndex, starting at start, for as
+        # long as match(entry); the cursor is the last key as [date, idstr]
+        self._indexed()
+        after = decode_cursor(cursor, self.epoch)
+        if after is not None:
+            if not isinstance(after[1], basestring):
+                raise ValueError("bad cursor")
+            start = (str(after[1]), after[0]) if 0 == by else (after[0], str(after[1]))
+        index = self.indexes[side][by]
+        if limit is None:
+            limit = sys.maxint
+        keys = []
+        with self.lock.reading():
+            for entry in index.walk(start, after is not None):
+                if not match(entry):
+                    break
+                if len(keys) == limit:
+                    last = keys[-1]
+                    return (entity_key_rows(side, keys),
+                        encode_cursor(self.epoch, [last[1], last[0]]))
+                keys.append(index.by(entry))
+        return (entity_key_rows(side, keys), None)
+    
+    def author_by_books_page(self, limit=None, min_count=1, cursor=None):
+        self._ranked()
+        with self.lock.reading():
+            t, position = entity_page_by_rels(self.authors, self.author_ranks,
+                limit, min_count, decode_cursor(cursor, self.epoch))
+        # unpack set of tuples
+        a = []
+        for i in t:
+            a.append({"name": i[0][0], "dob": i[0][1], "book_count": i[1]})
+        return (a, position and encode_cursor(self.epoch, position))
+    
+    def book_by_authors_page(self, limit=None, min_count=1, cursor=None):
+        self._ranked()
+        with self.lock.reading():
+            t, position = entity_page_by_rels(self.books, self.book_ranks,
+                limit, min_count, decode_cursor(cursor, self.epoch))
+        # unpack set of tuples
+        a = []
+        for i in t:
+            a.append({"title": i[0][0], "pubdate": i[0][1], "author_count": i[1]})
+        return (a, position and encode_cursor(self.epoch, position))
+
+
+
+# ------------------------------------------------------------
+# Compact storage
+# ------------------------------------------------------------
+
+"""
+BookAuthorCompactStorage has the same methods as BookAuthorMemStorage
+but keeps far less per relation. Each (idstr, date) key is interned once
+per side to a small integer id, and an entity's relations are a sorted
+array('i') of ids on the other side: 4 bytes per relation per side,
+instead of a tuple plus a set slot. Reads turn ids back into keys, which
+is one list index each.
+"""
+
+
+class EntityTable(object):
+    # one side: keys <-> ids, and each id's sorted relation ids
+    
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+        self.rels = []
+        self.free = []
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def intern(self, key):
+        i = self.ids.get(key)
+        if i is None:
+            if self.free:
+                i = self.free.pop()
+                self.keys[i] = key
+                self.rels[i] = array.array('i')
+            else:
+                i = len(self.keys)
+                self.keys.append(key)
+                self.rels.append(array.array('i'))
+            self.ids[key] = i
+        return i
+    
+    def release(self, i):
+        del self.ids[self.keys[i]]
+        self.keys[i] = None
+        self.rels[i] = None
+        self.free.append(i)
+    
+    def link(self, i, j):
+        # add j to i's relations, False if it was already there
+        rels = self.rels[i]
+        pos = bisect.bisect_left(rels, j)
+        if pos < len(rels) and rels[pos] == j:
+            return False
+        rels.insert(pos, j)
+        return True
+    
+    def unlink(self, i, j):
+        rels = self.rels[i]
+        pos = bisect.bisect_left(rels, j)
+        if pos < len(rels) and rels[pos] == j:
+            del rels[pos]
+    
+    def read(self, key, opposite):
+        # relation keys of key, empty if it doesn't exist
+        i = self.ids.get(key)
+        if i is None:
+            return []
+        keys = opposite.keys
+        return [keys[j] for j in self.rels[i]]
+
+
+def id_neighborhood(i, tables, depth, limit):
+    # [(distance, id)] like entity_neighborhood, for id i of tables[0]
+    seen = (bytearray(len(tables[0].keys)), bytearray(len(tables[1].keys)))
+    seen[0][i] = 1
+    frontier = [i]
+    found = []
+    for distance in xrange(1, depth + 1):
+        rels, visited = tables[(distance - 1) % 2].rels, seen[distance % 2]
+        next_frontier = []
+        for j in frontier:
+            for k in rels[j]:
+                if not visited[k]:
+                    visited[k] = 1
+                    next_frontier.append(k)
+                    found.append((distance, k))
+                    if len(found) == limit:
+                        return found
+        frontier = next_frontier
+    return found
+
+
+class IdRanks(object):
+    """
+    EntityRanks for EntityTable ids, kept in arrays instead of dicts of
+    keys and lists of tuples. A bucket entry packs stamp << 32 | id into one
+    integer, so buckets still sort by stamp and a cursor position is the
+    same (count, stamp) pair.
+    """
+    
+    def __init__(self):
+        self.counts = array.array('i')
+        self.stamps = array.array('l')
+        self.buckets = {}
+        self.stale = {}
+        self.next_stamp = 0
+        self.max_count = 0
+        self.n = 0
+    
+    def __len__(self):
+        return self.n
+    
+    def __iter__(self):
+        for i, count, stamp in self.walk():
+            yield (i, count)
+    
+    def count(self, i):
+        if i < len(self.counts):
+            return self.counts[i]
+        return 0
+    
+    def incr(self, i):
+        if i >= len(self.counts):
+            grow = max(i + 1 - len(self.counts), len(self.counts))
+            self.counts.extend(array.array('i', [0]) * grow)
+            self.stamps.extend(array.array('l', [-1]) * grow)
+        self._move(i, self.counts[i] + 1)
+    
+    def decr(self, i):
+        self._move(i, self.counts[i] - 1)
+    
+    def remove(self, i):
+        if i < len(self.counts):
+            self._move(i, 0)
+    
+    def _move(self, i, count):
+        old = self.counts[i]
+        self.counts[i] = count
+        if count > 0:
+            stamp = self.next_stamp
+            self.next_stamp += 1
+            self.stamps[i] = stamp
+            bucket = self.buckets.get(count)
+            if bucket is None:
+                bucket = self.buckets[count] = self._bucket()
+                if count > self.max_count:
+                    self.max_count = count
+            bucket.append(stamp << 32 | i)
+            if not old:
+                self.n += 1
+        elif old > 0:
+            self.stamps[i] = -1
+            self.n -= 1
+        if old > 0:
+            self._retire(old)
+    
+    def _bucket(self, entries=()):
+        # packed entries need 64 bits
+        if array.array('l').itemsize >= 8:
+            return array.array('l', entries)
+        return list(entries)
+    
+    def _retire(self, count):
+        bucket = self.buckets[count]
+        stale = self.stale.get(count, 0) + 1
+        if stale == len(bucket):
+            del self.buckets[count]
+            self.stale.pop(count, None)
+            while self.max_count > 0 and self.max_count not in self.buckets:
+                self.max_count -= 1
+        elif stale * 2 > len(bucket):
+            stamps = self.stamps
+            self.buckets[count] = self._bucket(
+                e for e in bucket if stamps[e & 0xffffffff] == e >> 32)
+            self.stale.pop(count, None)
+        else:
+            self.stale[count] = stale
+    
+    def walk(self, min_count=1, after=None):
+        # yields (id, count, stamp), as EntityRanks.walk
+        stamps = self.stamps
+        top = self.max_count
+        start = 0
+        if after is not None:
+            a_count, a_stamp = after
+            if not isinstance(a_stamp, (int, long)):
+                raise ValueError("bad position")
+            if a_count <= top:
+                top = a_count
+                bucket = self.buckets.get(top)
+                if bucket is not None:
+                    start = bisect.bisect_left(bucket, (a_stamp + 1) << 32)
+        for count in xrange(top, max(min_count, 1) - 1, -1):
+            bucket = self.buckets.get(count)
+            if bucket is None:
+                start = 0
+                continue
+            for k in xrange(start, len(bucket)):
+                e = bucket[k]
+                i, stamp = e & 0xffffffff, e >> 32
+                if stamps[i] == stamp:
+                    yield (i, count, stamp)
+            start = 0
+
+
+class BookAuthorCompactStorage(object):
+    def __init__(self):
+        self.lock = ReadWriteLock()
+        self.books = EntityTable()
+        self.authors = EntityTable()
+        self.book_ranks = IdRanks()
+        self.author_ranks = IdRanks()
+        # tells our cursors from any other's
+        self.epoch = os.urandom(4).encode('hex')
+    
+    def _side(self, side):
+        if "author" == side:
+            return (self.authors, self.books, self.author_ranks, self.book_ranks)
+        return (self.books, self.authors, self.book_ranks, self.author_ranks)
+    
+    def author_create(self, author, dob, bookset):
+        rels = []
+        for d in bookset:
+            rels.append( (d['title'], d['pubdate']) )
+        with self.lock.writing():
+            return self._create("author", author, dob, rels)
+    
+    def book_create(self, title, pubdate, authorset):
+        rels = []
+        for d in authorset:
+            rels.append( (d['name'], d['dob']) )
+        with self.lock.writing():
+            return self._create("book", title, pubdate, rels)
+    
+    def bulk_create(self, records):
+        a = []
+        with self.lock.writing():
+            for side, idstr, date, rels in records:
+                a.append(self._create(side, idstr, date, rels))
+        return a
+    
+    def _create(self, side, idstr, date, rels):
+        # same contract as entity_create
+        id_key = (str(idstr), int(date))
+        if len(rels) < 1:
+            return (False, False)
+        table, opposite, ranks, ranks_opposite = self._side(side)
+        created = id_key not in table.ids
+        i = table.intern(id_key)
+        updated = False
+        for r in rels:
+            j = opposite.intern((str(r[0]), int(r[1])))
+            if table.link(i, j):
+                opposite.link(j, i)
+                ranks.incr(i)
+                ranks_opposite.incr(j)
+                updated = True
+        return (created, updated)
+    
+    def _delete(self, side, idstr, date):
+        table, opposite, ranks, ranks_opposite = self._side(side)
+        i = table.ids.get((str(idstr), int(date)))
+        if i is None:
+            return False
+        for j in table.rels[i]:
+            opposite.unlink(j, i)
+            ranks_opposite.decr(j)
+            if 0 == len(opposite.rels[j]):
+                opposite.release(j)
+        ranks.remove(i)
+        table.release(i)
+        return True
+    
+    
+    def author_read(self, author, dob):
+        with self.lock.reading():
+            return set(self.authors.read((str(author), int(dob)), self.books))
+    
+    def book_read(self, title, pubdate):
+        with self.lock.reading():
+            return set(self.books.read((str(title), int(pubdate)), self.authors))
+    
+    def read_many(self, keys):
+        a = []
+        with self.lock.reading():
+            for side, key in keys:
+                table, opposite = self._side(side)[:2]
+                a.append(table.read(key, opposite) if key in table.ids else None)
+        return a
+    
+    def author_read_items(self, author, dob):
+        return list(self.author_iter_items(author, dob))
+    
+    def book_read_items(self, title, pubdate):
+        return list(self.book_iter_items(title, pubdate))
+    
+    def author_iter_items(self, author, dob):
+        for i in self.author_read(author, dob):
+            yield {'title': i[0], 'pubdate': i[1]}
+    
+    def book_iter_items(self, title, pubdate):
+        for i in self.book_read(title, pubdate):
+            yield {'name': i[0], 'dob': i[1]}
     
     
     def author_delete(self, author, dob):
-        return entity_delete(author, dob, self.authors, self.books)
+        with self.lock.writing():
+            return self._delete("author", author, dob)
     
     def book_delete(self, title, pubdate):
-        return entity_delete(title, pubdate, self.books, self.authors)
+        with self.lock.writing():
+            return self._delete("book", title, pubdate)
+    
+    
+    def author_coauthors(self, author, dob, limit=None):
+        found = self._related("author", (str(author), int(dob)), limit)
+        return [{"name": k[0], "dob": k[1], "shared_books": n} for k, n in found]
+    
+    def book_related(self, title, pubdate, limit=None):
+        found = self._related("book", (str(title), int(pubdate)), limit)
+        return [{"title": k[0], "pubdate": k[1], "shared_authors": n} for k, n in found]
+    
+    def author_neighborhood(self, author, dob, depth, limit=None):
+        return neighborhood_rows("author",
+            self._neighborhood("author", (str(author), int(dob)), depth, limit), entity_row)
+    
+    def book_neighborhood(self, title, pubdate, depth, limit=None):
+        return neighborhood_rows("book",
+            self._neighborhood("book", (str(title), int(pubdate)), depth, limit), entity_row)
+    
+    def _related(self, side, key, limit):
+        # entity_related over ids
+        table, opposite = self._side(side)[:2]
+        with self.lock.reading():
+            i = table.ids.get(key)
+            if i is None:
+                return []
+            counts = collections.defaultdict(int)
+            for j in table.rels[i]:
+                for k in opposite.rels[j]:
+                    counts[k] += 1
+            del counts[i]
+            keys = table.keys
+            return rank_related(((keys[k], n) for k, n in counts.iteritems()), limit)
+    
+    def _neighborhood(self, side, key, depth, limit):
+        # entity_neighborhood over ids: frontiers are lists of ids, and what
+        # each side has seen is a bytearray indexed by id
+        tables = self._side(side)[:2]
+        if limit is None:
+            limit = sys.maxint
+        with self.lock.reading():
+            i = tables[0].ids.get(key)
+            if i is None:
+                return []
+            found = id_neighborhood(i, tables, depth, limit)
+            return [(distance, tables[distance % 2].keys[k]) for distance, k in found]
     
     
     def author_by_books(self):
-        t = entity_by_rels(self.authors)
-        # unpack set of tuples
+        return self.author_by_books_page()[0]
+    
+    def book_by_authors(self):
+        return self.book_by_authors_page()[0]
+    
+    def author_by_books_iter(self, min_count=1):
+        # ids are only good while the lock is held, so keys are looked up
+        # chunk by chunk inside it
+        keys = self.authors.keys
+        return walk_in_chunks(self.lock, self.author_ranks.walk,
+            lambda i, count: {"name": keys[i][0], "dob": keys[i][1], "book_count": count},
+            min_count)
+    
+    def book_by_authors_iter(self, min_count=1):
+        keys = self.books.keys
+        return walk_in_chunks(self.lock, self.book_ranks.walk,
+            lambda i, count: {"title": keys[i][0], "pubdate": keys[i][1], "author_count": count},
+            min_count)
+    
+    def author_by_books_page(self, limit=None, min_count=1, cursor=None):
+        keys = self.authors.keys
         a = []
-        for i in t:
-            a.append({"name": i[0][0], "dob": i[0][1], "book_count": i[1]})
+        with self.lock.reading():
+            t, position = entity_page_by_rels(None, self.author_ranks,
+                limit, min_count, decode_cursor(cursor, self.epoch))
+            for i, count in t:
+                a.append({"name": keys[i][0], "dob": keys[i][1], "book_count": count})
+        return (a, position and encode_cursor(self.epoch, position))
+    
+    def book_by_authors_page(self, limit=None, min_count=1, cursor=None):
+        keys = self.books.keys
+        a = []
+        with self.lock.reading():
+            t, position = entity_page_by_rels(None, self.book_ranks,
+                limit, min_count, decode_cursor(cursor, self.epoch))
+            for i, count in t:
+                a.append({"title": keys[i][0], "pubdate": keys[i][1], "author_count": count})
+        return (a, position and encode_cursor(self.epoch, position))
+
+
+
+# ------------------------------------------------------------
+# SQLite storage
+# ------------------------------------------------------------
+
+"""
+BookAuthorSQLiteStorage has the same methods again, on a SQLite file, for
+data larger than memory or shared between processes.
+
+    author (id, name, dob, book_count)      unique (name, dob)
+    book (id, title, pubdate, author_count) unique (title, pubdate)
+    author_book (author_id, book_id)        the relation, both ways indexed
+
+book_count / author_count are kept up to date with the join table, and
+indexed together with the key, so the prolific queries (and their cursor
+pages) are an index-only scan in order. Ties are in id order, which is the
+order entities were first created in.
+
+Each thread gets its own connection; the file is in WAL journal mode so
+readers in other processes don't block on a writer.
+"""
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS author (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    dob INTEGER NOT NULL,
+    book_count INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (name, dob)
+);
+CREATE TABLE IF NOT EXISTS book (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    pubdate INTEGER NOT NULL,
+    author_count INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (title, pubdate)
+);
+CREATE TABLE IF NOT EXISTS author_book (
+    author_id INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    PRIMARY KEY (author_id, book_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS book_author ON author_book (book_id, author_id);
+CREATE INDEX IF NOT EXISTS author_by_books ON author (book_count DESC, id, name, dob);
+CREATE INDEX IF NOT EXISTS book_by_authors ON book (author_count DESC, id, title, pubdate);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class SQLiteSide(object):
+    # the SQL for one side of the relation
+    
+    def __init__(self, table, idstr, date, count, own_id, opposite):
+        # opposite is (table, idstr, date, count, own_id) of the other side
+        o_table, o_idstr, o_date, o_count, o_id = opposite
+        self.find = "SELECT id FROM %s WHERE %s = ? AND %s = ?" % (table, idstr, date)
+        self.insert = "INSERT OR IGNORE INTO %s (%s, %s) VALUES (?, ?)" % (table, idstr, date)
+        self.link = "INSERT OR IGNORE INTO author_book (%s, %s) VALUES (?, ?)" % (own_id, o_id)
+        self.add_count = "UPDATE %s SET %s = %s + ? WHERE id = ?" % (table, count, count)
+        self.read = ("SELECT o.%s, o.%s FROM %s e JOIN author_book r ON r.%s = e.id "
+            "JOIN %s o ON o.id = r.%s WHERE e.%s = ? AND e.%s = ?" % (
+            o_idstr, o_date, table, own_id, o_table, o_id, idstr, date))
+        self.drop_opposite_counts = ("UPDATE %s SET %s = %s - 1 WHERE id IN "
+            "(SELECT %s FROM author_book WHERE %s = ?)" % (
+            o_table, o_count, o_count, o_id, own_id))
+        self.unlink = "DELETE FROM author_book WHERE %s = ?" % own_id
+        self.drop_orphans = "DELETE FROM %s WHERE %s = 0" % (o_table, o_count)
+        self.drop = "DELETE FROM %s WHERE id = ?" % table
+        ranked = "SELECT %s, %s, %s, id FROM %s " % (idstr, date, count, table)
+        self.ranked = ranked + "WHERE %s >= ? ORDER BY %s DESC, id LIMIT ?" % (count, count)
+        self.ranked_below = (ranked + "WHERE %s < ? AND %s >= ? "
+            "ORDER BY %s DESC, id LIMIT ?" % (count, count, count))
+        self.ranked_tie = ranked + "WHERE %s = ? AND id > ? ORDER BY id LIMIT ?" % count
+
+
+class BookAuthorSQLiteStorage(object):
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        a = ("author", "name", "dob", "book_count", "author_id")
+        b = ("book", "title", "pubdate", "author_count", "book_id")
+        self.sides = {"author": SQLiteSide(*(a + (b,))), "book": SQLiteSide(*(b + (a,)))}
+        conn = self.conn()
+        conn.executescript(SQLITE_SCHEMA)
+        # the file's epoch, for cursors: the same for every connection to it
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('epoch', ?)",
+                (os.urandom(4).encode('hex'),))
+        self.epoch = conn.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0]
+    
+    def conn(self):
+        # this thread's connection
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.text_factory = str
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+    
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+    
+    def author_create(self, author, dob, bookset):
+        rels = []
+        for d in bookset:
+            rels.append( (d['title'], d['pubdate']) )
+        return self.bulk_create([("author", author, dob, rels)])[0]
+    
+    def book_create(self, title, pubdate, authorset):
+        rels = []
+        for d in authorset:
+            rels.append( (d['name'], d['dob']) )
+        return self.bulk_create([("book", title, pubdate, rels)])[0]
+    
+    def bulk_create(self, records):
+        # one transaction for the lot
+        conn = self.conn()
+        with conn:
+            return [self._create(conn, *r) for r in records]
+    
+    def _id(self, conn, side, key, create):
+        # (id, created) for key; id None if missing and not create. The
+        # insert goes first and takes the write lock, so another writer
+        # can't slip the same key in between finding it missing and adding it
+        created = create and conn.execute(side.insert, key).rowcount > 0
+        row = conn.execute(side.find, key).fetchone()
+        if row is None:
+            return (None, False)
+        return (row[0], created)
+    
+    def _create(self, conn, side_name, idstr, date, rels):
+        # same contract as entity_create
+        if len(rels) < 1:
+            return (False, False)
+        side = self.sides[side_name]
+        opposite = self.sides["book" if "author" == side_name else "author"]
+        i, created = self._id(conn, side, (str(idstr), int(date)), True)
+        added = 0
+        for r in rels:
+            j, _ = self._id(conn, opposite, (str(r[0]), int(r[1])), True)
+            if conn.execute(side.link, (i, j)).rowcount:
+                conn.execute(opposite.add_count, (1, j))
+                added += 1
+        if added:
+            conn.execute(side.add_count, (added, i))
+        return (created, added > 0)
+    
+    def _delete(self, side_name, idstr, date):
+        side = self.sides[side_name]
+        conn = self.conn()
+        with conn:
+            i, _ = self._id(conn, side, (str(idstr), int(date)), False)
+            if i is None:
+                return False
+            conn.execute(side.drop_opposite_counts, (i,))
+            conn.execute(side.unlink, (i,))
+            conn.execute(side.drop_orphans)
+            conn.execute(side.drop, (i,))
+        return True
+    
+    def _read(self, side_name, idstr, date):
+        return self.conn().execute(self.sides[side_name].read, (str(idstr), int(date)))
+    
+    
+    def read_many(self, keys):
+        # one statement per key, but one connection; every entity has
+        # relations, so none means missing
+        conn = self.conn()
+        return [conn.execute(self.sides[side].read, key).fetchall() or None
+            for side, key in keys]
+    
+    def author_read(self, author, dob):
+        return set(self._read("author", author, dob))
+    
+    def book_read(self, title, pubdate):
+        return set(self._read("book", title, pubdate))
+    
+    def author_read_items(self, author, dob):
+        return list(self.author_iter_items(author, dob))
+    
+    def book_read_items(self, title, pubdate):
+        return list(self.book_iter_items(title, pubdate))
+    
+    def author_iter_items(self, author, dob):
+        for i in self._read("author", author, dob):
+            yield {'title': i[0], 'pubdate': i[1]}
+    
+    def book_iter_items(self, title, pubdate):
+        for i in self._read("book", title, pubdate):
+            yield {'name': i[0], 'dob': i[1]}
+    
+    
+    def author_delete(self, author, dob):
+        return self._delete("author", author, dob)
+    
+    def book_delete(self, title, pubdate):
+        return self._delete("book", title, pubdate)
+    
+    
+    def _ranked(self, side_name, limit=None, min_count=1, after=None):
+        # [(idstr, date, count, id)] in ranking order, starting after the
+        # (count, id) position from a previous page
+        side = self.sides[side_name]
+        conn = self.conn()
+        if limit is None:
+            limit = -1
+        if after is None:
+            return conn.execute(side.ranked, (min_count, limit)).fetchall()
+        a_count, a_id = after
+        if not isinstance(a_id, (int, long)):
+            raise ValueError("bad position")
+        a = []
+        if a_count >= min_count:
+            a = conn.execute(side.ranked_tie, (a_count, a_id, limit)).fetchall()
+        if limit < 0 or len(a) < limit:
+            more = limit - len(a) if limit >= 0 else -1
+            a.extend(conn.execute(side.ranked_below, (a_count, min_count, more)))
         return a
     
+    def _page(self, side_name, limit, min_count, cursor):
+        after = decode_cursor(cursor, self.epoch)
+        if limit is None:
+            return (self._ranked(side_name, None, min_count, after), None)
+        a = self._ranked(side_name, limit + 1, min_count, after)
+        if len(a) <= limit:
+            return (a, None)
+        a = a[:limit]
+        return (a, encode_cursor(self.epoch, (a[-1][2], a[-1][3])))
+    
+    def author_by_books(self):
+        return self.author_by_books_page()[0]
+    
     def book_by_authors(self):
-        t = entity_by_rels(self.books)
-        # unpack set of tuples
+        return self.book_by_authors_page()[0]
+    
+    def author_by_books_iter(self, min_count=1):
+        cur = self.conn().execute(self.sides["author"].ranked, (min_count, -1))
+        for name, dob, count, i in cur:
+            yield {"name": name, "dob": dob, "book_count": count}
+    
+    def book_by_authors_iter(self, min_count=1):
+        cur = self.conn().execute(self.sides["book"].ranked, (min_count, -1))
+        for title, pubdate, count, i in cur:
+            yield {"title": title, "pubdate": pubdate, "author_count": count}
+    
+    def author_by_books_page(self, limit=None, min_count=1, cursor=None):
+        t, cursor = self._page("author", limit, min_count, cursor)
         a = []
-        for i in t:
-            a.append({"title": i[0][0], "pubdate": i[0][1], "author_count": i[1]})
+        for name, dob, count, i in t:
+            a.append({"name": name, "dob": dob, "book_count": count})
+        return (a, cursor)
+    
+    def book_by_authors_page(self, limit=None, min_count=1, cursor=None):
+        t, cursor = self._page("book", limit, min_count, cursor)
+        a = []
+        for title, pubdate, count, i in t:
+            a.append({"title": title, "pubdate": pubdate, "author_count": count})
+        return (a, cursor)
+
+
+
+# ------------------------------------------------------------
+# Sharded storage
+# ------------------------------------------------------------
+
+"""
+For using more than one core: entities are split over shard processes by a
+hash of their key, and each server process talks to every shard through
+BookAuthorShardedStorage.
+
+A shard holds both sides, but only for its own keys:
+    
+    author (name, dob) -> set of books     on shard_of(author key)
+    book (title, pubdate) -> set of authors on shard_of(book key)
+
+so creating an author links it on its own shard and links it back on each
+of its books' shards; deleting it unlinks it from each book's shard the
+same way. Those multi-shard writes are serialized by one lock shared by all
+server processes, so a write never sees another half done. Reads take no
+lock across shards and may see one half done.
+
+Each shard ranks its own keys; the prolific queries merge the shards'
+rankings by (count desc, stamp, shard), and a cursor is the position in
+that merged order, [count, [stamp, shard]].
+"""
+
+SHARD_METHODS = frozenset(["link", "unlink", "remove", "read", "read_many", "walk"])
+
+
+def shard_of(key, n):
+    # stable across processes, unlike hash()
+    return (zlib.crc32("%s\0%d" % key) & 0xffffffff) % n
+
+
+class EntityShard(object):
+    # one shard's entities, both sides
+    
+    def __init__(self):
+        self.lock = ReadWriteLock()
+        self.sides = {"author": ({}, EntityRanks()), "book": ({}, EntityRanks())}
+    
+    def link(self, side, pairs):
+        # [(key, rels)], each rel added to key's set; [(created, updated)]
+        entities, ranks = self.sides[side]
+        a = []
+        with self.lock.writing():
+            for key, rels in pairs:
+                id_rels = entities.get(key)
+                created = id_rels is None
+                if created:
+                    id_rels = entities[key] = set()
+                updated = False
+                for r in rels:
+                    if r not in id_rels:
+                        id_rels.add(r)
+                        ranks.incr(key)
+                        updated = True
+                a.append((created, updated))
+        return a
+    
+    def unlink(self, side, pairs):
+        # [(key, rel)], key goes when its last rel does
+        entities, ranks = self.sides[side]
+        with self.lock.writing():
+            for key, r in pairs:
+                id_rels = entities.get(key)
+                if id_rels is None or r not in id_rels:
+                    continue
+                id_rels.discard(r)
+                if id_rels:
+                    ranks.decr(key)
+                else:
+                    del entities[key]
+                    ranks.remove(key)
+    
+    def remove(self, side, key):
+        # key's rels, or None if there was no key
+        entities, ranks = self.sides[side]
+        with self.lock.writing():
+            id_rels = entities.pop(key, None)
+            if id_rels is None:
+                return None
+            ranks.remove(key)
+            return list(id_rels)
+    
+    def read(self, side, key):
+        entities, ranks = self.sides[side]
+        with self.lock.reading():
+            return list(entities.get(key, ()))
+    
+    def read_many(self, keys):
+        # [(side, key)] -> [rels or None]
+        a = []
+        with self.lock.reading():
+            for side, key in keys:
+                rels = self.sides[side][0].get(key)
+                a.append(None if rels is None else list(rels))
+        return a
+    
+    def walk(self, side, limit, min_count, after):
+        # [(key, count, stamp)], at most limit of them
+        entities, ranks = self.sides[side]
+        with self.lock.reading():
+            return list(itertools.islice(ranks.walk(min_count, after), limit))
+
+
+class ShardServer(object):
+    # serves an EntityShard on a multiprocessing.connection address, a
+    # thread per connection
+    
+    def __init__(self, address, authkey=None, shard=None):
+        self.listener = multiprocessing.connection.Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.shard = shard or EntityShard()
+        self.running = False
+        self.stopped = threading.Event()
+    
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except (EnvironmentError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            if not self.running:
+                conn.close()
+                break
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+        self.listener.close()
+        self.stopped.set()
+    
+    def handle(self, conn):
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, EnvironmentError):
+                break
+            try:
+                if method not in SHARD_METHODS:
+                    raise ValueError("no such method %r" % method)
+                reply = ("ok", getattr(self.shard, method)(*args))
+            except Exception, e:
+                reply = ("error", e)
+            conn.send(reply)
+        conn.close()
+    
+    def shutdown(self):
+        # accept() won't notice, so wake it up
+        self.running = False
+        multiprocessing.connection.Client(self.address, authkey=self.authkey).close()
+        self.stopped.wait()
+
+
+def start_shards(n, directory):
+    # n ShardServer processes listening in directory; returns the servers,
+    # which have to be kept (a collected listener removes its socket file)
+    authkey = os.urandom(16)
+    servers = []
+    for i in range(n):
+        server = ShardServer(os.path.join(directory, "shard%d" % i), authkey)
+        p = multiprocessing.Process(target=server.serve_forever)
+        p.daemon = True
+        p.start()
+        servers.append(server)
+    return servers
+
+
+class BookAuthorShardedStorage(object):
+    def __init__(self, addresses, authkey=None, write_lock=None):
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        # multiprocessing.Lock to share it between forked server processes
+        self.write_lock = write_lock or threading.Lock()
+        self.local = threading.local()
+        # tells our cursors from any other's; made before any fork, so the
+        # server processes share it
+        self.epoch = os.urandom(4).encode('hex')
+    
+    def conns(self):
+        # this thread's connections, one per shard; a forked child opens
+        # its own
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.conns = [multiprocessing.connection.Client(a, authkey=self.authkey)
+                for a in self.addresses]
+            local.pid = os.getpid()
+        return local.conns
+    
+    def close(self):
+        if getattr(self.local, 'pid', None) == os.getpid():
+            for conn in self.local.conns:
+                conn.close()
+        self.local.pid = None
+    
+    def _call(self, calls):
+        # {shard: (method, args)} -> {shard: result}; all requests go out
+        # before any reply is read, so the shards work in parallel
+        conns = self.conns()
+        for i, call in calls.iteritems():
+            conns[i].send(call)
+        results = {}
+        error = None
+        for i in calls:
+            status, result = conns[i].recv()
+            if "error" == status:
+                error = result
+            results[i] = result
+        if error is not None:
+            raise error
+        return results
+    
+    def _by_shard(self, pairs):
+        # [(key, x)] -> {shard: [(key, x)]}
+        n = len(self.addresses)
+        shards = {}
+        for pair in pairs:
+            shards.setdefault(shard_of(pair[0], n), []).append(pair)
+        return shards
+    
+    
+    def author_create(self, author, dob, bookset):
+        rels = []
+        for d in bookset:
+            rels.append( (d['title'], d['pubdate']) )
+        with self.write_lock:
+            return self._create("author", author, dob, rels)
+    
+    def book_create(self, title, pubdate, authorset):
+        rels = []
+        for d in authorset:
+            rels.append( (d['name'], d['dob']) )
+        with self.write_lock:
+            return self._create("book", title, pubdate, rels)
+    
+    def bulk_create(self, records):
+        a = []
+        with self.write_lock:
+            for side, idstr, date, rels in records:
+                a.append(self._create(side, idstr, date, rels))
+        return a
+    
+    def _create(self, side, idstr, date, rels):
+        # same contract as entity_create; callers hold write_lock
+        id_key = (str(idstr), int(date))
+        if len(rels) < 1:
+            return (False, False)
+        rels = list(set((str(r[0]), int(r[1])) for r in rels))
+        opposite = "book" if "author" == side else "author"
+        # links back first, then the entity itself
+        calls = {}
+        for i, pairs in self._by_shard((r, [id_key]) for r in rels).iteritems():
+            calls[i] = ("link", (opposite, pairs))
+        self._call(calls)
+        i = shard_of(id_key, len(self.addresses))
+        return self._call({i: ("link", (side, [(id_key, rels)]))})[i][0]
+    
+    def _delete(self, side, idstr, date):
+        id_key = (str(idstr), int(date))
+        opposite = "book" if "author" == side else "author"
+        with self.write_lock:
+            i = shard_of(id_key, len(self.addresses))
+            rels = self._call({i: ("remove", (side, id_key))})[i]
+            if rels is None:
+                return False
+            calls = {}
+            for i, pairs in self._by_shard((r, id_key) for r in rels).iteritems():
+                calls[i] = ("unlink", (opposite, pairs))
+            self._call(calls)
+        return True
+    
+    def _read(self, side, idstr, date):
+        id_key = (str(idstr), int(date))
+        i = shard_of(id_key, len(self.addresses))
+        return set(self._call({i: ("read", (side, id_key))})[i])
+    
+    
+    def read_many(self, keys):
+        # one request per shard, all at once
+        shards = self._by_shard((key, (i, side)) for i, (side, key) in enumerate(keys))
+        calls = dict((s, ("read_many", ([(side, key) for key, (i, side) in pairs],)))
+            for s, pairs in shards.iteritems())
+        a = [None] * len(keys)
+        for s, found in self._call(calls).iteritems():
+            for (key, (i, side)), rels in itertools.izip(shards[s], found):
+                a[i] = rels
         return a
+    
+    def author_read(self, author, dob):
+        return self._read("author", author, dob)
+    
+    def book_read(self, title, pubdate):
+        return self._read("book", title, pubdate)
+    
+    def author_read_items(self, author, dob):
+        return list(self.author_iter_items(author, dob))
+    
+    def book_read_items(self, title, pubdate):
+        return list(self.book_iter_items(title, pubdate))
+    
+    def author_iter_items(self, author, dob):
+        for i in self.author_read(author, dob):
+            yield {'title': i[0], 'pubdate': i[1]}
+    
+    def book_iter_items(self, title, pubdate):
+        for i in self.book_read(title, pubdate):
+            yield {'name': i[0], 'dob': i[1]}
+    
+    
+    def author_delete(self, author, dob):
+        return self._delete("author", author, dob)
+    
+    def book_delete(self, title, pubdate):
+        return self._delete("book", title, pubdate)
+    
+    
+    def _ranked(self, side, limit, min_count, after):
+        # [(key, count, stamp, shard)] in merged order after position after
+        calls = {}
+        for i in range(len(self.addresses)):
+            shard_after = None
+            if after is not None:
+                a_count, a_rest = after
+                if (not isinstance(a_rest, list) or len(a_rest) != 2 or
+                        not isinstance(a_rest[0], (int, long))):
+                    raise ValueError("bad position")
+                a_stamp, a_shard = a_rest
+                # ties on stamp go in shard order
+                if i > a_shard:
+                    a_stamp -= 1
+                shard_after = (a_count, a_stamp)
+            calls[i] = ("walk", (side, limit, min_count, shard_after))
+        results = self._call(calls)
+        merged = heapq.merge(*[[(-count, stamp, i, key) for key, count, stamp in results[i]]
+            for i in results])
+        return [(key, -count, stamp, i) for count, stamp, i, key
+            in itertools.islice(merged, limit)]
+    
+    def _page(self, side, limit, min_count, cursor):
+        after = decode_cursor(cursor, self.epoch)
+        if limit is None:
+            return (self._ranked(side, None, min_count, after), None)
+        a = self._ranked(side, limit + 1, min_count, after)
+        if len(a) <= limit:
+            return (a, None)
+        a = a[:limit]
+        key, count, stamp, i = a[-1]
+        return (a, encode_cursor(self.epoch, (count, [stamp, i])))
+    
+    def _iter(self, side, min_count, chunk_size=256):
+        after = None
+        while True:
+            a = self._ranked(side, chunk_size, min_count, after)
+            for row in a:
+                yield row
+            if len(a) < chunk_size:
+                return
+            key, count, stamp, i = a[-1]
+            after = (count, [stamp, i])
+    
+    def author_by_books(self):
+        return self.author_by_books_page()[0]
+    
+    def book_by_authors(self):
+        return self.book_by_authors_page()[0]
+    
+    def author_by_books_iter(self, min_count=1):
+        for key, count, stamp, i in self._iter("author", min_count):
+            yield {"name": key[0], "dob": key[1], "book_count": count}
+    
+    def book_by_authors_iter(self, min_count=1):
+        for key, count, stamp, i in self._iter("book", min_count):
+            yield {"title": key[0], "pubdate": key[1], "author_count": count}
+    
+    def author_by_books_page(self, limit=None, min_count=1, cursor=None):
+        t, cursor = self._page("author", limit, min_count, cursor)
+        a = []
+        for key, count, stamp, i in t:
+            a.append({"name": key[0], "dob": key[1], "book_count": count})
+        return (a, cursor)
+    
+    def book_by_authors_page(self, limit=None, min_count=1, cursor=None):
+        t, cursor = self._page("book", limit, min_count, cursor)
+        a = []
+        for key, count, stamp, i in t:
+            a.append({"title": key[0], "pubdate": key[1], "author_count": count})
+        return (a, cursor)
+
+
+
+# ------------------------------------------------------------
+# Replication
+# ------------------------------------------------------------
+
+"""
+A read replica is a BookAuthor over its own BookAuthorMemStorage, kept a
+copy of a leader's by a Follower: it loads the leader's GET /dump, then
+long-polls GET /changes from the version the dump was taken at and
+apply()s each change, which is safe on top of a dump that already has
+some of them. If the leader answers 410 (restarted, or the follower fell
+too far behind) it starts over from a fresh dump.
+
+lag() is how long since the follower last knew it had every write the
+leader had, so it's the staleness bound of what the replica serves: once
+it's over max_lag, reads get a 503 until the follower catches up. Writes
+always get a 405; they go to the leader.
+"""
+
+class Follower(object):
+    
+    def __init__(self, app, host, port, max_lag=10.0, wait=1.0, batch=1000,
+            changes=10000):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.max_lag = max_lag
+        # seconds a /changes poll waits on the leader, and at most how
+        # many changes it brings back; a leader that can't long-poll (its
+        # X-Changes-Max-Wait is 0) is short-polled this often instead
+        self.wait = wait
+        self.long_poll = True
+        self.batch = batch
+        # ChangeFeed size of each copy, so replicas can be followed too
+        self.changes = changes
+        self.epoch = None
+        # last leader write applied, and newest one the leader mentioned
+        self.seq = 0
+        self.latest = 0
+        # when we last had everything the leader did, None if never
+        self.fresh_at = None
+        self.bootstraps = 0
+        self.running = False
+        app.replica = self
+    
+    def lag(self):
+        if self.fresh_at is None:
+            return float('inf')
+        return time.time() - self.fresh_at
+    
+    def get(self, path):
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=self.wait + 30)
+        conn.request("GET", path, headers={"Accept": "application/json"})
+        return (conn, conn.getresponse())
+    
+    def bootstrap(self):
+        # a whole new copy from the leader's dump
+        storage = BookAuthorMemStorage(changes=self.changes)
+        conn, res = self.get("/dump")
+        try:
+            if 200 != res.status:
+                raise IOError("leader answered %d to /dump" % res.status)
+            epoch = res.getheader('X-Changes-Epoch')
+            seq = int(res.getheader('X-Changes-Latest'))
+            batch = []
+            lines = iter_body_lines({'wsgi.input': res, 'wsgi.input_terminated': True},
+                sys.maxint)
+            for line in lines:
+                batch.append(parse_entity_record(json.loads(line)))
+                if len(batch) >= self.app.bulk_batch:
+                    storage.bulk_create(batch)
+                    batch = []
+            storage.bulk_create(batch)
+        finally:
+            conn.close()
+        self.app.use_storage(storage)
+        self.epoch = epoch
+        self.seq = self.latest = seq
+        self.bootstraps += 1
+    
+    def poll(self):
+        # apply whatever the leader has had since seq, waiting up to wait
+        # seconds for something; True if that was all of it
+        conn, res = self.get("/changes?%s" % urllib.urlencode([("since", self.seq),
+            ("epoch", self.epoch), ("limit", self.batch),
+            ("wait", self.wait if self.long_poll else 0)]))
+        try:
+            if 410 == res.status:
+                self.bootstrap()
+                return False
+            if 200 != res.status:
+                raise IOError("leader answered %d to /changes" % res.status)
+            latest = int(res.getheader('X-Changes-Latest'))
+            self.long_poll = float(res.getheader('X-Changes-Max-Wait', 0)) > 0
+            rows = json.loads(res.read())
+        finally:
+            conn.close()
+        if not rows and not self.long_poll:
+            # the leader answered at once, so pause here rather than asking
+            # again straight away
+            time.sleep(self.wait)
+        storage = self.app.storage
+        for row in rows:
+            storage.apply(change_record(row))
+            self.seq = row["seq"]
+        self.latest = max(latest, self.seq)
+        if self.seq == self.latest:
+            self.fresh_at = time.time()
+            return True
+        return False
+    
+    def run(self, retry=1.0):
+        # keep up until stop(); trouble reaching the leader is retried,
+        # while lag() goes up
+        self.running = True
+        while self.running:
+            try:
+                if self.epoch is None:
+                    self.bootstrap()
+                self.poll()
+            except (IOError, ValueError, KeyError, TypeError, httplib.HTTPException), e:
+                sys.stderr.write("follower: %s\n" % (e,))
+                time.sleep(retry)
+    
+    def stop(self):
+        self.running = False
+    
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+        return t
+
+
+
+# ------------------------------------------------------------
+# Server
+# ------------------------------------------------------------
+
+"""
+wsgiref's server handles one request at a time. ThreadPoolWSGIServer hands
+accepted connections to a fixed pool of worker threads instead, so slow
+clients and long streamed responses don't hold everyone else up. Storage
+engines do their own locking.
+"""
+
+class ThreadPoolWSGIServer(wsgiref.simple_server.WSGIServer):
+    threads = 8
+    daemon_threads = True
+    
+    def server_activate(self):
+        wsgiref.simple_server.WSGIServer.server_activate(self)
+        self.requests = Queue.Queue(self.threads * 4)
+        self.workers = []
+        for n in range(self.threads):
+            t = threading.Thread(target=self.work)
+            t.daemon = self.daemon_threads
+            t.start()
+            self.workers.append(t)
+    
+    def process_request(self, request, client_address):
+        # blocks accepting once every worker is busy and the queue is full
+        self.requests.put((request, client_address))
+    
+    def work(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+    
+    def server_close(self):
+        wsgiref.simple_server.WSGIServer.server_close(self)
+        for t in self.workers:
+            self.requests.put(None)
+        for t in self.workers:
+            t.join()
+
+
+def prefork(httpd, processes):
+    # serve httpd's listening socket from that many child processes, which
+    # take turns accepting; returns their pids
+    children = []
+    for i in range(processes):
+        pid = os.fork()
+        if 0 == pid:
+            try:
+                httpd.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    return children
+
+
+def make_threaded_server(host, port, app, threads=8):
+    class Server(ThreadPoolWSGIServer):
+        pass
+    Server.threads = threads
+    return wsgiref.simple_server.make_server(host, port, app,
+        server_class=Server)
+
+
+
+"""
+AsyncHTTPServer serves the same app from one thread with asyncore, for lots
+of mostly idle keep-alive connections. Requests are parsed here into a WSGI
+environ and handed to the app as-is, so routing stays in BookAuthor.
+
+HTTP/1.1 connections stay open unless the client says otherwise, and
+pipelined requests are answered in order. Responses of unknown length go
+out chunked (or close the connection, for HTTP/1.0). The app runs on the
+loop thread, so a slow storage engine holds up every connection.
+"""
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    
+    def __init__(self, host, port, app, max_request=1 << 26, max_header=1 << 16,
+            backlog=1024):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.app = app
+        self.max_request = max_request
+        self.max_header = max_header
+        self.running = False
+        self.added = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.server_name, self.server_port = self.socket.getsockname()[:2]
+    
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.added.append(AsyncHTTPChannel(self, pair[0], pair[1]))
+    
+    def serve_forever(self, poll_interval=0.5):
+        # asyncore.loop asks every channel what it's waiting for on every
+        # turn, which adds up with thousands of idle ones; here a channel is
+        # only asked again after it had an event, the poller keeps the rest
+        if hasattr(select, 'epoll'):
+            poller = select.epoll()
+            timeout = poll_interval
+        else:
+            poller = select.poll()
+            timeout = poll_interval * 1000
+        registered = {}
+        self.added = [self]
+        self.running = True
+        while self.running:
+            for fd in registered.viewkeys() - self.map.viewkeys():
+                poll_unregister(poller, fd)
+                del registered[fd]
+            added, self.added = self.added, []
+            for obj in added:
+                fd = obj._fileno
+                if self.map.get(fd) is obj:
+                    # fd may be a closed channel's, still registered
+                    poll_unregister(poller, fd)
+                    registered[fd] = (obj, poll_mask(obj))
+                    poller.register(fd, registered[fd][1])
+            for fd, flags in poller.poll(timeout):
+                obj, mask = registered.get(fd, (None, 0))
+                if obj is None or self.map.get(fd) is not obj:
+                    continue
+                asyncore.readwrite(obj, flags)
+                if self.map.get(fd) is obj and poll_mask(obj) != mask:
+                    registered[fd] = (obj, poll_mask(obj))
+                    poller.modify(fd, registered[fd][1])
+        poller.close()
+    
+    def shutdown(self):
+        self.running = False
+    
+    def server_close(self):
+        asyncore.close_all(self.map)
+
+
+def poll_mask(obj):
+    mask = 0
+    if obj.readable():
+        mask |= select.POLLIN | select.POLLPRI
+    if obj.writable() and not obj.accepting:
+        mask |= select.POLLOUT
+    return mask
+
+
+def poll_unregister(poller, fd):
+    # epoll forgets closed fds by itself
+    try:
+        poller.unregister(fd)
+    except (EnvironmentError, KeyError):
+        pass
+
+
+class AsyncHTTPChannel(asynchat.async_chat):
+    # one client connection; reads a head, then a body, then dispatches
+    
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        # the head and body go out as separate sends
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = server
+        self.addr = addr
+        self.data = []
+        self.size = 0
+        self.environ = None
+        self.closing = False
+        self.set_terminator('\r\n\r\n')
+    
+    def collect_incoming_data(self, data):
+        if self.closing:
+            return
+        self.data.append(data)
+        self.size += len(data)
+        if self.environ is None and self.size > self.server.max_header:
+            self.error('431 Request Header Fields Too Large')
+    
+    def found_terminator(self):
+        if self.closing:
+            return
+        data = ''.join(self.data)
+        self.data = []
+        self.size = 0
+        if self.environ is not None:
+            self.respond(data)
+            return
+        try:
+            self.environ = self.parse_head(data)
+        except ValueError:
+            self.error('400 Bad Request')
+            return
+        environ = self.environ
+        if 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            self.error('411 Length Required')
+            return
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self.error('400 Bad Request')
+            return
+        if length > self.server.max_request:
+            self.error('413 Request Entity Too Large')
+            return
+        if length <= 0:
+            self.respond('')
+            return
+        if '100-continue' == environ.get('HTTP_EXPECT', '').lower():
+            self.push('HTTP/1.1 100 Continue\r\n\r\n')
+        self.set_terminator(length)
+    
+    def parse_head(self, data):
+        lines = data.lstrip('\r\n').split('\r\n')
+        method, target, version = lines[0].split(' ')
+        if not version.startswith('HTTP/1.'):
+            raise ValueError(version)
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': self.server.server_name,
+            'SERVER_PORT': str(self.server.server_port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': self.addr[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'wsgi.input_terminated': True,
+        }
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise ValueError(line)
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            elif 'HTTP_' + name in environ:
+                environ['HTTP_' + name] += ',' + value
+            else:
+                environ['HTTP_' + name] = value
+        return environ
+    
+    def respond(self, body):
+        environ = self.environ
+        self.environ = None
+        self.set_terminator('\r\n\r\n')
+        environ['wsgi.input'] = cStringIO.StringIO(body)
+        version = environ['SERVER_PROTOCOL']
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if 'HTTP/1.0' == version:
+            keep_alive = 'keep-alive' in connection
+        else:
+            keep_alive = 'close' not in connection
+        
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+        try:
+            result = self.server.app(environ, start_response)
+            if isinstance(result, (list, tuple)):
+                data = ''.join(result)
+                chunks = iter([data])
+                length = len(data)
+            else:
+                # peek, so start_response has been called
+                first = next(iter(result), '')
+                chunks = itertools.chain([first], result)
+                length = None
+        except Exception:
+            nil, t, v, tbinfo = asyncore.compact_traceback()
+            self.log_info('app raised %s:%s %s' % (t, v, tbinfo), 'error')
+            self.error('500 Internal Server Error')
+            return
+        
+        status, headers = started
+        names = set(name.lower() for name, value in headers)
+        head = ['%s %s' % (version, status)]
+        head.extend('%s: %s' % h for h in headers)
+        chunked = False
+        if 'content-length' not in names:
+            if length is not None:
+                head.append('Content-Length: %d' % length)
+            elif 'HTTP/1.0' == version:
+                # only the end of the connection marks the end of the body
+                keep_alive = False
+            else:
+                head.append('Transfer-Encoding: chunked')
+                chunked = True
+        if 'HTTP/1.0' == version and keep_alive:
+            head.append('Connection: keep-alive')
+        elif not keep_alive:
+            head.append('Connection: close')
+        self.push('\r\n'.join(head) + '\r\n\r\n')
+        self.push_with_producer(BodyProducer(chunks, chunked, getattr(result, 'close', None)))
+        if not keep_alive:
+            self.finish()
+    
+    def error(self, status):
+        # answer and hang up, ignoring anything else the client sent
+        body = status + '\n'
+        self.push('HTTP/1.1 %s\r\nContent-Type: text/plain\r\n'
+            'Content-Length: %d\r\nConnection: close\r\n\r\n%s'
+            % (status, len(body), body))
+        self.finish()
+    
+    def finish(self):
+        self.closing = True
+        self.data = []
+        self.set_terminator(None)
+        self.close_when_done()
+
+
+class BodyProducer(object):
+    # asynchat producer over a response iterable, chunk-framed if asked
+    
+    def __init__(self, chunks, chunked, close=None):
+        self.chunks = chunks
+        self.chunked = chunked
+        self.close = close
+        self.done = False
+    
+    def more(self):
+        if self.done:
+            return ''
+        for data in self.chunks:
+            if data:
+                if self.chunked:
+                    return '%x\r\n%s\r\n' % (len(data), data)
+                return data
+        self.done = True
+        if self.close is not None:
+            self.close()
+        if self.chunked:
+            return '0\r\n\r\n'
+        return ''
 
 
 
@@ -339,18 +4621,121 @@ if __name__ == "__main__":
     
     # Non-cgi ONLY - status printing for WSGI servers
     #"""
-    server_address = sys.argv[1]
-    server_port = int(sys.argv[2])
+    import argparse
+    parser = argparse.ArgumentParser(description="Book / author JSON REST API")
+    parser.add_argument("address")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--log", metavar="PATH",
+        help="keep a write-ahead log here and load it on startup")
+    parser.add_argument("--sync-every", type=int, default=1, metavar="N",
+        help="fsync the log once per N writes (default 1)")
+    parser.add_argument("--sync-interval", type=float, metavar="SECONDS",
+        help="also fsync pending log writes at least this often")
+    parser.add_argument("--snapshot", metavar="PATH",
+        help="start from this snapshot file if it exists")
+    parser.add_argument("--snapshot-every", type=int, metavar="N",
+        help="rewrite the snapshot and empty the log every N writes")
+    parser.add_argument("--changes", type=int, default=10000, metavar="N",
+        help="keep the last N writes for GET /changes (default 10000, 0 for none)")
+    parser.add_argument("--compact", action="store_true",
+        help="use the compact in-memory storage (no log or snapshots)")
+    parser.add_argument("--sqlite", metavar="PATH",
+        help="keep everything in this SQLite file instead of in memory")
+    parser.add_argument("--cache-mb", type=int, default=32, metavar="MB",
+        help="keep up to this much encoded GET responses (default 32, 0 for none)")
+    parser.add_argument("--threads", type=int, default=1, metavar="N",
+        help="handle requests on a pool of N threads (default 1)")
+    parser.add_argument("--async", action="store_true",
+        help="serve every connection from one event loop, with keep-alive")
+    parser.add_argument("--processes", type=int, default=1, metavar="N",
+        help="serve from N forked processes over sharded storage")
+    parser.add_argument("--shards", type=int, metavar="N",
+        help="split the storage over N shard processes (default --processes)")
+    parser.add_argument("--follow", metavar="HOST:PORT",
+        help="serve reads as a replica of the server at HOST:PORT")
+    parser.add_argument("--max-lag", type=float, default=10.0, metavar="SECONDS",
+        help="a replica answers 503 once this far behind (default 10)")
+    parser.add_argument("--profile", type=float, default=0.0, metavar="FRACTION",
+        help="profile this fraction of requests, see /admin/profile")
+    parser.add_argument("--profile-header", metavar="NAME",
+        help="also profile any request that sends this header")
+    args = parser.parse_args()
+    if args.snapshot_every and not args.snapshot:
+        parser.error("--snapshot-every needs --snapshot")
+    if args.async and args.threads > 1:
+        parser.error("--async and --threads don't mix")
+    if (args.compact or args.sqlite) and (args.log or args.snapshot):
+        parser.error("only the default storage can be logged or snapshotted")
+    sharded = args.processes > 1 or args.shards
+    if sharded and (args.compact or args.sqlite or args.log or args.snapshot):
+        parser.error("sharded storage has no other storage options")
+    if args.processes > 1 and args.threads > 1:
+        parser.error("--processes and --threads don't mix")
+    if args.follow and (sharded or args.compact or args.sqlite or args.log or args.snapshot):
+        parser.error("a replica keeps its copy in memory, with no other storage options")
+    if args.follow and ':' not in args.follow:
+        parser.error("--follow needs HOST:PORT")
+    server_address = args.address
+    server_port = args.port
     server_pair = (server_address, server_port)
+    log = None
+    if args.log:
+        log = MutationLog(args.log, args.sync_every, args.sync_interval)
+    if sharded:
+        import tempfile
+        import shutil
+        shard_dir = tempfile.mkdtemp(prefix="book_author")
+        shards = start_shards(args.shards or args.processes, shard_dir)
+        storage = BookAuthorShardedStorage([shard.address for shard in shards],
+            shards[0].authkey, multiprocessing.Lock())
+    elif args.follow:
+        # replaced by the Follower's copy
+        storage = None
+    elif args.compact:
+        storage = BookAuthorCompactStorage()
+    elif args.sqlite:
+        storage = BookAuthorSQLiteStorage(args.sqlite)
+    else:
+        storage = BookAuthorMemStorage(log, args.snapshot, args.snapshot_every,
+            args.changes)
     print "Serving on port %s..." % server_port
     #"""
     
     #wsgiref server
     #"""
-    print "using wsgiref"
-    import wsgiref.simple_server
-    httpd = wsgiref.simple_server.make_server(server_address, server_port, BookAuthor())
-    httpd.serve_forever()
+    # long-polling /changes holds a thread, only worth it with a pool of them
+    application = BookAuthor(storage=storage, cache_bytes=args.cache_mb << 20,
+        max_wait=30 if args.threads > 1 else 0)
+    if args.follow:
+        leader_host, leader_port = args.follow.rsplit(':', 1)
+        print "following %s" % args.follow
+        Follower(application, leader_host, int(leader_port), args.max_lag,
+            changes=args.changes).start()
+    if args.profile or args.profile_header:
+        application = ProfilingMiddleware(application, args.profile,
+            args.profile_header)
+    if args.async:
+        print "using asyncore"
+        httpd = AsyncHTTPServer(server_address, server_port, application)
+    elif args.threads > 1:
+        print "using wsgiref"
+        httpd = make_threaded_server(server_address, server_port,
+            application, args.threads)
+    else:
+        print "using wsgiref"
+        httpd = wsgiref.simple_server.make_server(server_address, server_port,
+            application)
+    try:
+        if args.processes > 1:
+            for pid in prefork(httpd, args.processes):
+                os.waitpid(pid, 0)
+        else:
+            httpd.serve_forever()
+    finally:
+        if log is not None:
+            log.close()
+        if sharded:
+            shutil.rmtree(shard_dir, True)
     #"""
 
 
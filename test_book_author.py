@@ -5,6 +5,10 @@ import book_author
 
 import unittest
 import json
+import os
+import shutil
+import tempfile
+import time
 
 # WebTest - http://webtest.pythonpaste.org/en/latest/index.html
 # $ easy_install WebTest
@@ -164,6 +168,82 @@ class TestBookAuthorAcceptance(unittest.TestCase):
         self.assertEqual(res.json, [q2, q1])
     
     
+    def test_url_author_by_books_pages(self):
+        # walk a ranking one page at a time by following Link headers
+        for i in range(5):
+            b = [{"title": "b%d" % j, "pubdate": 1} for j in range(i + 1)]
+            self.app.put('/author/a%d/1' % i, json.dumps(b), content_type=self.ctype)
+        q_url = '/query/author_by_books?limit=2'
+        names = []
+        while q_url is not None:
+            res = self.app.get(q_url, status=200)
+            self.assertTrue(len(res.json) <= 2)
+            names.extend(d['name'] for d in res.json)
+            q_url = None
+            link = res.headers.get('Link')
+            if link is not None:
+                q_url = link[1:link.index('>')]
+        self.assertEqual(names, ['a4', 'a3', 'a2', 'a1', 'a0'])
+        
+        res = self.app.get('/query/author_by_books?min_count=4')
+        self.assertEqual([d['book_count'] for d in res.json], [5, 4])
+        res = self.app.get('/query/author_by_books?min_count=6', status=404)
+        self.assertEqual(res.json, [])
+        res = self.app.get('/query/author_by_books?limit=zero', status=400)
+        res = self.app.get('/query/author_by_books?cursor=bogus', status=400)
+        # a cursor from before a restart is gone, not somewhere else
+        link = self.app.get('/query/author_by_books?limit=2').headers['Link']
+        self.app.app.storage.epoch = "restarted"
+        self.app.get(link[1:link.index('>')], status=410)
+    
+    
+    def test_url_streamed_get(self):
+        # GETs come back as a generator, encoded a chunk at a time
+        app = book_author.BookAuthor(chunk_size=2)
+        b = [{"title": "b%d" % j, "pubdate": j} for j in range(5)]
+        app.storage.author_create("a1", 1, b)
+        environ = {'PATH_INFO': '/author/a1/1', 'REQUEST_METHOD': 'GET'}
+        out = app(environ, lambda status, headers: None)
+        self.assertFalse(isinstance(out, list))
+        chunks = list(out)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(sorted(json.loads(''.join(chunks))), sorted(b))
+        res = webtest.TestApp(app).get('/query/book_by_authors')
+        self.assertEqual(len(res.json), 5)
+    
+    
+    def test_url_ndjson(self):
+        b1 = [{"title": "The Republic", "pubdate": -360}]
+        self.app.put('/author/Plato/-424', json.dumps(b1), content_type=self.ctype)
+        accept = {'Accept': 'application/x-ndjson'}
+        res = self.app.get('/author/Plato/-424', headers=accept)
+        self.assertEqual(res.content_type, 'application/x-ndjson')
+        self.assertEqual([json.loads(l) for l in res.body.splitlines()], b1)
+        res = self.app.get('/query/author_by_books', headers=accept)
+        self.assertEqual([json.loads(l) for l in res.body.splitlines()],
+            [{"name": "Plato", "dob": -424, "book_count": 1}])
+    
+    
+    def test_url_accept(self):
+        b1 = [{"title": "The Republic", "pubdate": -360}]
+        path = '/author/Plato/-424'
+        self.app.put(path, json.dumps(b1), content_type=self.ctype)
+        # compact unless asked otherwise
+        res = self.app.get(path)
+        self.assertEqual(res.content_type, 'application/json')
+        self.assertEqual(res.json, b1)
+        self.assertFalse(' ' in res.body.replace('The Republic', ''))
+        res = self.app.get(path, headers={'Accept': 'application/json; indent=4'})
+        self.assertTrue('\n    ' in res.body)
+        self.assertEqual(res.json, b1)
+        # q-values pick between offered types
+        res = self.app.get(path, headers={'Accept': 'application/json;q=0.5, application/cbor'})
+        self.assertEqual(res.content_type, 'application/cbor')
+        res = self.app.get(path, headers={'Accept': 'text/html'}, status=406)
+        res = self.app.get(path, headers={'Accept': 'text/html, */*;q=0.1'})
+        self.assertEqual(res.json, b1)
+    
+    
     def test_url_author_post(self):
         # Test POST an entity url - /entity/idstr/date/
         b1 = [{"title": "The Visual Display of Quantitative Information", "pubdate": 1983}]
@@ -174,6 +254,86 @@ class TestBookAuthorAcceptance(unittest.TestCase):
         self.assertEqual(res.json, b1)
     
     
+    def test_url_body_limits(self):
+        app = webtest.TestApp(book_author.BookAuthor(max_body=64))
+        a1_url = '/author/Edward R. Tufte/1942'
+        b1 = [{"title": "The Visual Display of Quantitative Information", "pubdate": 1983}]
+        res = app.put(a1_url, json.dumps(b1), content_type=self.ctype, status=413)
+        res = app.get(a1_url, status=404)
+        res = app.put(a1_url, '[{"title": ', content_type=self.ctype, status=400)
+        b2 = [{"title": "Envisioning Information", "pubdate": 1990}]
+        res = app.put(a1_url, json.dumps(b2),
+            content_type=self.ctype + '; charset=utf-8', status=201)
+        self.assertEqual(res.json, b2)
+    
+    
+    def test_url_bulk(self):
+        lines = [
+            {"name": "Plato", "dob": -424, "books": [{"title": "The Republic", "pubdate": -360}]},
+            {"title": "Envisioning Information", "pubdate": 1990,
+                "authors": [{"name": "Edward R. Tufte", "dob": 1942}]},
+            {"name": "Edward R. Tufte", "dob": 1942,
+                "books": [{"title": "Envisioning Information", "pubdate": 1990},
+                    {"title": "Visual Explanations", "pubdate": 1997}]},
+            {"name": "Nobody", "dob": 1900, "books": []},
+            {"title": "No Year", "authors": [{"name": "Plato", "dob": -424}]},
+        ]
+        body = '\n'.join(json.dumps(d) for d in lines) + '\n\nnot json\n'
+        ndjson = "application/x-ndjson"
+        app = webtest.TestApp(book_author.BookAuthor(bulk_batch=2))
+        res = app.post('/bulk', body, content_type=ndjson)
+        self.assertEqual(res.json,
+            {"lines": 6, "created": 2, "updated": 1, "rejected": 3})
+        res = app.get('/author/Edward R. Tufte/1942')
+        self.assertEqual(len(res.json), 2)
+        res = app.get('/book/The Republic/-360')
+        self.assertEqual(res.json, [{"name": "Plato", "dob": -424}])
+        res = app.post('/bulk', body, content_type=self.ctype, status=406)
+        # non-ASCII names land where the path routes find them
+        line = {"name": u"Garc\u00eda M\u00e1rquez", "dob": 1927,
+            "books": [{"title": u"Cien a\u00f1os de soledad", "pubdate": 1967}]}
+        res = app.post('/bulk', json.dumps(line), content_type=ndjson)
+        self.assertEqual(res.json["created"], 1)
+        res = app.get('/author/Garc%C3%ADa M%C3%A1rquez/1927')
+        self.assertEqual(res.json, line["books"])
+    
+    
+    def test_url_read(self):
+        self.app.put('/author/Edward R. Tufte/1942', json.dumps([
+            {"title": "Envisioning Information", "pubdate": 1990},
+            {"title": "Visual Explanations", "pubdate": 1997}]), content_type=self.ctype)
+        self.app.put('/author/Plato/-424', json.dumps([{"title": "The Republic", "pubdate": -360}]),
+            content_type=self.ctype)
+        keys = [{"title": "The Republic", "pubdate": -360},
+            {"name": "Edward R. Tufte", "dob": 1942},
+            {"name": "Nobody", "dob": 1900},
+            {"title": "Visual Explanations", "pubdate": 1997}]
+        res = self.app.post('/read', json.dumps(keys), content_type=self.ctype)
+        self.assertEqual(len(res.json), 4)
+        self.assertEqual(res.json[0], {"title": "The Republic", "pubdate": -360,
+            "authors": [{"name": "Plato", "dob": -424}]})
+        self.assertEqual(res.json[1]["name"], "Edward R. Tufte")
+        self.assertEqual(sorted(res.json[1]["books"]),
+            sorted(self.app.get('/author/Edward R. Tufte/1942').json))
+        # missing keys are marked, not a 404
+        self.assertEqual(res.json[2], {"name": "Nobody", "dob": 1900, "books": None})
+        self.assertEqual(res.json[3]["authors"], [{"name": "Edward R. Tufte", "dob": 1942}])
+        # non-ASCII keys are found as the path routes stored them
+        self.app.put('/author/Garc%C3%ADa/1927', json.dumps([{"title": "Cien", "pubdate": 1967}]),
+            content_type=self.ctype)
+        res = self.app.post('/read', json.dumps([{"name": u"Garc\u00eda", "dob": 1927},
+            {"name": "Plato", "dob": -424}]), content_type=self.ctype)
+        self.assertEqual(res.json[0], {"name": u"Garc\u00eda", "dob": 1927,
+            "books": [{"title": "Cien", "pubdate": 1967}]})
+        self.assertEqual(len(res.json[1]["books"]), 1)
+        self.app.post('/read', json.dumps([]), content_type=self.ctype, status=400)
+        self.app.post('/read', json.dumps([{"name": "No Year"}]), content_type=self.ctype,
+            status=400)
+        self.app.post('/read', json.dumps({"name": "Plato", "dob": -424}),
+            content_type=self.ctype, status=400)
+        self.app.get('/read', status=405)
+    
+    
     def test_some_bad_requests(self):
         # Clearly not internet-strength, but some accident safety
         b1 = [{"title": "The Visual Display of Quantitative Information", "pubdate": 1983}]
@@ -192,6 +352,816 @@ class TestBookAuthorAcceptance(unittest.TestCase):
 
 
 
+class TestBookAuthorAcceptanceCompact(TestBookAuthorAcceptance):
+    # the same API over the compact storage
+    
+    def setUp(self):
+        storage = book_author.BookAuthorCompactStorage()
+        self.app = webtest.TestApp(book_author.BookAuthor(storage=storage))
+        self.ctype = "application/json"
+
+
+
+
+class TestBookAuthorAcceptanceSQLite(TestBookAuthorAcceptance):
+    # and over SQLite
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = book_author.BookAuthorSQLiteStorage(os.path.join(self.dir, 'ba.db'))
+        self.app = webtest.TestApp(book_author.BookAuthor(storage=self.storage))
+        self.ctype = "application/json"
+    
+    
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.dir)
+
+
+
+
+def start_shard_threads(directory, n):
+    # ShardServers on threads rather than processes, for tests
+    import threading
+    servers = []
+    for i in range(n):
+        server = book_author.ShardServer(os.path.join(directory, 'shard%d' % i))
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        servers.append(server)
+    return servers
+
+
+
+
+class TestBookAuthorAcceptanceSharded(TestBookAuthorAcceptance):
+    # and over three shards
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = start_shard_threads(self.dir, 3)
+        self.storage = book_author.BookAuthorShardedStorage(
+            [server.address for server in self.servers])
+        self.app = webtest.TestApp(book_author.BookAuthor(storage=self.storage))
+        self.ctype = "application/json"
+    
+    
+    def tearDown(self):
+        self.storage.close()
+        for server in self.servers:
+            server.shutdown()
+        shutil.rmtree(self.dir)
+
+
+
+
+class TestConditionalGet(unittest.TestCase):
+    
+    def setUp(self):
+        self.app = webtest.TestApp(book_author.BookAuthor())
+        self.ctype = "application/json"
+    
+    
+    def test_entity_etag(self):
+        a1_url = '/author/Edward R. Tufte/1942'
+        b1_url = '/book/Envisioning Information/1990'
+        b1 = [{"title": "Envisioning Information", "pubdate": 1990}]
+        b2 = [{"title": "The Visual Display of Quantitative Information", "pubdate": 1983}]
+        self.app.get(a1_url, status=404)
+        self.app.put(a1_url, json.dumps(b1), content_type=self.ctype, status=201)
+        res = self.app.get(a1_url)
+        etag = res.headers['ETag']
+        self.assertTrue(etag.startswith('"'))
+        res = self.app.get(a1_url, headers={'If-None-Match': etag}, status=304)
+        self.assertEqual(res.body, '')
+        self.assertEqual(res.headers['ETag'], etag)
+        self.app.get(a1_url, headers={'If-None-Match': 'W/' + etag}, status=304)
+        # a PUT that changes nothing keeps it
+        self.app.put(a1_url, json.dumps(b1), content_type=self.ctype, status=200)
+        self.app.get(a1_url, headers={'If-None-Match': etag}, status=304)
+        # a new link changes both ends
+        b1_etag = self.app.get(b1_url).headers['ETag']
+        self.app.put('/book/Envisioning Information/1990',
+            json.dumps([{"name": "Plato", "dob": -424}]), content_type=self.ctype)
+        self.app.get(a1_url, headers={'If-None-Match': etag}, status=304)
+        self.app.get(b1_url, headers={'If-None-Match': b1_etag}, status=200)
+        self.app.put(a1_url, json.dumps(b2), content_type=self.ctype, status=200)
+        res = self.app.get(a1_url, headers={'If-None-Match': etag}, status=200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+        # and a different representation has a different tag
+        res = self.app.get(a1_url, headers={'Accept': 'application/x-ndjson'})
+        self.assertNotEqual(res.headers['ETag'], etag)
+        self.app.delete(a1_url)
+        self.app.get(a1_url, headers={'If-None-Match': etag}, status=404)
+    
+    
+    def test_query_etag(self):
+        url = '/query/author_by_books'
+        self.app.put('/author/Plato/-424', json.dumps([{"title": "The Republic", "pubdate": -360}]),
+            content_type=self.ctype)
+        etag = self.app.get(url).headers['ETag']
+        self.app.get(url, headers={'If-None-Match': '"other", ' + etag}, status=304)
+        self.app.delete('/book/The Republic/-360')
+        self.app.get(url, headers={'If-None-Match': etag}, status=404)
+    
+    
+    def test_no_versions(self):
+        # storage without versions, no ETags
+        app = webtest.TestApp(book_author.BookAuthor(
+            storage=book_author.BookAuthorCompactStorage()))
+        app.put('/author/Plato/-424', json.dumps([{"title": "The Republic", "pubdate": -360}]),
+            content_type=self.ctype)
+        res = app.get('/author/Plato/-424', headers={'If-None-Match': '*'})
+        self.assertFalse('ETag' in res.headers)
+
+
+
+
+class TestResponseCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.ba = book_author.BookAuthor()
+        self.cache = self.ba.cache
+        self.app = webtest.TestApp(self.ba)
+        self.ctype = "application/json"
+        self.app.put('/author/Edward R. Tufte/1942', json.dumps([
+            {"title": "Envisioning Information", "pubdate": 1990},
+            {"title": "Beautiful Evidence", "pubdate": 2006}]), content_type=self.ctype)
+    
+    
+    def test_hit(self):
+        url = '/author/Edward R. Tufte/1942'
+        res1 = self.app.get(url)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 1))
+        res2 = self.app.get(url)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(res2.body, res1.body)
+        self.assertEqual(res2.headers['ETag'], res1.headers['ETag'])
+        # another encoding is another entry
+        self.app.get(url, headers={'Accept': 'application/cbor'})
+        self.assertEqual(len(self.cache), 2)
+    
+    
+    def test_invalidation(self):
+        a_url = '/author/Edward R. Tufte/1942'
+        b_url = '/book/Beautiful Evidence/2006'
+        other_url = '/book/Envisioning Information/1990'
+        q_url = '/query/book_by_authors?limit=1'
+        for url in (a_url, b_url, other_url, q_url):
+            self.app.get(url)
+        self.assertEqual(len(self.cache), 4)
+        # the book, its new author and the queries; Tufte's books are the same
+        self.app.put(b_url, json.dumps([{"name": "Plato", "dob": -424}]),
+            content_type=self.ctype)
+        self.assertEqual(sorted(self.cache.entries.keys()),
+            [(("author", ("Edward R. Tufte", 1942)), "json"),
+            (("book", ("Envisioning Information", 1990)), "json")])
+        res = self.app.get(b_url)
+        self.assertEqual(len(res.json), 2)
+        res = self.app.get(q_url)
+        self.assertEqual(res.json[0]["author_count"], 2)
+        self.assertTrue('Link' in res.headers)
+        self.assertEqual(self.app.get(q_url).headers['Link'], res.headers['Link'])
+        self.app.delete(a_url)
+        self.app.get(a_url, status=404)
+        self.app.get(other_url, status=404)
+    
+    
+    def test_stale_entry(self):
+        # an entry put under an ETag that's since moved on is never served
+        url = '/author/Edward R. Tufte/1942'
+        etag = self.app.get(url).headers['ETag']
+        key = self.cache.entries.keys()[0]
+        self.cache.put(key, '"old"', [], 'stale')
+        self.assertEqual(self.app.get(url).headers['ETag'], etag)
+        self.assertNotEqual(self.app.get(url).body, 'stale')
+    
+    
+    def test_eviction(self):
+        cache = book_author.ResponseCache(100, max_entry=40)
+        for i in range(5):
+            cache.put(((i, None), "json"), '"1"', [], 'x' * 30)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(cache.size, 90)
+        # used recently, kept
+        self.assertNotEqual(cache.get(((2, None), "json"), '"1"'), None)
+        cache.put(((5, None), "json"), '"1"', [], 'x' * 30)
+        self.assertEqual(cache.get(((3, None), "json"), '"1"'), None)
+        self.assertNotEqual(cache.get(((2, None), "json"), '"1"'), None)
+        cache.put(((6, None), "json"), '"1"', [], 'x' * 50)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(list(cache.collect(((7, None), "json"), '"1"', [], ['x' * 30] * 2)),
+            ['x' * 30] * 2)
+        self.assertEqual(len(cache), 3)
+        cache.drop((2, None))
+        self.assertEqual(cache.size, 60)
+
+
+
+
+class TestRouting(unittest.TestCase):
+    
+    def setUp(self):
+        self.app = webtest.TestApp(book_author.BookAuthor())
+    
+    
+    def test_method_not_allowed(self):
+        res = self.app.post('/query/author_by_books', status=405)
+        self.assertEqual(res.headers['Allow'], 'GET')
+        res = self.app.get('/bulk', status=405)
+        self.assertEqual(res.headers['Allow'], 'POST')
+        res = self.app.request('/author/Plato/-424', method='PATCH', status=405)
+        self.assertEqual(res.headers['Allow'], 'DELETE, GET, POST, PUT')
+    
+    
+    def test_not_found(self):
+        self.app.get('/author/Plato', status=404)
+        self.app.get('/author/Plato/-424/extra', status=404)
+        self.app.get('/query/nothing', status=404)
+        self.app.get('/', status=404)
+    
+    
+    def test_slashes(self):
+        self.app.put('/author/Plato/-424/', json.dumps([{"title": "The Republic", "pubdate": -360}]),
+            content_type="application/json", status=201)
+        self.app.get('//author/Plato//-424', status=200)
+        self.app.get('/query/author_by_books/', status=200)
+    
+    
+    def test_router(self):
+        class Target(object):
+            def a(self):
+                pass
+        router = book_author.Router([
+            book_author.Route("/x/{p}", {"GET": "a"}),
+            book_author.Route("/y/one", {"GET": "a"}),
+            book_author.Route("/y/two", {"PUT": "a"}),
+        ], Target())
+        route, params = router.match('/x/1')
+        self.assertEqual(params, ['1'])
+        route, params = router.match('/y/two')
+        self.assertEqual((route.allow, params), ('PUT', []))
+        self.assertEqual(router.match('/y/three'), (None, None))
+        self.assertRaises(ValueError, book_author.Router, [
+            book_author.Route("/x/{p}", {"GET": "a"}),
+            book_author.Route("/x/one", {"GET": "a"})], Target())
+        self.assertRaises(ValueError, book_author.Route, "/x/{p}/y", {})
+
+
+
+
+class TestMetrics(unittest.TestCase):
+    
+    def setUp(self):
+        self.ba = book_author.BookAuthor()
+        self.app = webtest.TestApp(self.ba)
+        self.ctype = "application/json"
+    
+    
+    def metrics(self):
+        # {name{labels}: value} from GET /metrics
+        res = self.app.get('/metrics')
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        samples = {}
+        for line in res.body.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+    
+    
+    def test_requests(self):
+        url = '/author/Edward R. Tufte/1942'
+        self.app.put(url, json.dumps([{"title": "Envisioning Information", "pubdate": 1990}]),
+            content_type=self.ctype, status=201)
+        self.app.get(url)
+        self.app.get(url)
+        self.app.get('/author/Nobody/1', status=404)
+        self.app.get('/nowhere', status=404)
+        self.app.request('/query/author_by_books', method="OPTIONS", status=405)
+        m = self.metrics()
+        route = 'route="/author/{name}/{dob}"'
+        self.assertEqual(m['bookauthor_http_requests_total{method="GET",%s,status="200"}' % route], 2)
+        self.assertEqual(m['bookauthor_http_requests_total{method="GET",%s,status="404"}' % route], 1)
+        self.assertEqual(m['bookauthor_http_requests_total{method="PUT",%s,status="201"}' % route], 1)
+        self.assertEqual(m['bookauthor_http_requests_total{method="GET",route="",status="404"}'], 1)
+        self.assertEqual(m['bookauthor_http_requests_total{method="other",'
+            'route="/query/author_by_books",status="405"}'], 1)
+        # buckets are cumulative, the last one is everything
+        name = 'bookauthor_http_request_duration_seconds'
+        self.assertEqual(m['%s_bucket{le="+Inf",method="GET",%s}' % (name, route)], 3)
+        self.assertEqual(m['%s_count{method="GET",%s}' % (name, route)], 3)
+        self.assertTrue(m['%s_bucket{le="0.0005",method="GET",%s}' % (name, route)] <= 3)
+        name = 'bookauthor_http_request_size_bytes'
+        self.assertEqual(m['%s_bucket{le="64",method="PUT",%s}' % (name, route)], 1)
+        self.assertTrue(m['%s_sum{method="PUT",%s}' % (name, route)] > 0)
+        # the first GET was encoded, the second came from the cache
+        self.assertEqual(m['bookauthor_cache_hits_total'], 1)
+        self.assertEqual(m['bookauthor_cache_misses_total'], 1)
+    
+    
+    def test_streamed(self):
+        self.app.put('/author/Plato/-424', json.dumps([{"title": "The Republic", "pubdate": -360}]),
+            content_type=self.ctype)
+        res = self.app.get('/query/author_by_books')
+        m = self.metrics()
+        labels = 'method="GET",route="/query/author_by_books"'
+        self.assertEqual(m['bookauthor_http_response_size_bytes_count{%s}' % labels], 1)
+        self.assertEqual(m['bookauthor_http_response_size_bytes_sum{%s}' % labels],
+            len(res.body))
+    
+    
+    def test_storage(self):
+        self.app.put('/author/Edward R. Tufte/1942', json.dumps([
+            {"title": "Envisioning Information", "pubdate": 1990},
+            {"title": "Beautiful Evidence", "pubdate": 2006}]), content_type=self.ctype)
+        self.app.put('/author/Edward R. Tufte/1942', json.dumps([
+            {"title": "Envisioning Information", "pubdate": 1990}]), content_type=self.ctype)
+        self.app.put('/book/Beautiful Evidence/2006', json.dumps([
+            {"name": "Plato", "dob": -424}]), content_type=self.ctype)
+        self.app.delete('/book/Envisioning Information/1990')
+        m = self.metrics()
+        self.assertEqual(m['bookauthor_storage_entities{side="author"}'], 2)
+        self.assertEqual(m['bookauthor_storage_entities{side="book"}'], 1)
+        self.assertEqual(m['bookauthor_storage_relations'], 2)
+        self.assertEqual(m['bookauthor_storage_writes_total{op="create",result="created",side="author"}'], 1)
+        self.assertEqual(m['bookauthor_storage_writes_total{op="create",result="unchanged",side="author"}'], 1)
+        self.assertEqual(m['bookauthor_storage_writes_total{op="create",result="updated",side="book"}'], 1)
+        self.assertEqual(m['bookauthor_storage_writes_total{op="delete",result="deleted",side="book"}'], 1)
+    
+    
+    def test_off(self):
+        app = webtest.TestApp(book_author.BookAuthor(metrics=False))
+        app.get('/metrics', status=404)
+        # other storage has no stats, just the requests
+        app = webtest.TestApp(book_author.BookAuthor(
+            storage=book_author.BookAuthorCompactStorage()))
+        app.get('/author/Nobody/1', status=404)
+        body = app.get('/metrics').body
+        self.assertTrue('bookauthor_http_requests_total' in body)
+        self.assertFalse('bookauthor_storage' in body)
+    
+    
+    def test_labels(self):
+        self.assertEqual(book_author.metric_labels(route='a"b\\c\nd', le=0.5),
+            'le="0.5",route="a\\"b\\\\c\\nd"')
+
+
+
+class TestProfiling(unittest.TestCase):
+    
+    def setUp(self):
+        # no cache, so every profiled GET is encoded
+        self.ba = book_author.BookAuthor(cache_bytes=0)
+        self.profiler = book_author.ProfilingMiddleware(self.ba, header="X-Profile")
+        self.app = webtest.TestApp(self.profiler)
+        self.app.put('/author/Plato/-424', json.dumps([{"title": "The Republic", "pubdate": -360}]),
+            content_type="application/json")
+    
+    
+    def test_header(self):
+        url = '/query/author_by_books'
+        res = self.app.get(url)
+        self.assertEqual(self.profiler.stats, {})
+        profiled = self.app.get(url, headers={'X-Profile': '1'})
+        self.assertEqual(profiled.body, res.body)
+        self.app.get(url, headers={'X-Profile': '1'})
+        self.assertEqual(self.profiler.stats.keys(), [url])
+        self.assertEqual(self.profiler.stats[url][0], 2)
+        listing = self.app.get('/admin/profile').body
+        self.assertTrue(url in listing)
+        # the pstats file loads, and encoding the stream is in it
+        path = tempfile.mktemp()
+        try:
+            with open(path, 'wb') as f:
+                f.write(self.app.get('/admin/profile', {'route': url}).body)
+            import pstats
+            functions = [f[2] for f in pstats.Stats(path).stats]
+            self.assertTrue('chunks' in functions)
+        finally:
+            os.remove(path)
+        text = self.app.get('/admin/profile', {'route': url, 'format': 'text',
+            'sort': 'tottime', 'limit': '5'}).body
+        self.assertTrue('function calls' in text)
+        self.app.get('/admin/profile', {'route': url, 'format': 'text', 'sort': 'nope'},
+            status=400)
+        self.app.get('/admin/profile', {'route': '/nothing'}, status=404)
+        self.app.delete('/admin/profile')
+        self.assertEqual(self.profiler.stats, {})
+    
+    
+    def test_sampled(self):
+        self.profiler.fraction = 1.0
+        self.app.get('/author/Plato/-424')
+        self.app.get('/author/Nobody/1', status=404)
+        self.app.get('/nothing', status=404)
+        self.assertEqual(self.profiler.stats['/author/{name}/{dob}'][0], 2)
+        self.assertEqual(self.profiler.stats[''][0], 1)
+        # routes still work through it
+        self.app.delete('/author/Plato/-424')
+        self.app.get('/author/Plato/-424', status=404)
+
+
+
+class TestIndexQueries(unittest.TestCase):
+    
+    def setUp(self):
+        self.app = webtest.TestApp(book_author.BookAuthor())
+        self.ctype = "application/json"
+        for name, dob, books in [
+                ("Edward R. Tufte", 1942, [("Envisioning Information", 1990),
+                    ("Visual Explanations", 1997), ("Beautiful Evidence", 2006)]),
+                ("Edward Gibbon", 1737, [("The Decline and Fall of the Roman Empire", 1776)]),
+                ("Plato", -424, [("The Republic", -360)]),
+                ("James D. Foley", 1942, [("Computer Graphics", 1995)]),
+                ("Andries van Dam", 1938, [("Computer Graphics", 1995)])]:
+            self.app.put('/author/%s/%d' % (name, dob), json.dumps(
+                [{"title": t, "pubdate": p} for t, p in books]), content_type=self.ctype)
+    
+    
+    def test_prefix(self):
+        res = self.app.get('/query/author_by_name', {'prefix': 'Edward'})
+        self.assertEqual(res.json, [{"name": "Edward Gibbon", "dob": 1737},
+            {"name": "Edward R. Tufte", "dob": 1942}])
+        res = self.app.get('/query/book_by_title', {'prefix': 'The '})
+        self.assertEqual([d["title"] for d in res.json],
+            ["The Decline and Fall of the Roman Empire", "The Republic"])
+        self.assertEqual(len(self.app.get('/query/author_by_name').json), 5)
+        self.app.get('/query/author_by_name', {'prefix': 'Zeno'}, status=404)
+    
+    
+    def test_range(self):
+        res = self.app.get('/query/book_by_pubdate', {'from': 1980, 'to': 1995})
+        self.assertEqual(res.json, [{"title": "Envisioning Information", "pubdate": 1990},
+            {"title": "Computer Graphics", "pubdate": 1995}])
+        res = self.app.get('/query/author_by_dob', {'to': 0})
+        self.assertEqual(res.json, [{"name": "Plato", "dob": -424}])
+        res = self.app.get('/query/author_by_dob', {'from': 1942})
+        self.assertEqual([d["name"] for d in res.json], ["Edward R. Tufte", "James D. Foley"])
+        self.app.get('/query/author_by_dob', {'from': 'soon'}, status=400)
+        self.app.get('/query/author_by_dob', {'from': 2000, 'to': 1900}, status=404)
+    
+    
+    def test_pages(self):
+        url = '/query/book_by_pubdate?from=1900&limit=2'
+        seen = []
+        while url:
+            res = self.app.get(url)
+            seen.extend(d["title"] for d in res.json)
+            url = None
+            if 'Link' in res.headers:
+                url = res.headers['Link'].split('>')[0][1:]
+        self.assertEqual(seen, [d["title"] for d in
+            self.app.get('/query/book_by_pubdate?from=1900').json])
+        self.assertEqual(len(seen), 4)
+        # a ranking's cursor is no good here
+        cursor = self.app.get('/query/author_by_books?limit=1').headers['Link']
+        cursor = cursor.split('cursor=')[1].split('>')[0].split('&')[0]
+        self.app.get('/query/author_by_name?limit=1&cursor=' + cursor, status=400)
+    
+    
+    def test_writes(self):
+        self.app.delete('/book/Computer Graphics/1995')
+        res = self.app.get('/query/author_by_dob', {'from': 1930, 'to': 1950})
+        self.assertEqual(res.json, [{"name": "Edward R. Tufte", "dob": 1942}])
+        self.app.put('/book/Computer Graphics/1995', json.dumps([{"name": "Edward Teller", "dob": 1908}]),
+            content_type=self.ctype)
+        res = self.app.get('/query/author_by_name', {'prefix': 'Edward'})
+        self.assertEqual([d["name"] for d in res.json],
+            ["Edward Gibbon", "Edward R. Tufte", "Edward Teller"])
+    
+    
+    def test_snapshot(self):
+        # indexes are built on first use for a store that started from a
+        # snapshot, and kept up from there
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'book_author.snap')
+            self.app.app.storage.snapshot(path)
+            store = book_author.BookAuthorMemStorage(snapshot=path)
+            self.assertEqual(store.indexes, None)
+            store.author_delete("Plato", -424)
+            rows, cursor = store.author_by_dob_page(None, 1800)
+            self.assertEqual(rows, [{"name": "Edward Gibbon", "dob": 1737}])
+            store.author_create("Plato", -424, [{"title": "Laws", "pubdate": -348}])
+            self.assertEqual(list(store.book_by_title_iter("L")), [{"title": "Laws", "pubdate": -348}])
+        finally:
+            shutil.rmtree(directory)
+    
+    
+    def test_other_storage(self):
+        app = webtest.TestApp(book_author.BookAuthor(
+            storage=book_author.BookAuthorCompactStorage()))
+        app.get('/query/author_by_name', status=501)
+
+
+
+class TestTraversal(unittest.TestCase):
+    
+    def storage(self):
+        return book_author.BookAuthorMemStorage()
+    
+    def setUp(self):
+        self.store = self.storage()
+        self.app = webtest.TestApp(book_author.BookAuthor(storage=self.store))
+        cg = {"title": "Computer Graphics", "pubdate": 1995}
+        intro = {"title": "Introduction to Computer Graphics", "pubdate": 1993}
+        for name, dob, books in [
+                ("James D. Foley", 1942, [cg, intro, {"title": "Fundamentals", "pubdate": 1982}]),
+                ("Andries van Dam", 1938, [cg, {"title": "Fundamentals", "pubdate": 1982}]),
+                ("Steven K. Feiner", 1952, [cg, intro]),
+                ("John F. Hughes", 1955, [cg]),
+                ("Richard L. Phillips", 1935, [intro]),
+                ("Plato", -424, [{"title": "The Republic", "pubdate": -360}])]:
+            self.store.author_create(name, dob, books)
+    
+    
+    def test_coauthors(self):
+        res = self.app.get('/query/coauthors/James D. Foley/1942')
+        self.assertEqual(res.json, [
+            {"name": "Andries van Dam", "dob": 1938, "shared_books": 2},
+            {"name": "Steven K. Feiner", "dob": 1952, "shared_books": 2},
+            {"name": "John F. Hughes", "dob": 1955, "shared_books": 1},
+            {"name": "Richard L. Phillips", "dob": 1935, "shared_books": 1}])
+        res = self.app.get('/query/coauthors/James D. Foley/1942?limit=1')
+        self.assertEqual([d["name"] for d in res.json], ["Andries van Dam"])
+        self.app.get('/query/coauthors/Plato/-424', status=404)
+        self.app.get('/query/coauthors/Nobody/1', status=404)
+        self.app.get('/query/coauthors/Plato/soon', status=400)
+    
+    
+    def test_related_books(self):
+        res = self.app.get('/query/related_books/Introduction to Computer Graphics/1993')
+        self.assertEqual(res.json, [
+            {"title": "Computer Graphics", "pubdate": 1995, "shared_authors": 2},
+            {"title": "Fundamentals", "pubdate": 1982, "shared_authors": 1}])
+    
+    
+    def test_neighborhood(self):
+        url = '/query/author_neighborhood/Richard L. Phillips/1935'
+        res = self.app.get(url, {'depth': 1})
+        self.assertEqual(res.json, [{"title": "Introduction to Computer Graphics",
+            "pubdate": 1993, "distance": 1}])
+        res = self.app.get(url, {'depth': 3})
+        by_distance = {}
+        for d in res.json:
+            by_distance.setdefault(d.pop("distance"), []).append(d)
+        self.assertEqual(sorted(d["name"] for d in by_distance[2]),
+            ["James D. Foley", "Steven K. Feiner"])
+        self.assertEqual(sorted(d["title"] for d in by_distance[3]),
+            ["Computer Graphics", "Fundamentals"])
+        distances = [d["distance"] for d in self.app.get(url, {'depth': 5}).json]
+        self.assertEqual(distances, sorted(distances))
+        # everything connected, and nothing twice
+        self.assertEqual(len(distances), 7)
+        self.assertEqual(len(self.app.get(url, {'depth': 5, 'limit': 3}).json), 3)
+        res = self.app.get('/query/book_neighborhood/The Republic/-360')
+        self.assertEqual(res.json, [{"name": "Plato", "dob": -424, "distance": 1}])
+        self.app.get(url, {'depth': 0}, status=400)
+    
+    
+    def test_other_storage(self):
+        directory = tempfile.mkdtemp()
+        try:
+            app = webtest.TestApp(book_author.BookAuthor(storage=
+                book_author.BookAuthorSQLiteStorage(os.path.join(directory, 'ba.db'))))
+            app.get('/query/coauthors/Plato/-424', status=501)
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestTraversalCompact(TestTraversal):
+    # the same over ids and bytearrays
+    
+    def storage(self):
+        return book_author.BookAuthorCompactStorage()
+
+
+
+class TestChanges(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = book_author.BookAuthorMemStorage(changes=4)
+        self.app = webtest.TestApp(book_author.BookAuthor(storage=self.store))
+        self.ctype = "application/json"
+    
+    
+    def put(self, url, rels):
+        self.app.put(url, json.dumps(rels), content_type=self.ctype)
+    
+    
+    def test_since(self):
+        res = self.app.get('/changes?since=0')
+        self.assertEqual(res.json, [])
+        self.assertEqual(res.headers['X-Changes-Latest'], '0')
+        epoch = res.headers['X-Changes-Epoch']
+        self.put('/author/Plato/-424', [{"title": "The Republic", "pubdate": -360}])
+        # no change, no number
+        self.put('/author/Plato/-424', [{"title": "The Republic", "pubdate": -360}])
+        self.put('/book/Laws/-348', [{"name": "Plato", "dob": -424}])
+        self.app.delete('/book/The Republic/-360')
+        self.app.delete('/book/The Republic/-360', status=404)
+        res = self.app.get('/changes?since=0')
+        self.assertEqual(res.json, [
+            {"seq": 1, "op": "put", "name": "Plato", "dob": -424,
+                "books": [{"title": "The Republic", "pubdate": -360}]},
+            {"seq": 2, "op": "put", "title": "Laws", "pubdate": -348,
+                "authors": [{"name": "Plato", "dob": -424}]},
+            {"seq": 3, "op": "delete", "title": "The Republic", "pubdate": -360}])
+        self.assertEqual(res.headers['X-Changes-Latest'], '3')
+        res = self.app.get('/changes', {'since': 1, 'limit': 1, 'epoch': epoch})
+        self.assertEqual([d["seq"] for d in res.json], [2])
+        self.app.get('/changes', {'since': 3, 'epoch': 'elsewhere'}, status=410)
+        self.app.get('/changes', {'since': 4}, status=410)
+        self.app.get('/changes', status=400)
+        self.app.get('/changes', {'since': 0, 'wait': 'nan'}, status=400)
+    
+    
+    def test_fell_off(self):
+        for i in range(6):
+            self.put('/author/a%d/1' % i, [{"title": "b", "pubdate": 1}])
+        self.app.get('/changes?since=1', status=410)
+        res = self.app.get('/changes?since=2')
+        self.assertEqual([d["seq"] for d in res.json], [3, 4, 5, 6])
+    
+    
+    def test_replay(self):
+        # a copy kept up from the feed matches
+        copy = book_author.BookAuthorMemStorage()
+        self.store.changes = book_author.ChangeFeed(100)
+        self.put('/author/Edward R. Tufte/1942', [{"title": "Envisioning Information", "pubdate": 1990},
+            {"title": "Visual Explanations", "pubdate": 1997}])
+        self.put('/book/Visual Explanations/1997', [{"name": "Plato", "dob": -424}])
+        self.app.delete('/author/Edward R. Tufte/1942')
+        changes, latest = self.store.changes.since(0)
+        for seq, record in changes:
+            copy.apply(record)
+        self.assertEqual(copy.authors, self.store.authors)
+        self.assertEqual(copy.books, self.store.books)
+        self.assertEqual(copy.version(), latest)
+    
+    
+    def test_wait(self):
+        import threading
+        writer = threading.Timer(0.1, self.store.author_create, ("Plato", -424,
+            [{"title": "The Republic", "pubdate": -360}]))
+        writer.start()
+        app = webtest.TestApp(book_author.BookAuthor(storage=self.store, max_wait=30))
+        res = app.get('/changes?since=0&wait=10')
+        writer.join()
+        self.assertEqual([d["seq"] for d in res.json], [1])
+        self.assertEqual(res.headers['X-Changes-Max-Wait'], '30')
+        # nothing comes, so an empty list once the wait is up
+        self.assertEqual(app.get('/changes?since=1&wait=0.05').json, [])
+    
+    
+    def test_no_wait_single_threaded(self):
+        # by default nothing waits, so one thread isn't held up by a poll
+        import threading
+        import urllib2
+        import wsgiref.simple_server
+        class Quiet(wsgiref.simple_server.WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+        self.put('/author/Plato/-424', [{"title": "The Republic", "pubdate": -360}])
+        httpd = wsgiref.simple_server.make_server('127.0.0.1', 0, self.app.app,
+            handler_class=Quiet)
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            url = 'http://127.0.0.1:%d' % httpd.server_port
+            polled = []
+            poller = threading.Thread(target=lambda: polled.append(
+                urllib2.urlopen(url + '/changes?since=1&wait=5')))
+            started = time.time()
+            poller.start()
+            time.sleep(0.1)
+            res = urllib2.urlopen(url + '/query/author_by_books')
+            self.assertEqual(json.load(res)[0]["name"], "Plato")
+            poller.join()
+            self.assertTrue(time.time() - started < 2)
+            self.assertEqual(polled[0].info()['X-Changes-Max-Wait'], '0')
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+    
+    
+    def test_other_storage(self):
+        app = webtest.TestApp(book_author.BookAuthor(
+            storage=book_author.BookAuthorCompactStorage()))
+        app.get('/changes?since=0', status=501)
+
+
+
+class TestEncodings(unittest.TestCase):
+    
+    def test_json_chunks(self):
+        items = [{"a": i, "b": [i]} for i in range(5)]
+        for e in [book_author.JSONEncoding(), book_author.JSONEncoding(4, True)]:
+            self.assertEqual(json.loads(''.join(e.chunks(iter(items), 2))), items)
+            self.assertEqual(json.loads(''.join(e.chunks(iter([]), 2))), [])
+            self.assertEqual(json.loads(e.encode(items)), items)
+            # streamed or not, the same bytes
+            for x in [items, [{'a': [1, 2]}, {'b': 2}], [1], []]:
+                for n in [1, 2, 10]:
+                    self.assertEqual(''.join(e.chunks(iter(x), n)), e.encode(x))
+    
+    
+    def test_ndjson(self):
+        e = book_author.NDJSONEncoding()
+        self.assertEqual(e.encode([{"a": 1}, {"a": 2}]), '{"a":1}\n{"a":2}\n')
+        self.assertEqual(e.encode([]), '')
+    
+    
+    def test_cbor(self):
+        e = book_author.CBOREncoding()
+        self.assertEqual(e.encode([{"a": 1}]), '\x81\xa1\x61a\x01')
+        self.assertEqual(e.encode([-424, 1983, u"\xe9"]),
+            '\x83\x39\x01\xa7\x19\x07\xbf\x62\xc3\xa9')
+        self.assertEqual(''.join(e.chunks(iter([1, 2]), 1)), '\x9f\x01\x02\xff')
+    
+    
+    def test_negotiate(self):
+        encodings = book_author.ENCODINGS
+        negotiate = book_author.negotiate
+        self.assertTrue(negotiate(None, encodings) is encodings[0])
+        self.assertTrue(negotiate('*/*', encodings) is encodings[0])
+        e = negotiate('application/x-ndjson', encodings)
+        self.assertEqual(e.content_type, 'application/x-ndjson')
+        e = negotiate('text/plain;q=0.9, application/*;q=0.2', encodings)
+        self.assertEqual(e.content_type, 'application/json')
+        self.assertEqual(negotiate('application/json;q=0', encodings), None)
+        # a refusal holds against wildcards, but not the other way round
+        e = negotiate('application/json;q=0, */*;q=0.1', encodings)
+        self.assertEqual(e.content_type, 'application/x-ndjson')
+        e = negotiate('application/*;q=0, application/cbor', encodings)
+        self.assertEqual(e.content_type, 'application/cbor')
+        self.assertEqual(negotiate('application/*;q=0, */*', encodings), None)
+        self.assertEqual(negotiate('*/*;q=0', encodings), None)
+        # indent=4 is the only variant
+        self.assertEqual(negotiate('application/json; indent=4', encodings).tag, 'json-pretty')
+        self.assertEqual(negotiate('application/json; indent=2', encodings).tag, 'json')
+
+
+
+
+class TestReadBody(unittest.TestCase):
+    
+    class Trickle(object):
+        # wsgi.input that hands back a few bytes per read
+        def __init__(self, data):
+            self.data = data
+        def read(self, n=-1):
+            n = min(n, 3)
+            d, self.data = self.data[:n], self.data[n:]
+            return d
+    
+    
+    def test_short_reads(self):
+        body = json.dumps([{"title": "b1", "pubdate": 1}])
+        environ = {'wsgi.input': self.Trickle(body + 'trailing'),
+            'CONTENT_LENGTH': str(len(body))}
+        self.assertEqual(book_author.read_body(environ, 1024), body)
+    
+    
+    def test_limits(self):
+        read_body = book_author.read_body
+        environ = {'wsgi.input': self.Trickle('x' * 10), 'CONTENT_LENGTH': '10'}
+        self.assertRaises(book_author.BodyTooLarge, read_body, environ, 9)
+        # refused before reading anything
+        self.assertEqual(environ['wsgi.input'].data, 'x' * 10)
+        environ = {'wsgi.input': self.Trickle('x' * 10), 'wsgi.input_terminated': True}
+        self.assertRaises(book_author.BodyTooLarge, read_body, environ, 9)
+        environ = {'wsgi.input': self.Trickle('x' * 10), 'wsgi.input_terminated': True}
+        self.assertEqual(read_body(environ, 10), 'x' * 10)
+        environ = {'wsgi.input': self.Trickle('x' * 10)}
+        self.assertEqual(read_body(environ, 10), '')
+
+
+
+
+class TestBodyLines(unittest.TestCase):
+    
+    def lines(self, body, max_line=8, block_size=3):
+        environ = {'wsgi.input': TestReadBody.Trickle(body),
+            'CONTENT_LENGTH': str(len(body))}
+        return list(book_author.iter_body_lines(environ, max_line, block_size))
+    
+    
+    def test_split_across_blocks(self):
+        self.assertEqual(self.lines('ab\ncdefg\n\nh'), ['ab', 'cdefg', 'h'])
+    
+    
+    def test_long_lines(self):
+        self.assertEqual(self.lines('ab\n0123456789\ncd\n'), ['ab', None, 'cd'])
+        self.assertEqual(self.lines('0123456789'), [None])
+
+
+
+
 class TestBookAuthorInternals(unittest.TestCase):
     
     def setUp(self):
@@ -304,10 +1274,866 @@ class TestBookAuthorInternals(unittest.TestCase):
         a = self.store.author_by_books()
         self.assertEqual(len(a), 3)
         self.assertEqual(a[0], {'name': 'a3', 'dob': 1, 'book_count': 3})
+    
+    
+    def test_author_by_books_ties(self):
+        # equal counts come back in the order they reached that count
+        b1 = [{"title": "b1", "pubdate": 1}]
+        b2 = [{"title": "b2", "pubdate": 1}]
+        created, updated = self.store.author_create("a1", 1, b1)
+        created, updated = self.store.author_create("a2", 1, b1)
+        created, updated = self.store.author_create("a3", 1, b1)
+        names = [d['name'] for d in self.store.author_by_books()]
+        self.assertEqual(names, ['a1', 'a2', 'a3'])
+        # a1 moves up and back down, now the newest at count 1
+        created, updated = self.store.author_create("a1", 1, b2)
+        self.store.book_delete("b2", 1)
+        names = [d['name'] for d in self.store.author_by_books()]
+        self.assertEqual(names, ['a2', 'a3', 'a1'])
+    
+    
+    def test_author_by_books_page(self):
+        for i in range(6):
+            bi = [{"title": "b%d" % j, "pubdate": 1} for j in range(i % 3 + 1)]
+            self.store.author_create("a%d" % i, 1, bi)
+        full = self.store.author_by_books()
+        a, cursor = self.store.author_by_books_page(limit=4)
+        self.assertEqual(a, full[:4])
+        a, cursor = self.store.author_by_books_page(limit=4, cursor=cursor)
+        self.assertEqual(a, full[4:])
+        self.assertEqual(cursor, None)
+        a, cursor = self.store.author_by_books_page(min_count=2)
+        self.assertEqual(a, full[:4])
+    
+    
+    def test_entity_page_by_rels_unindexed(self):
+        # without a ranking one is built, and it pages the same way
+        entities = {("a", 1): set([1, 2]), ("b", 1): set([1]),
+            ("c", 1): set([1, 2, 3]), ("d", 1): set([2])}
+        ranks = book_author.ranks_for(entities)
+        a, after = book_author.entity_page_by_rels(entities, limit=2)
+        self.assertEqual(a, [(("c", 1), 3), (("a", 1), 2)])
+        self.assertEqual((a, after), book_author.entity_page_by_rels(None, ranks, limit=2))
+        after = json.loads(json.dumps(after))
+        a, after = book_author.entity_page_by_rels(None, ranks, limit=2, after=after)
+        self.assertEqual(sorted(a), [(("b", 1), 1), (("d", 1), 1)])
+        self.assertEqual(after, None)
+        self.assertEqual(book_author.entity_by_rels(entities)[0], (("c", 1), 3))
+    
+    
+    def test_ranks_match_relations(self):
+        # index agrees with the adjacency dicts through creates and deletes
+        for i in range(20):
+            bi = [{"title": "b%d" % j, "pubdate": 1} for j in range(i % 7)]
+            self.store.author_create("a%d" % i, 1, bi)
+        for j in range(0, 7, 2):
+            self.store.book_delete("b%d" % j, 1)
+        self.store.author_delete("a6", 1)
+        for d in self.store.author_by_books():
+            rels = self.store.author_read(d['name'], d['dob'])
+            self.assertEqual(d['book_count'], len(rels))
+        self.assertEqual(len(self.store.author_by_books()), len(self.store.authors))
+        counts = [d['author_count'] for d in self.store.book_by_authors()]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertEqual(len(counts), len(self.store.books))
+    
+    
+    def test_indexes_match_relations(self):
+        # the name and date indexes hold exactly the stored keys, through
+        # creates and deletes that add and drop entities on both sides
+        for i in range(40):
+            bi = [{"title": "b%d" % j, "pubdate": j % 5} for j in range(i % 7)]
+            self.store.author_create("a%d" % i, i % 9, bi)
+        for j in range(0, 7, 2):
+            self.store.book_delete("b%d" % j, j % 5)
+        self.store.author_delete("a6", 6)
+        self.store.author_delete("a13", 4)
+        for side, entities in (("author", self.store.authors), ("book", self.store.books)):
+            by_name, by_date = self.store.indexes[side]
+            self.assertEqual([by_name.by(e) for e in by_name.walk(())],
+                sorted(entities))
+            self.assertEqual([by_date.by(e) for e in by_date.walk(())],
+                sorted(entities, key=lambda k: (k[1], k[0])))
+    
+    
+    def test_sorted_index(self):
+        import random
+        rnd = random.Random(7)
+        index = book_author.SortedIndex(book_author.by_name, [("k%03d" % i, 0) for i in range(0, 50, 5)])
+        index.load = 4
+        keys = set(("k%03d" % i, 0) for i in range(0, 50, 5))
+        for n in range(500):
+            key = ("k%03d" % rnd.randrange(100), 0)
+            if rnd.random() < 0.6:
+                if key not in keys:
+                    index.add(key)
+                keys.add(key)
+            else:
+                index.remove(key)
+                keys.discard(key)
+        self.assertEqual(list(index.walk(())), sorted(keys))
+        self.assertEqual(len(index), len(keys))
+        self.assertTrue(len(index.lists) > 1)
+        self.assertEqual(index.maxes, [entries[-1] for entries in index.lists])
+        start = sorted(keys)[len(keys) // 2]
+        self.assertEqual(list(index.walk(start)), [k for k in sorted(keys) if k >= start])
+        self.assertEqual(list(index.walk(start, True)), [k for k in sorted(keys) if k > start])
+        self.assertEqual(list(index.walk(("z",))), [])
+
+
+
+
+class TestMutationLog(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'book_author.log')
+    
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    
+    def reopen(self, store):
+        store.log.close()
+        return book_author.BookAuthorMemStorage(book_author.MutationLog(self.path))
+    
+    
+    def test_replay(self):
+        store = book_author.BookAuthorMemStorage(book_author.MutationLog(self.path))
+        store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}, {"title": "b2", "pubdate": 2}])
+        store.book_create("b3", 3, [{"name": "a1", "dob": 1}, {"name": "a2", "dob": 2}])
+        store.book_delete("b1", 1)
+        store.author_create("a1", 1, [{"title": "b2", "pubdate": 2}])
+        size = os.path.getsize(self.path)
+        restored = self.reopen(store)
+        self.assertEqual(restored.authors, store.authors)
+        self.assertEqual(restored.books, store.books)
+        self.assertEqual(restored.author_by_books(), store.author_by_books())
+        # no-op writes aren't logged
+        self.assertEqual(os.path.getsize(self.path), size)
+        restored.log.close()
+    
+    
+    def test_torn_tail(self):
+        store = book_author.BookAuthorMemStorage(book_author.MutationLog(self.path))
+        store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+        store.author_create("a2", 1, [{"title": "b1", "pubdate": 1}])
+        store.log.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 3)
+        log = book_author.MutationLog(self.path)
+        restored = book_author.BookAuthorMemStorage(log)
+        self.assertEqual(restored.authors.keys(), [("a1", 1)])
+        # later writes follow the last good record
+        restored.author_create("a3", 1, [{"title": "b1", "pubdate": 1}])
+        restored = self.reopen(restored)
+        self.assertEqual(sorted(restored.authors.keys()), [("a1", 1), ("a3", 1)])
+        restored.log.close()
+    
+    
+    def test_group_commit(self):
+        log = book_author.MutationLog(self.path, sync_every=3)
+        store = book_author.BookAuthorMemStorage(log)
+        store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+        store.author_create("a2", 1, [{"title": "b1", "pubdate": 1}])
+        self.assertEqual(log.pending, 2)
+        store.author_delete("a1", 1)
+        self.assertEqual(log.pending, 0)
+        log.close()
+
+
+class TestSnapshot(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.dir, 'book_author.log')
+        self.snap_path = os.path.join(self.dir, 'book_author.snap')
+        self.store = book_author.BookAuthorMemStorage(
+            book_author.MutationLog(self.log_path), self.snap_path)
+        self.store.author_create("Edward R. Tufte", 1942,
+            [{"title": "Envisioning Information", "pubdate": 1990},
+            {"title": "Visual Explanations", "pubdate": 1997}])
+        self.store.book_create("Computer Graphics", 1995,
+            [{"name": "James D. Foley", "dob": 1942}, {"name": "Andries van Dam", "dob": 1938}])
+        self.store.author_create("Plato", -424, [{"title": "The Republic", "pubdate": -360}])
+    
+    
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    
+    
+    def reopen(self):
+        self.store.log.close()
+        return book_author.BookAuthorMemStorage(
+            book_author.MutationLog(self.log_path), self.snap_path)
+    
+    
+    def assertSameData(self, a, b):
+        self.assertEqual(sorted(a.authors.items()), sorted(b.authors.items()))
+        self.assertEqual(sorted(a.books.items()), sorted(b.books.items()))
+        self.assertEqual(len(a.authors), len(b.authors))
+        self.assertEqual(len(a.books), len(b.books))
+    
+    
+    def test_snapshot_reads(self):
+        self.store.snapshot()
+        self.assertEqual(os.path.getsize(self.log_path), 0)
+        restored = self.reopen()
+        self.assertTrue(isinstance(restored.authors, book_author.SnapshotEntities))
+        self.assertEqual(len(restored.authors.live), 0)
+        self.assertEqual(sorted(restored.book_read_items("Computer Graphics", 1995)),
+            sorted(self.store.book_read_items("Computer Graphics", 1995)))
+        # reading doesn't copy anything in
+        self.assertEqual(len(restored.books.live), 0)
+        self.assertEqual(restored.author_read("Nobody", 1), set())
+        self.assertSameData(restored, self.store)
+        self.assertEqual(restored.author_by_books(), [
+            {"name": "Edward R. Tufte", "dob": 1942, "book_count": 2},
+            {"name": "Andries van Dam", "dob": 1938, "book_count": 1},
+            {"name": "James D. Foley", "dob": 1942, "book_count": 1},
+            {"name": "Plato", "dob": -424, "book_count": 1}])
+        restored.log.close()
+    
+    
+    def test_snapshot_then_log(self):
+        self.store.snapshot()
+        self.store.book_delete("Envisioning Information", 1990)
+        self.store.author_create("Plato", -424, [{"title": "Laws", "pubdate": -348}])
+        restored = self.reopen()
+        self.assertSameData(restored, self.store)
+        # and keep going on top of the mapped snapshot
+        self.store = restored
+        self.assertEqual(restored.stats()["relations"], 5)
+        restored.author_delete("Andries van Dam", 1938)
+        restored.author_create("Edward R. Tufte", 1942,
+            [{"title": "Beautiful Evidence", "pubdate": 2006}])
+        self.assertEqual(restored.author_by_books()[0]["book_count"], 2)
+        self.assertEqual(restored.stats()["relations"],
+            book_author.relation_count(restored.authors))
+        restored.snapshot()
+        again = self.reopen()
+        self.assertSameData(again, restored)
+        again.log.close()
+    
+    
+    def test_periodic(self):
+        self.store.log.close()
+        os.remove(self.log_path)
+        store = book_author.BookAuthorMemStorage(
+            book_author.MutationLog(self.log_path), self.snap_path, snapshot_every=2)
+        store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+        self.assertFalse(os.path.exists(self.snap_path))
+        store.author_create("a2", 1, [{"title": "b1", "pubdate": 1}])
+        self.assertTrue(os.path.exists(self.snap_path))
+        self.assertEqual(os.path.getsize(self.log_path), 0)
+        store.log.close()
+        # nowhere to write it
+        self.assertRaises(ValueError, book_author.BookAuthorMemStorage, snapshot_every=2)
 
 
+class TestCompactStorage(unittest.TestCase):
+    
+    def test_matches_mem_storage(self):
+        # same writes, same answers
+        import random
+        rnd = random.Random(7)
+        mem = book_author.BookAuthorMemStorage()
+        compact = book_author.BookAuthorCompactStorage()
+        for n in range(400):
+            op = rnd.random()
+            a, b = "a%d" % rnd.randint(0, 30), "b%d" % rnd.randint(0, 30)
+            if op < 0.45:
+                bi = [{"title": b, "pubdate": 1}, {"title": "b%d" % rnd.randint(0, 30), "pubdate": 2}]
+                self.assertEqual(mem.author_create(a, 1, bi), compact.author_create(a, 1, bi))
+            elif op < 0.8:
+                ai = [{"name": a, "dob": 1}]
+                self.assertEqual(mem.book_create(b, 1, ai), compact.book_create(b, 1, ai))
+            elif op < 0.9:
+                self.assertEqual(mem.author_delete(a, 1), compact.author_delete(a, 1))
+            else:
+                self.assertEqual(mem.book_delete(b, 2), compact.book_delete(b, 2))
+        self.assertEqual(len(compact.authors), len(mem.authors))
+        for key in mem.authors:
+            self.assertEqual(compact.author_read(*key), mem.author_read(*key))
+        for key in mem.books:
+            self.assertEqual(sorted(compact.book_read_items(*key)),
+                sorted(mem.book_read_items(*key)))
+        counts = lambda a: [d["book_count"] for d in a]
+        self.assertEqual(counts(compact.author_by_books()), counts(mem.author_by_books()))
+    
+    
+    def test_ids_reused(self):
+        store = book_author.BookAuthorCompactStorage()
+        store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+        store.author_delete("a1", 1)
+        self.assertEqual(len(store.books), 0)
+        store.author_create("a2", 1, [{"title": "b2", "pubdate": 1}])
+        self.assertEqual(len(store.authors.keys), 1)
+        self.assertEqual(store.book_read("b2", 1), set([("a2", 1)]))
+        self.assertEqual(store.author_by_books(), [{"name": "a2", "dob": 1, "book_count": 1}])
 
 
+class TestSQLiteStorage(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ba.db')
+        self.store = book_author.BookAuthorSQLiteStorage(self.path)
+    
+    
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.dir)
+    
+    
+    def test_create_delete(self):
+        created, updated = self.store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+        self.assertEqual((created, updated), (True, True))
+        created, updated = self.store.book_create("b1", 1, [{"name": "a1", "dob": 1}])
+        self.assertEqual((created, updated), (False, False))
+        self.assertEqual(self.store.author_create("a1", 1, []), (False, False))
+        self.store.book_create("b2", 2, [{"name": "a1", "dob": 1}, {"name": "a2", "dob": 2}])
+        self.assertEqual(self.store.author_read("a1", 1), set([("b1", 1), ("b2", 2)]))
+        self.assertTrue(self.store.book_delete("b2", 2))
+        # a2 had no other books, so it goes too
+        self.assertEqual(self.store.author_read("a2", 2), set())
+        self.assertEqual(self.store.author_by_books(), [{"name": "a1", "dob": 1, "book_count": 1}])
+        self.assertTrue(self.store.author_delete("a1", 1))
+        self.assertFalse(self.store.author_delete("a1", 1))
+        self.assertEqual(self.store.book_by_authors(), [])
+    
+    
+    def test_pages(self):
+        for i in range(7):
+            bi = [{"title": "b%d" % j, "pubdate": 1} for j in range(i % 3 + 1)]
+            self.store.author_create("a%d" % i, 1, bi)
+        full = self.store.author_by_books()
+        self.assertEqual([d["book_count"] for d in full], [3, 3, 2, 2, 1, 1, 1])
+        # ties in creation order
+        self.assertEqual([d["name"] for d in full[:2]], ["a2", "a5"])
+        pages = []
+        a, cursor = self.store.author_by_books_page(limit=3)
+        pages.extend(a)
+        while cursor is not None:
+            a, cursor = self.store.author_by_books_page(limit=3, cursor=cursor)
+            pages.extend(a)
+        self.assertEqual(pages, full)
+        a, cursor = self.store.author_by_books_page(limit=1, min_count=2)
+        a, cursor = self.store.author_by_books_page(limit=5, min_count=2, cursor=cursor)
+        self.assertEqual(a, full[1:4])
+        self.assertEqual(list(self.store.author_by_books_iter(3)), full[:2])
+    
+    
+    def test_shared_file(self):
+        other = book_author.BookAuthorSQLiteStorage(self.path)
+        self.store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+        self.assertEqual(other.book_read_items("b1", 1), [{"name": "a1", "dob": 1}])
+        # pages follow on from either
+        self.assertEqual(other.epoch, self.store.epoch)
+        other.close()
+    
+    
+    def test_concurrent_writers(self):
+        # the same new keys from several connections at once
+        import threading
+        errors = []
+        def write(n):
+            store = book_author.BookAuthorSQLiteStorage(self.path)
+            try:
+                for i in range(200):
+                    store.author_create("a%d" % (i / 4), 1,
+                        [{"title": "b%d" % (i / 4), "pubdate": 1}, {"title": "p%d" % n, "pubdate": 1}])
+            except Exception, e:
+                errors.append(e)
+            finally:
+                store.close()
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.store.author_by_books()), 50)
+        for d in self.store.author_by_books():
+            self.assertEqual(d["book_count"], 5)
+
+
+class TestShardedStorage(unittest.TestCase):
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.servers = start_shard_threads(self.dir, 4)
+        self.store = book_author.BookAuthorShardedStorage(
+            [server.address for server in self.servers])
+    
+    
+    def tearDown(self):
+        self.store.close()
+        for server in self.servers:
+            server.shutdown()
+        shutil.rmtree(self.dir)
+    
+    
+    def test_matches_mem_storage(self):
+        import random
+        rnd = random.Random(11)
+        mem = book_author.BookAuthorMemStorage()
+        for n in range(300):
+            op = rnd.random()
+            a, b = "a%d" % rnd.randint(0, 20), "b%d" % rnd.randint(0, 20)
+            if op < 0.45:
+                bi = [{"title": b, "pubdate": 1}, {"title": "b%d" % rnd.randint(0, 20), "pubdate": 2}]
+                self.assertEqual(mem.author_create(a, 1, bi), self.store.author_create(a, 1, bi))
+            elif op < 0.8:
+                ai = [{"name": a, "dob": 1}]
+                self.assertEqual(mem.book_create(b, 1, ai), self.store.book_create(b, 1, ai))
+            elif op < 0.9:
+                self.assertEqual(mem.author_delete(a, 1), self.store.author_delete(a, 1))
+            else:
+                self.assertEqual(mem.book_delete(b, 2), self.store.book_delete(b, 2))
+        for key in mem.authors:
+            self.assertEqual(self.store.author_read(*key), mem.author_read(*key))
+        for key in mem.books:
+            self.assertEqual(self.store.book_read(*key), mem.book_read(*key))
+        counts = lambda a: [d["author_count"] for d in a]
+        self.assertEqual(counts(self.store.book_by_authors()), counts(mem.book_by_authors()))
+        self.assertEqual(sorted(d["title"] for d in self.store.book_by_authors()),
+            sorted(d["title"] for d in mem.book_by_authors()))
+    
+    
+    def test_pages(self):
+        for i in range(40):
+            bi = [{"title": "b%d" % j, "pubdate": 1} for j in range(i % 5 + 1)]
+            self.store.author_create("a%d" % i, 1, bi)
+        full = self.store.author_by_books()
+        self.assertEqual(len(full), 40)
+        counts = [d["book_count"] for d in full]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        pages = []
+        a, cursor = self.store.author_by_books_page(limit=3)
+        pages.extend(a)
+        while cursor is not None:
+            a, cursor = self.store.author_by_books_page(limit=3, cursor=cursor)
+            pages.extend(a)
+        self.assertEqual(pages, full)
+        self.assertEqual(list(self.store.author_by_books_iter(2)), full[:32])
+        bad = book_author.encode_cursor(self.store.epoch, [3, 7])
+        self.assertRaises(ValueError, self.store.author_by_books_page, 3, 1, bad)
+    
+    
+    def test_shard_processes(self):
+        directory = os.path.join(self.dir, 'processes')
+        os.mkdir(directory)
+        shards = book_author.start_shards(2, directory)
+        store = book_author.BookAuthorShardedStorage(
+            [shard.address for shard in shards], shards[0].authkey)
+        store.author_create("a1", 1, [{"title": "b1", "pubdate": 1}, {"title": "b2", "pubdate": 1}])
+        self.assertEqual(store.book_read("b2", 1), set([("a1", 1)]))
+        self.assertEqual(store.author_by_books(), [{"name": "a1", "dob": 1, "book_count": 2}])
+        store.close()
+
+
+class TestConcurrency(unittest.TestCase):
+    
+    def test_rwlock_writer_waits(self):
+        import threading
+        lock = book_author.ReadWriteLock()
+        order = []
+        lock.acquire_read()
+        def write():
+            with lock.writing():
+                order.append("w")
+        t = threading.Thread(target=write)
+        t.start()
+        while not lock.writers_waiting:
+            pass
+        # a waiting writer holds off new readers
+        def read():
+            with lock.reading():
+                order.append("r")
+        r = threading.Thread(target=read)
+        r.start()
+        order.append("first")
+        lock.release_read()
+        t.join()
+        r.join()
+        self.assertEqual(order, ["first", "w", "r"])
+    
+    
+    def check_concurrent(self, store):
+        # writers and readers in parallel; every book ends up with all its
+        # authors, and the ranking agrees with the stored sets
+        import threading
+        errors = []
+        def write(n):
+            try:
+                for i in range(200):
+                    store.author_create("a%d" % n, n,
+                        [{"title": "b%d" % i, "pubdate": 1},
+                        {"title": "p%d" % i, "pubdate": n}])
+                    store.book_delete("p%d" % i, n)
+            except Exception, e:
+                errors.append(e)
+        def read():
+            try:
+                for i in range(50):
+                    for d in store.author_by_books_iter():
+                        self.assertTrue(d["book_count"] > 0)
+                    store.book_by_authors_page(limit=5)
+                    store.book_read_items("b%d" % i, 1)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        threads += [threading.Thread(target=read) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        books = store.book_by_authors()
+        self.assertEqual(len(books), 200)
+        for d in books:
+            if d["author_count"] != 4:
+                self.fail(d)
+        for d in store.author_by_books():
+            self.assertEqual(d["book_count"], len(store.author_read(d["name"], d["dob"])))
+    
+    def test_mem_storage(self):
+        self.check_concurrent(book_author.BookAuthorMemStorage())
+    
+    def test_compact_storage(self):
+        self.check_concurrent(book_author.BookAuthorCompactStorage())
+    
+    
+    def test_threaded_server(self):
+        import threading
+        import urllib2
+        import wsgiref.simple_server
+        class Quiet(wsgiref.simple_server.WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+        app = book_author.BookAuthor()
+        httpd = book_author.make_threaded_server('127.0.0.1', 0, app, 4)
+        httpd.RequestHandlerClass = Quiet
+        t = threading.Thread(target=httpd.serve_forever)
+        t.start()
+        try:
+            url = 'http://127.0.0.1:%d/author/a1/1' % httpd.server_port
+            req = urllib2.Request(url, json.dumps([{"title": "b1", "pubdate": 1}]),
+                {'Content-Type': 'application/json'})
+            self.assertEqual(urllib2.urlopen(req).getcode(), 201)
+            self.assertEqual(json.load(urllib2.urlopen(url)), [{"title": "b1", "pubdate": 1}])
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            t.join()
+
+
+class TestReadView(unittest.TestCase):
+    
+    def setUp(self):
+        self.store = book_author.BookAuthorMemStorage()
+        self.store.chunk_size = 2
+        for n in range(8):
+            self.store.author_create("a%d" % n, 1,
+                [{"title": "b%d" % i, "pubdate": 1} for i in range(n % 4 + 1)])
+    
+    def write(self):
+        # a bit of everything, after a stream has started
+        store = self.store
+        store.author_delete("a6", 1)
+        store.author_create("a1", 1, [{"title": "b%d" % i, "pubdate": 1} for i in range(6)])
+        store.author_create("a3", 1, [{"title": "b9", "pubdate": 1}])
+        store.author_create("a9", 1, [{"title": "b%d" % i, "pubdate": 1} for i in range(9)])
+        store.book_delete("b0", 1)
+    
+    def test_ranking(self):
+        expected = self.store.author_by_books()
+        rows = self.store.author_by_books_iter()
+        first = [next(rows) for i in range(3)]
+        self.write()
+        self.assertEqual(first + list(rows), expected)
+        self.assertEqual(len(self.store.views), 0)
+        self.assertEqual(list(self.store.author_by_books_iter()), self.store.author_by_books())
+        expected = self.store.book_by_authors()
+        rows = self.store.book_by_authors_iter(min_count=2)
+        first = next(rows)
+        self.write()
+        self.assertEqual([first] + list(rows), [d for d in expected if d["author_count"] >= 2])
+    
+    def test_indexes(self):
+        expected = list(self.store.author_by_name_iter("a"))
+        rows = self.store.author_by_name_iter("a")
+        first = next(rows)
+        self.write()
+        self.assertEqual([first] + list(rows), expected)
+        self.assertNotEqual(list(self.store.author_by_name_iter("a")), expected)
+        expected = list(self.store.book_by_pubdate_iter(1, 1))
+        rows = self.store.book_by_pubdate_iter(1, 1)
+        first = next(rows)
+        self.store.book_delete("b3", 1)
+        self.store.book_create("b10", 1, [{"name": "a0", "dob": 1}])
+        self.assertEqual([first] + list(rows), expected)
+    
+    def test_dump(self):
+        version, chunks = self.store.dump(chunk_size=2)
+        expected = [row for chunk in self.store.dump()[1] for row in chunk]
+        first = next(chunks)
+        self.write()
+        self.assertEqual(first + [row for chunk in chunks for row in chunk], expected)
+    
+    def test_dropped(self):
+        # a stream left unfinished stops costing writes anything
+        rows = self.store.author_by_books_iter()
+        next(rows)
+        version, chunks = self.store.dump()
+        self.assertEqual(len(self.store.views), 2)
+        del rows, chunks
+        self.assertEqual(len(self.store.views), 0)
+        self.write()
+
+
+
+class TestReplica(unittest.TestCase):
+    
+    def setUp(self):
+        import threading
+        import wsgiref.simple_server
+        class Quiet(wsgiref.simple_server.WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+        self.leader_store = book_author.BookAuthorMemStorage(changes=8)
+        self.leader = webtest.TestApp(book_author.BookAuthor(storage=self.leader_store))
+        self.httpd = book_author.make_threaded_server('127.0.0.1', 0, self.leader.app, 4)
+        self.httpd.RequestHandlerClass = Quiet
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.start()
+        self.ctype = "application/json"
+        for i in range(5):
+            self.leader.put('/author/a%d/1' % i, json.dumps([{"title": "b%d" % (i % 2), "pubdate": 1}]),
+                content_type=self.ctype)
+        self.ba = book_author.BookAuthor()
+        self.follower = book_author.Follower(self.ba, '127.0.0.1', self.httpd.server_port,
+            max_lag=5, wait=0)
+        self.app = webtest.TestApp(self.ba)
+    
+    
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+    
+    
+    def test_follow(self):
+        # nothing served until there's a copy
+        self.app.get('/author/a1/1', status=503)
+        self.follower.bootstrap()
+        self.assertTrue(self.follower.poll())
+        self.assertEqual(self.app.get('/query/book_by_authors').json,
+            self.leader.get('/query/book_by_authors').json)
+        self.leader.put('/author/a1/1', json.dumps([{"title": "b9", "pubdate": 1}]),
+            content_type=self.ctype)
+        self.leader.delete('/book/b0/1')
+        self.assertTrue(self.follower.poll())
+        self.assertEqual(self.follower.seq, self.leader_store.version())
+        self.assertEqual(self.ba.storage.authors, self.leader_store.authors)
+        self.assertEqual(self.ba.storage.books, self.leader_store.books)
+        self.assertEqual(sorted(self.app.get('/author/a1/1').json),
+            sorted(self.leader.get('/author/a1/1').json))
+        # reads only, whatever the method
+        res = self.app.put('/author/a1/1', json.dumps([{"title": "b1", "pubdate": 1}]),
+            content_type=self.ctype, status=405)
+        self.assertEqual(res.headers['Allow'], 'GET')
+        self.app.post('/read', json.dumps([{"name": "a1", "dob": 1}]), content_type=self.ctype)
+        metrics = self.app.get('/metrics').body
+        self.assertTrue('bookauthor_replication_seq %d' % self.follower.seq in metrics)
+        self.assertTrue('bookauthor_replication_lag_seconds' in metrics)
+        # too long since the leader was heard from
+        self.follower.fresh_at -= 10
+        self.app.get('/author/a1/1', status=503)
+    
+    
+    def test_swap_mid_request(self):
+        # a request started on one storage finishes on it, ETag and body
+        later = book_author.BookAuthorMemStorage()
+        later.author_create("a1", 1, [{"title": "b2", "pubdate": 1}])
+        class Swapping(book_author.BookAuthorMemStorage):
+            def author_version(self, *key):
+                app.use_storage(later)
+                return book_author.BookAuthorMemStorage.author_version(self, *key)
+        first = Swapping()
+        first.author_create("a1", 1, [{"title": "b1", "pubdate": 1}])
+        app = book_author.BookAuthor(storage=first)
+        res = webtest.TestApp(app).get('/author/a1/1')
+        self.assertEqual(res.json, [{"title": "b1", "pubdate": 1}])
+        self.assertTrue(first.epoch in res.headers['ETag'])
+        res = webtest.TestApp(app).get('/author/a1/1')
+        self.assertEqual(res.json, [{"title": "b2", "pubdate": 1}])
+        self.assertTrue(later.epoch in res.headers['ETag'])
+    
+    
+    def test_short_polls(self):
+        # a leader that can't long-poll is asked again only after a pause
+        self.follower.bootstrap()
+        self.follower.wait = 0.2
+        started = time.time()
+        self.assertTrue(self.follower.poll())
+        self.assertFalse(self.follower.long_poll)
+        self.assertTrue(time.time() - started >= 0.2)
+        # and one that can is left to do the waiting
+        self.leader.app.max_wait = 30
+        self.assertTrue(self.follower.poll())
+        self.assertTrue(self.follower.long_poll)
+    
+    
+    def test_non_ascii(self):
+        # names the leader took through its path routes, in the dump and after
+        url = '/author/Garc%C3%ADa M%C3%A1rquez/1927'
+        self.leader.put(url, json.dumps([{"title": u"Cien a\u00f1os", "pubdate": 1967}]),
+            content_type=self.ctype)
+        self.follower.bootstrap()
+        self.leader.put('/book/El oto%C3%B1o/1975',
+            json.dumps([{"name": u"Garc\u00eda M\u00e1rquez", "dob": 1927}]),
+            content_type=self.ctype)
+        self.assertTrue(self.follower.poll())
+        self.assertEqual(self.ba.storage.authors, self.leader_store.authors)
+        self.assertEqual(sorted(self.app.get(url).json), sorted(self.leader.get(url).json))
+    
+    
+    def test_fell_behind(self):
+        self.follower.bootstrap()
+        self.follower.poll()
+        for i in range(20):
+            self.leader.put('/author/x%d/1' % i, json.dumps([{"title": "b1", "pubdate": 1}]),
+                content_type=self.ctype)
+        # the leader no longer has what's needed, so a fresh copy
+        self.assertFalse(self.follower.poll())
+        self.assertEqual(self.follower.bootstraps, 2)
+        self.assertTrue(self.follower.poll())
+        self.assertEqual(self.ba.storage.authors, self.leader_store.authors)
+    
+    
+    def test_dump_with_later_writes(self):
+        # writes made while the dump is read are also in the changes after it
+        version, chunks = self.leader_store.dump(chunk_size=2)
+        first = next(chunks)
+        self.leader_store.author_delete("a4", 1)
+        self.leader_store.author_create("a0", 1, [{"title": "b7", "pubdate": 1}])
+        copy = book_author.BookAuthorMemStorage()
+        rows = first + [row for chunk in chunks for row in chunk]
+        copy.bulk_create([book_author.parse_entity_record(row) for row in rows])
+        for seq, record in self.leader_store.changes.since(version)[0]:
+            copy.apply(record)
+        self.assertEqual(copy.authors, self.leader_store.authors)
+        self.assertEqual(copy.books, self.leader_store.books)
+
+
+
+class TestAsyncServer(unittest.TestCase):
+    
+    def setUp(self):
+        import threading
+        self.httpd = book_author.AsyncHTTPServer('127.0.0.1', 0,
+            book_author.BookAuthor(), max_request=1000)
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+            args=(0.05,))
+        self.thread.start()
+    
+    
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.thread.join()
+        self.httpd.server_close()
+    
+    
+    def connect(self):
+        import socket
+        return socket.create_connection(('127.0.0.1', self.httpd.server_port))
+    
+    
+    def responses(self, sock, n, method='GET'):
+        import httplib
+        a = []
+        for i in range(n):
+            r = httplib.HTTPResponse(sock, method=method)
+            r.begin()
+            a.append((r.status, r.getheader('transfer-encoding'), r.read()))
+        return a
+    
+    
+    def test_pipelined(self):
+        body = json.dumps([{"title": "b1", "pubdate": 1}])
+        sock = self.connect()
+        # three requests in one write, three answers in order
+        sock.sendall(
+            "PUT /author/a1/1 HTTP/1.1\r\nHost: x\r\nContent-Type: application/json\r\n"
+            "Content-Length: %d\r\n\r\n%s" % (len(body), body) +
+            "GET /author/a1/1 HTTP/1.1\r\nHost: x\r\n\r\n"
+            "GET /query/book_by_authors?limit=5 HTTP/1.1\r\nHost: x\r\n\r\n")
+        a = self.responses(sock, 3)
+        self.assertEqual([status for status, te, data in a], [201, 200, 200])
+        # streamed bodies are chunked, the connection stays up
+        self.assertEqual(a[1][1], 'chunked')
+        self.assertEqual(json.loads(a[1][2]), [{"title": "b1", "pubdate": 1}])
+        self.assertEqual(json.loads(a[2][2]), [{"title": "b1", "pubdate": 1, "author_count": 1}])
+        sock.sendall("GET /author/a2/1 HTTP/1.1\r\nHost: x\r\n\r\n")
+        self.assertEqual(self.responses(sock, 1)[0][0], 404)
+        sock.close()
+    
+    
+    def test_close(self):
+        sock = self.connect()
+        sock.sendall("GET /author/a1/1 HTTP/1.0\r\n\r\n")
+        self.assertEqual(self.responses(sock, 1)[0][0], 404)
+        self.assertEqual(sock.recv(1), '')
+        sock.close()
+    
+    
+    def test_bad_requests(self):
+        sock = self.connect()
+        sock.sendall("PUT /author/a1/1 HTTP/1.1\r\nContent-Length: 5000\r\n\r\n")
+        self.assertEqual(self.responses(sock, 1)[0][0], 413)
+        sock.close()
+        sock = self.connect()
+        sock.sendall("nonsense\r\n\r\n")
+        self.assertEqual(self.responses(sock, 1)[0][0], 400)
+        sock.close()
+
+
+
+class TestBench(unittest.TestCase):
+    # the benchmark harness still runs, on a tiny catalog
+    
+    def test_catalog_reproducible(self):
+        import bench_book_author
+        a = bench_book_author.make_catalog(50, 80, 10, 1.2, 3)
+        self.assertEqual(a, bench_book_author.make_catalog(50, 80, 10, 1.2, 3))
+        self.assertNotEqual(a, bench_book_author.make_catalog(50, 80, 10, 1.2, 4))
+        ops = bench_book_author.make_workload(a, 100, 0.2, 1.2, 3)
+        self.assertEqual(len(ops), 100)
+    
+    
+    def test_load(self):
+        import bench_book_author
+        import sys
+        import StringIO
+        path = os.path.join(tempfile.mkdtemp(), 'bench.json')
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            bench_book_author.main(['load', '--authors', '50', '--books', '80',
+                '--requests', '200', '--driver', 'socket', '--clients', '2',
+                '--json', path])
+        finally:
+            sys.stdout = stdout
+        with open(path) as f:
+            results = json.load(f)
+        shutil.rmtree(os.path.dirname(path))
+        self.assertEqual(results["requests"], 200)
+        self.assertEqual(sum(r["count"] for r in results["routes"].values()), 200)
+        self.assertFalse(any("0" in r["status"] for r in results["routes"].values()))
+        self.assertTrue(results["peak_rss_kb"] > 0)
+
 
 
 if __name__ == '__main__':